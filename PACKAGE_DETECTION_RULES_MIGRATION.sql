@@ -0,0 +1,49 @@
+-- =====================================================
+-- PACKAGE DETECTION RULES MIGRATION
+-- =====================================================
+-- Target: VPS Production Database (tikz2svg)
+-- Purpose: Extra auto-detection triggers for detect_required_packages,
+--          on top of BUILTIN_RULES in package_detector.py
+--
+-- A rule means: if trigger_text occurs in the submitted code (case-sensitive
+-- substring), add target_name to the preamble. target_name must exist in
+-- supported_packages and in the SAFE_* allowlists of app.py, otherwise the
+-- rule is ignored. Workers pick up changes within TIKZ_PACKAGE_RULES_REFRESH
+-- seconds (immediately in the worker that approves a package).
+--
+-- INSTRUCTIONS FOR MANUAL EXECUTION ON VPS:
+-- 1. SSH to VPS
+-- 2. Connect to MySQL: mysql -u root -p tikz2svg
+-- 3. Copy and paste this entire script
+-- 4. Verify results at the end
+-- =====================================================
+
+CREATE TABLE IF NOT EXISTS `package_detection_rules` (
+    `id` INT AUTO_INCREMENT PRIMARY KEY,
+    `trigger_text` VARCHAR(255) NOT NULL COMMENT 'Chuỗi cần tìm trong code, vd. \\tdplotsetmaincoords',
+    `target_type` ENUM('package', 'tikz_lib', 'pgfplots_lib') NOT NULL DEFAULT 'package',
+    `target_name` VARCHAR(255) NOT NULL COMMENT 'supported_packages.package_name',
+    `is_active` TINYINT(1) NOT NULL DEFAULT 1,
+    `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+
+    UNIQUE KEY `uniq_trigger_target` (`trigger_text`, `target_type`, `target_name`),
+    INDEX `idx_target_name` (`target_name`),
+    INDEX `idx_is_active` (`is_active`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin
+COMMENT='Trigger tự động phát hiện package/thư viện (bổ sung cho BUILTIN_RULES)';
+
+-- =====================================================
+-- VERIFICATION QUERIES
+-- =====================================================
+
+SELECT
+    'Detection rules by target' as report_type,
+    r.target_type,
+    r.target_name,
+    COUNT(*) as triggers,
+    SUM(sp.id IS NULL) as unsupported_target
+FROM `package_detection_rules` r
+LEFT JOIN `supported_packages` sp ON sp.package_name = r.target_name
+GROUP BY r.target_type, r.target_name
+ORDER BY r.target_type, r.target_name;
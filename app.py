@@ -1,13 +1,15 @@
-from flask import Flask, request, render_template, url_for, send_file, jsonify, session, redirect, flash, make_response, send_from_directory, render_template_string
+from flask import Flask, request, render_template, url_for, send_file, jsonify, session, redirect, flash, make_response, send_from_directory, render_template_string, Response
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from werkzeug.middleware.proxy_fix import ProxyFix
 import os
+import hmac
 import subprocess
 import uuid
 from datetime import datetime, timezone, timedelta
 import time
+import math
 import glob
 import cairosvg
 from PIL import Image
@@ -22,12 +24,16 @@ from dotenv import load_dotenv
 from werkzeug.utils import secure_filename
 import mysql.connector
 import threading
+import atexit
 import psutil
 from contextlib import contextmanager
 from pathlib import Path
 import hashlib
+import shutil
+import zlib
+from collections import OrderedDict
 import logging
-from typing import Iterable
+from typing import Iterable, Optional
 import smtplib
 import base64
 from email.mime.text import MIMEText
@@ -36,6 +42,26 @@ from email_service import init_email_service, get_email_service
 from comments_helpers import add_security_headers
 from comments_routes import comments_bp
 from notification_service import init_notification_service, get_notification_service
+from latex_format_pool import LaTeXFormatPool
+from latex_warm_pool import LuaLaTeXWarmPool, WARM_POOL_USER
+from latex_sandbox import LaTeXSandbox
+from compilation_cache_tiers import SharedFileCache, RedisCache, DEFAULT_L2_DIR
+from tex_normalize import normalize_tikz_code
+from tex_security import scan_tex_security, DANGEROUS_PATTERNS, MAX_CODE_BYTES, MAX_BRACE_DEPTH, MAX_BRACE_IMBALANCE, MAX_FOREACH
+from cache_analytics import HotKeyTracker
+from cache_warmer import CacheWarmer, WARMER_USER_ID
+from compile_singleflight import SingleFlight, DEFAULT_LOCK_DIR as DEFAULT_FLIGHT_LOCK_DIR
+from compile_jobs import init_compile_job_queue, get_compile_job_queue, CompileJobQueue
+from compile_daemon import CompileDaemonClient, CompileDaemonUnavailable, CompileDaemonError
+from compile_slots import HostCompileSlots, CompilationQueueFull, DEFAULT_SLOTS_DIR, auto_concurrency
+from compile_cancel import CompileSessions, CompilationCancelled, valid_session_id, DEFAULT_SESSIONS_DIR
+from system_load import SystemLoadSampler
+from compile_workspace import WorkspaceAllocator, DEFAULT_WORKSPACE_ROOT, KEEP_AFTER_FAILURE
+from package_detector import PackageDetector
+from tex_syntax import check_tex_syntax, format_syntax_errors, syntax_error_summary
+from tex_log import (FatalErrorWatcher, first_fatal_error, document_line, latex_error_excerpt, make_error_excerpt, format_error_excerpt,
+                     save_error_excerpt, load_error_excerpt, write_console_log, error_identity, relocate_error_excerpt,
+                     EXCERPT_FILE)
 
 load_dotenv()
 
@@ -73,6 +99,16 @@ def get_real_ip():
         return request.headers.get('X-Forwarded-For').split(',')[0].strip()
     return request.remote_addr or '127.0.0.1'
 
+def compile_user_key():
+    """
+    Owner key for compile slots (MAX_PER_USER) and editor sessions
+    Logged-out callers are keyed by client IP (remote_addr, fixed up by ProxyFix),
+    otherwise every anonymous preview on the host would share one user's quota
+    """
+    if current_user.is_authenticated:
+        return str(current_user.id)
+    return f"anonymous:{request.remote_addr or 'unknown'}"
+
 # Initialize Flask-Limiter
 # In development: disable rate limiting entirely for testing
 # In production: use Redis storage with real IP tracking
@@ -281,66 +317,20 @@ class CompilationLimits:
     """Resource limits for LaTeX compilation"""
     
     TIMEOUT_SECONDS = 45           # Max compilation time
+    MAX_ADAPTIVE_TIMEOUT_SECONDS = 120  # Upper clamp of AdaptiveResourceLimits per LaTeX run
+    MAX_LATEX_RUNS = 3             # minimal -> full preamble, pdflatex -> lualatex fallback
+    SVG_TIMEOUT_SECONDS = 15       # pdf2svg / dvisvgm
     MAX_MEMORY_MB = 300           # Max memory per compilation
     MAX_CPU_PERCENT = 80          # Max CPU usage
-    MAX_CONCURRENT = 5            # Max concurrent compilations
-    
-    _active_compilations = 0
-    _compilation_lock = threading.Lock()
+    # Max concurrent compilations (host-wide): CPU cores / available memory, TIKZ_MAX_CONCURRENT overrides
+    MAX_CONCURRENT = int(os.environ.get('TIKZ_MAX_CONCURRENT') or auto_concurrency(MAX_MEMORY_MB))
+    MAX_PER_USER = 2              # Max concurrent compilations per user (logged-out: per client IP)
 
 class LaTeXSecurityValidator:
-    """Validate LaTeX code for security threats"""
-    
-    # Dangerous patterns to block
-    DANGEROUS_PATTERNS = {
-        # Shell execution attempts
-        r'\\write18': "Shell execution command detected",
-        r'\\immediate\\write18': "Immediate shell execution detected", 
-        r'\\special': "Special command detected",
-        
-        # File system access attempts  
-        r'\\input\{[^}]*\.\./': "Directory traversal attempt",
-        r'\\input\{/(?:etc|root|home)/': "System file access attempt",
-        r'\\openin': "File input stream detected",
-        r'\\openout': "File output stream detected",
-        
-        # Suspicious file operations
-        r'\\verbatiminput\{[^}]*(?:/etc/|/root/|/home/)': "System file read attempt",
-        r'\\lstinputlisting\{[^}]*(?:/etc/|/root/|/home/)': "System file listing attempt",
-        
-        # Network/URL attempts
-        r'\\url\{(?:file://|ftp://)[^}]*\}': "Local/FTP URL detected",
-        
-        # Code injection attempts
-        r'\\catcode.*=.*13': "Catcode manipulation detected",
-        r'\\lowercase\{.*\\def': "Lowercase definition trick detected",
-        r'\\csname.*\\endcsname': "Control sequence name manipulation",
-        
-        # Resource exhaustion patterns
-        r'\\loop.*\\repeat': "Potentially infinite loop detected",
-        r'\\foreach.*\\foreach.*\\foreach': "Nested loop with potential DoS",
-        
-        # Lua execution (for lualatex)
-        r'\\directlua\{': "Direct Lua execution detected",
-        r'\\luaexec\{': "Lua execution detected",
-        
-        # Advanced patterns (LaTeX3 and modern packages)
-        r'\\__[\w_]+:': "LaTeX3 internal command access detected",
-        r'\\exp_last_unbraced:': "Advanced expansion manipulation detected",
-        
-        # TikZ-specific abuses
-        r'\\tikzset{.*execute\s*=.*begin': "TikZ code execution attempt",
-        r'pgfinvokebeamer': "Beamer-specific command injection",
-        
-        # Memory-based attacks
-        r'\\pgfmathdeclfunction.*\{.*\{.*\{.*': "Recursive function definition detected",
-        r'\\def\\recursive.*\\recursive': "Recursive macro definition detected",
-        
-        # Advanced file operations
-        r'\\pdffiledump': "PDF file dump attempt",
-        r'\\pdfmdfivesum': "PDF checksum access attempt",
-        r'\\pdfcreationdate': "PDF metadata access attempt",
-    }
+    """Validate LaTeX code for security threats (single linear pass, see tex_security)"""
+    
+    # Dangerous patterns to block (rule table of scan_tex_security)
+    DANGEROUS_PATTERNS = DANGEROUS_PATTERNS
     
     @staticmethod
     def validate_tikz_security(tikz_code: str) -> dict:
@@ -351,19 +341,11 @@ class LaTeXSecurityValidator:
         
         warnings = []
         
-        # Check dangerous patterns
-        for pattern, description in LaTeXSecurityValidator.DANGEROUS_PATTERNS.items():
-            if re.search(pattern, tikz_code, re.IGNORECASE | re.MULTILINE):
-                return {
-                    'safe': False,
-                    'reason': description,
-                    'warnings': warnings,
-                    'pattern': pattern,
-                    'severity': 'high'
-                }
+        # One pass: size limit first, then dangerous primitives, braces and \foreach counts
+        scan = scan_tex_security(tikz_code, max_bytes=MAX_CODE_BYTES)
         
         # Check code size (basic DoS prevention)
-        if len(tikz_code) > 50000:  # 50KB limit
+        if scan['too_large']:
             return {
                 'safe': False,
                 'reason': "Code too large (>50KB)",
@@ -371,27 +353,27 @@ class LaTeXSecurityValidator:
                 'severity': 'medium'
             }
         
+        # Check dangerous patterns
+        if scan['violation']:
+            return {
+                'safe': False,
+                'reason': LaTeXSecurityValidator.DANGEROUS_PATTERNS[scan['violation']],
+                'warnings': warnings,
+                'pattern': scan['violation'],
+                'line': scan['line'],
+                'severity': 'high'
+            }
+        
         # Check excessive nesting
-        brace_count = tikz_code.count('{') - tikz_code.count('}')
-        if abs(brace_count) > 5:  # Unbalanced braces
+        if abs(scan['brace_balance']) > MAX_BRACE_IMBALANCE:  # Unbalanced braces
             warnings.append("Unbalanced braces detected")
         
-        max_nesting = 0
-        current_nesting = 0
-        for char in tikz_code:
-            if char == '{':
-                current_nesting += 1
-                max_nesting = max(max_nesting, current_nesting)
-            elif char == '}':
-                current_nesting -= 1
-        
-        if max_nesting > 20:  # Deep nesting limit
+        if scan['max_depth'] > MAX_BRACE_DEPTH:  # Deep nesting limit
             warnings.append("Deep nesting detected (potential DoS)")
         
         # Check for excessive repetition
-        foreach_count = len(re.findall(r'\\foreach', tikz_code, re.IGNORECASE))
-        if foreach_count > 5:
-            warnings.append(f"Many foreach loops detected ({foreach_count})")
+        if scan['foreach_count'] > MAX_FOREACH:
+            warnings.append(f"Many foreach loops detected ({scan['foreach_count']})")
         
         return {
             'safe': True,
@@ -401,53 +383,48 @@ class LaTeXSecurityValidator:
         }
 
 class ConcurrentCompilationManager:
-    """Manage concurrent compilation limits"""
+    """Manage concurrent compilation limits (host-wide, shared by all gunicorn workers)"""
     
-    def __init__(self, max_concurrent=5):
+    def __init__(self, max_concurrent=5, max_per_user=2, slots_dir=None, lease_seconds=None, max_queue=None):
         self.max_concurrent = max_concurrent
-        self.active_count = 0
-        self.lock = threading.Lock()
-        self.compilation_queue = []
+        self.max_per_user = max_per_user
+        self.slots = HostCompileSlots(
+            state_dir=slots_dir or DEFAULT_SLOTS_DIR,
+            max_concurrent=max_concurrent,
+            max_per_user=max_per_user,
+            # Longest compile: every LaTeX run at the adaptive ceiling, then the SVG step (+ margin);
+            # a lease must not expire under a compile that is still running
+            lease_seconds=lease_seconds or (CompilationLimits.MAX_ADAPTIVE_TIMEOUT_SECONDS * CompilationLimits.MAX_LATEX_RUNS
+                                            + CompilationLimits.SVG_TIMEOUT_SECONDS + 30),
+            max_queue=max_queue
+        )
     
     def can_start_compilation(self, user_id: str) -> bool:
-        """Check if user can start new compilation"""
-        with self.lock:
-            # Check global limit
-            if self.active_count >= self.max_concurrent:
-                return False
-            
-            # Check per-user limit (max 2 concurrent per user)
-            user_compilations = sum(1 for item in self.compilation_queue if item['user_id'] == user_id)
-            if user_compilations >= 2:
-                return False
-                
-            return True
+        """Check if user can start new compilation without queueing (advisory, start_compilation decides)"""
+        stats = self.slots.get_stats()
+        return stats['active_count'] < self.max_concurrent and stats['queued'] == 0
     
-    def start_compilation(self, user_id: str, compilation_id: str):
-        """Register new compilation"""
-        with self.lock:
-            self.active_count += 1
-            self.compilation_queue.append({
-                'user_id': user_id,
-                'compilation_id': compilation_id,
-                'start_time': time.time()
-            })
+    def start_compilation(self, user_id: str, lane: str = 'interactive', cancelled=None) -> str:
+        """
+        Register new compilation, waiting in the lane's fair queue if all slots are busy
+        Returns compilation_id; raises CompilationQueueFull (with retry_after) when shed,
+        CompilationCancelled when the request is superseded while waiting
+        """
+        return self.slots.acquire(user_id, lane, cancelled=cancelled)
     
     def end_compilation(self, compilation_id: str):
         """Unregister completed compilation"""
-        with self.lock:
-            self.active_count = max(0, self.active_count - 1)
-            self.compilation_queue = [
-                item for item in self.compilation_queue 
-                if item['compilation_id'] != compilation_id
-            ]
+        self.slots.release(compilation_id)
+    
+    def get_stats(self) -> dict:
+        return self.slots.get_stats()
 
 class CompilationErrorClassifier:
     """Intelligent error classification for better UX"""
     
     ERROR_CATEGORIES = {
         'syntax': {
-            'patterns': [r'Undefined control sequence', r'Missing \\begin', r'Extra \\end'],
+            'patterns': [r'Syntax pre-check', r'Undefined control sequence', r'Missing \\begin', r'Extra \\end'],
             'user_message': "Lỗi cú pháp LaTeX: Kiểm tra lại cú pháp TikZ của bạn",
             'suggestions': ["Kiểm tra dấu ngoặc nhọn {}", "Xem lại \\begin và \\end", "Kiểm tra tên lệnh"]
         },
@@ -510,10 +487,11 @@ class CompilationErrorClassifier:
 class AdaptiveCompilationLimits:
     """Dynamic resource limits based on system load and user tier"""
     
-    def __init__(self):
+    def __init__(self, load_sampler: SystemLoadSampler = None):
+        self.load_sampler = load_sampler  # None = measure CPU inline (blocks 100ms)
         self.base_timeout = 45          # Base timeout seconds
         self.base_memory_mb = 300       # Base memory MB
-        self.base_concurrent = 5        # Base concurrent limit
+        self.base_concurrent = CompilationLimits.MAX_CONCURRENT  # Base concurrent limit
         
         # User tier multipliers
         self.user_tier_multipliers = {
@@ -535,9 +513,12 @@ class AdaptiveCompilationLimits:
         return 'free'
     
     def get_system_load_level(self) -> str:
-        """Get current system load level"""
+        """Get current system load level (CPU averaged over the sampler window)"""
         try:
-            cpu_percent = psutil.cpu_percent(interval=0.1)
+            if self.load_sampler:
+                cpu_percent = self.load_sampler.snapshot()['avg_cpu_percent']
+            else:
+                cpu_percent = psutil.cpu_percent(interval=0.1)
             if cpu_percent < self.load_thresholds['low']:
                 return 'low'
             elif cpu_percent < self.load_thresholds['medium']:
@@ -583,31 +564,186 @@ class AdaptiveCompilationLimits:
         adaptive_limits['max_concurrent'] = max(1, adaptive_limits['max_concurrent'])
         
         # Ensure maximum limits for safety
-        adaptive_limits['timeout_seconds'] = min(120, adaptive_limits['timeout_seconds'])
+        adaptive_limits['timeout_seconds'] = min(CompilationLimits.MAX_ADAPTIVE_TIMEOUT_SECONDS, adaptive_limits['timeout_seconds'])
         adaptive_limits['max_memory_mb'] = min(1000, adaptive_limits['max_memory_mb'])
         adaptive_limits['max_concurrent'] = min(10, adaptive_limits['max_concurrent'])
         
         return adaptive_limits
 
+class CompilationEngineRouter:
+    """Pick the fastest LaTeX engine that can handle the TikZ code"""
+    
+    FAST_ENGINE = 'pdflatex'
+    DEFAULT_ENGINE = 'lualatex'
+    
+    # Packages that only work (or only make sense) with LuaLaTeX
+    LUALATEX_PACKAGES = {
+        'fontspec', 'polyglossia', 'unicode-math', 'luacode', 'luatexja', 'luamplib', 'CJKutf8'
+    }
+    
+    # TikZ libraries that need LuaTeX
+    LUALATEX_TIKZ_LIBS = {'graphdrawing'}
+    
+    # Code features that need LuaLaTeX
+    LUALATEX_PATTERNS = {
+        r'\\setmainfont|\\set(?:sans|mono|math)font': "fontspec font selection",
+        r'\\fontspec|\\newfontfamily|\\addfontfeature': "fontspec command",
+        r'\\begin\{CJK|\\CJKfamily|\\ltjset': "CJK text",
+        r'\\directlua|\\luaexec|\\begin\{luacode|\\luadirect': "Lua code",
+        r'\\usegdlibrary|\\mplibcode': "LuaTeX-only feature",
+    }
+    
+    # First fatal errors that LuaLaTeX would raise just the same: no fallback run
+    ENGINE_AGNOSTIC_ERRORS = re.compile(
+        r"^(Missing \$ inserted|Missing [{}] inserted|Extra [}]|Extra alignment tab|Too many [}]'s|"
+        r"Paragraph ended before|File ended while scanning|Argument of .* has an extra [}]|"
+        r"Illegal unit of measure|Illegal parameter number|Misplaced alignment tab|Dimension too large|"
+        r"Package (pgfkeys|pgf|tikz|pgfplots) Error|LaTeX Error: \\begin\{.*\} on input line \d+ ended by|"
+        r"LaTeX Error: File `[^']*' not found)"
+    )
+    # With the full preamble loaded these only differ between engines for LuaTeX-only
+    # commands, and LUALATEX_PATTERNS already routed the known ones to LuaLaTeX
+    ENGINE_AGNOSTIC_WITH_FULL_PREAMBLE = re.compile(r"^(Undefined control sequence|LaTeX Error: Environment \S+ undefined)")
+    
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.stats = {
+            'routed': {self.FAST_ENGINE: 0, self.DEFAULT_ENGINE: 0},
+            'succeeded': {self.FAST_ENGINE: 0, self.DEFAULT_ENGINE: 0},
+            'fallbacks': 0,
+            'fallbacks_skipped': 0,
+            'reasons': {}
+        }
+    
+    def route(self, tikz_code: str, packages: list = None, tikz_libs: list = None) -> dict:
+        """
+        Choose engine for this code
+        Returns: {'engine': 'pdflatex'|'lualatex', 'reason': str}
+        """
+        reason = self._lualatex_reason(tikz_code, packages or [], tikz_libs or [])
+        if not self.enabled and not reason:
+            reason = "engine routing disabled"
+        engine = self.DEFAULT_ENGINE if reason else self.FAST_ENGINE
+        
+        with self.lock:
+            self.stats['routed'][engine] += 1
+            if reason:
+                self.stats['reasons'][reason] = self.stats['reasons'].get(reason, 0) + 1
+        
+        return {'engine': engine, 'reason': reason or "plain TikZ"}
+    
+    def _lualatex_reason(self, tikz_code: str, packages: list, tikz_libs: list) -> str:
+        """Why this code needs LuaLaTeX ('' if pdfLaTeX can handle it)"""
+        if not tikz_code.isascii():
+            return "non-ASCII text"
+        
+        for pkg in packages:
+            pkg_name = pkg.get('name', '') if isinstance(pkg, dict) else str(pkg)
+            if pkg_name in self.LUALATEX_PACKAGES:
+                return f"package {pkg_name}"
+        
+        for lib in tikz_libs:
+            if lib in self.LUALATEX_TIKZ_LIBS:
+                return f"tikz library {lib}"
+        
+        for pattern, description in self.LUALATEX_PATTERNS.items():
+            if re.search(pattern, tikz_code):
+                return description
+        
+        return ""
+    
+    def fallback_may_help(self, latex_output: str, full_preamble: bool = False) -> bool:
+        """False when the fast engine's first fatal error does not depend on the engine (syntax, unknown key, ...)"""
+        error = first_fatal_error(latex_output)
+        if error and (self.ENGINE_AGNOSTIC_ERRORS.match(error['message']) or
+                      (full_preamble and self.ENGINE_AGNOSTIC_WITH_FULL_PREAMBLE.match(error['message']))):
+            with self.lock:
+                self.stats['fallbacks_skipped'] += 1
+            return False
+        return True
+    
+    def record_result(self, engine: str, success: bool, fallback: bool = False):
+        """Record outcome of a compile on the given engine"""
+        with self.lock:
+            if success:
+                self.stats['succeeded'][engine] = self.stats['succeeded'].get(engine, 0) + 1
+            if fallback:
+                self.stats['fallbacks'] += 1
+    
+    def get_stats(self) -> dict:
+        """Get routing statistics"""
+        with self.lock:
+            fast_routed = self.stats['routed'][self.FAST_ENGINE]
+            return {
+                'enabled': self.enabled,
+                'routed': dict(self.stats['routed']),
+                'succeeded': dict(self.stats['succeeded']),
+                'fallbacks': self.stats['fallbacks'],
+                'fallbacks_skipped': self.stats['fallbacks_skipped'],
+                'fast_engine_fallback_rate_percent': round(self.stats['fallbacks'] / max(1, fast_routed) * 100, 2),
+                'lualatex_reasons': dict(self.stats['reasons'])
+            }
+
 class CompilationCache:
-    """Intelligent caching system for compilation results"""
+    """
+    Intelligent caching system for compilation results
+    L1 is this in-process OrderedDict LRU (O(1) get/set/evict) of zlib-compressed
+    SVGs, bounded by compressed bytes, entry count and an optional TTL.
+    Failed compilations are cached in L1 as negative entries under the same
+    key with a short TTL (classified error + log excerpt).
+    Every entry is tagged (template, toolchain, engine, converter, packages,
+    libraries) so purge() can drop e.g. everything using circuitikz; purges
+    reach the other workers' L1 through a shared append-only journal.
+    Optional shared tiers (L2 files, L3 Redis) sit behind it. Writes go to
+    every tier, lower-tier hits are promoted upwards.
+    Every lookup is also counted in an optional HotKeyTracker (per-key
+    frequencies, miss ratios and working-set size of this worker).
+    """
     
-    def __init__(self, max_cache_size_mb=50):
-        self.cache = {}                    # SHA256 -> cache_entry
+    def __init__(self, max_cache_size_mb=50, tiers: list = None, max_entries: int = 20000,
+                 ttl_seconds: int = None, compression_level: int = 6, negative_ttl_seconds: int = 120,
+                 purge_journal: str = None, hot_keys: HotKeyTracker = None):
+        self.cache = OrderedDict()         # SHA256 -> cache_entry (least recently used first)
         self.max_cache_size_mb = max_cache_size_mb
-        self.current_size_bytes = 0
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds     # None = entries only leave by LRU eviction
+        self.negative_ttl_seconds = negative_ttl_seconds  # failures: 0 = never cached
+        self.compression_level = compression_level
+        self.current_size_bytes = 0        # exact: sum of compressed payload lengths
+        self.raw_size_bytes = 0            # uncompressed UTF-8 size of the same entries
         self.cache_lock = threading.Lock()
+        self.tiers = tiers or []           # ordered L2, L3, ... (get/set/clear/get_stats)
+        self.template_version = ""         # set once the LaTeX templates are defined (TEMPLATE_VERSION)
+        self.purge_journal = purge_journal # shared JSONL of purges, replayed by every worker
+        if self.purge_journal:
+            os.makedirs(os.path.dirname(self.purge_journal), exist_ok=True)
+        self.purge_journal_offset = self._journal_size()  # purges before startup cannot hit an empty L1
+        self.purge_checked_at = 0.0
+        self.hot_keys = hot_keys           # None = no per-key analytics
         
         # Cache statistics
         self.stats = {
             'hits': 0,
             'misses': 0,
             'evictions': 0,
-            'total_requests': 0
+            'expirations': 0,
+            'total_requests': 0,
+            'l1_hits': 0,
+            'promotions': 0,
+            'negative_hits': 0,
+            'negative_writes': 0,
+            'purged': 0
         }
+        for tier in self.tiers:
+            self.stats[f"{tier.name}_hits"] = 0
     
-    def _calculate_cache_key(self, tikz_code: str, packages: list, tikz_libs: list, pgfplots_libs: list) -> str:
-        """Generate SHA256 cache key from compilation parameters"""
+    def _calculate_cache_key(self, tikz_code: str, packages: list, tikz_libs: list, pgfplots_libs: list, engine: str = 'lualatex', svg_pipeline: str = 'pdf2svg') -> str:
+        """
+        Generate SHA256 cache key from compilation parameters
+        The code is canonicalized first (comments, insignificant whitespace),
+        so edits TeX cannot see still hit the cache
+        """
         
         # Normalize packages to consistent format for caching
         normalized_packages = []
@@ -623,131 +759,415 @@ class CompilationCache:
         
         # Create consistent string representation
         cache_input = {
-            'tikz_code': tikz_code.strip(),
+            'tikz_code': normalize_tikz_code(tikz_code),
             'packages': sorted(normalized_packages),
             'tikz_libs': sorted(tikz_libs) if tikz_libs else [],
-            'pgfplots_libs': sorted(pgfplots_libs) if pgfplots_libs else []
+            'pgfplots_libs': sorted(pgfplots_libs) if pgfplots_libs else [],
+            'engine': engine,
+            'svg_pipeline': svg_pipeline,
+            'template_version': self.template_version,
+            'toolchain_version': get_toolchain_version(engine, svg_pipeline)
         }
         
         # Convert to JSON and generate SHA256
         cache_string = json.dumps(cache_input, sort_keys=True)
         return hashlib.sha256(cache_string.encode('utf-8')).hexdigest()
     
-    def _estimate_svg_size(self, svg_content: str) -> int:
-        """Estimate SVG content size in bytes"""
-        return len(svg_content.encode('utf-8'))
-    
-    def _evict_lru_entries(self, required_space: int):
-        """Evict least recently used entries to make space"""
-        
-        if not self.cache:
-            return
-        
-        # Sort by last_accessed (LRU eviction)
-        sorted_entries = sorted(
-            self.cache.items(), 
-            key=lambda x: x[1]['last_accessed']
-        )
+    def _entry_tags(self, packages: list, tikz_libs: list, pgfplots_libs: list, engine: str, svg_pipeline: str) -> tuple:
+        """Purge tags of one entry: versions, engine/converter, packages and libraries"""
+        tags = [
+            f"template:{self.template_version}",
+            f"toolchain:{get_toolchain_version(engine, svg_pipeline)}",
+            f"engine:{engine}",
+            f"converter:{svg_pipeline}"
+        ]
+        for pkg in packages or []:
+            tags.append(f"package:{pkg.get('name', '') if isinstance(pkg, dict) else pkg}")
+        tags.extend(f"tikzlib:{lib}" for lib in tikz_libs or [])
+        tags.extend(f"pgfplotslib:{lib}" for lib in pgfplots_libs or [])
+        return tuple(dict.fromkeys(tags))
+    
+    def _compress(self, svg_content: str) -> tuple:
+        """(zlib payload, raw UTF-8 size); called outside cache_lock"""
+        raw = svg_content.encode('utf-8')
+        return zlib.compress(raw, self.compression_level), len(raw)
+    
+    def _drop_entry(self, cache_key: str):
+        """Remove one entry and its byte accounting (called with cache_lock held)"""
+        entry = self.cache.pop(cache_key)
+        self.current_size_bytes -= entry['size_bytes']
+        self.raw_size_bytes -= entry['raw_size_bytes']
+    
+    def _evict_lru_entries(self, required_space: int, required_slots: int = 0):
+        """Evict least recently used entries to make space (called with cache_lock held)"""
         
         freed_space = 0
         evicted_count = 0
         
-        for cache_key, entry in sorted_entries:
-            entry_size = entry['size_bytes']
-            
-            del self.cache[cache_key]
-            self.current_size_bytes -= entry_size
-            freed_space += entry_size
+        # OrderedDict keeps LRU order: the oldest entry is always first, no sort needed
+        while self.cache and (freed_space < required_space or evicted_count < required_slots):
+            cache_key, entry = next(iter(self.cache.items()))
+            freed_space += entry['size_bytes']
+            self._drop_entry(cache_key)
             evicted_count += 1
-            
-            if freed_space >= required_space:
-                break
         
         self.stats['evictions'] += evicted_count
-        print(f"Cache: Evicted {evicted_count} entries, freed {freed_space} bytes")
+        if evicted_count:
+            print(f"Cache: Evicted {evicted_count} entries, freed {freed_space} bytes")
     
-    def get(self, tikz_code: str, packages: list = None, tikz_libs: list = None, pgfplots_libs: list = None) -> dict:
-        """Get cached compilation result"""
+    def get(self, tikz_code: str, packages: list = None, tikz_libs: list = None, pgfplots_libs: list = None, engine: str = 'lualatex', svg_pipeline: str = 'pdf2svg',
+            probe: bool = False) -> dict:
+        """Get cached compilation result (probe=True: secondary lookup of the same request, not counted in stats/hot keys)"""
         
+        self._sync_purges()
+        # Key first: normalization is O(len(code)) and must not serialize lookups behind cache_lock
+        cache_key = self._calculate_cache_key(tikz_code, packages or [], tikz_libs or [], pgfplots_libs or [], engine, svg_pipeline)
         with self.cache_lock:
-            self.stats['total_requests'] += 1
+            self.stats['total_requests'] += not probe
             
-            cache_key = self._calculate_cache_key(tikz_code, packages or [], tikz_libs or [], pgfplots_libs or [])
+            entry = self.cache.get(cache_key)
+            if entry is not None and entry['expires_at'] is not None and entry['expires_at'] <= time.time():
+                # Expired: drop it and fall through to the shared tiers
+                self._drop_entry(cache_key)
+                self.stats['expirations'] += 1
+                entry = None
             
-            if cache_key in self.cache:
+            if entry is not None:
                 # Cache hit
-                self.stats['hits'] += 1
-                entry = self.cache[cache_key]
+                self.stats['hits'] += not probe
+                self.stats['l1_hits'] += not probe
+                self.cache.move_to_end(cache_key)
                 entry['last_accessed'] = time.time()
                 entry['hit_count'] += 1
-                
+                if entry['failed']:
+                    self.stats['negative_hits'] += 1
+                payload = entry['payload']
+                failed = entry['failed']
+                cached_at = entry['cached_at']
+                hit_count = entry['hit_count']
+        
+        if entry is not None:
+            if self.hot_keys and not probe:
+                self.hot_keys.record(cache_key, hit=True, tikz_code=tikz_code)
+            if failed:
                 return {
                     'found': True,
-                    'svg_content': entry['svg_content'],
+                    'failed': True,
+                    'failure': json.loads(zlib.decompress(payload)),
                     'cache_key': cache_key,
-                    'cached_at': entry['cached_at'],
-                    'hit_count': entry['hit_count']
+                    'cached_at': cached_at,
+                    'hit_count': hit_count,
+                    'tier': 'l1'
                 }
-            else:
-                # Cache miss
-                self.stats['misses'] += 1
-                return {
-                    'found': False,
-                    'cache_key': cache_key
-                }
-    
-    def set(self, tikz_code: str, svg_content: str, packages: list = None, tikz_libs: list = None, pgfplots_libs: list = None):
-        """Cache compilation result"""
+            return {
+                'found': True,
+                'failed': False,
+                'svg_content': zlib.decompress(payload).decode('utf-8'),
+                'cache_key': cache_key,
+                'cached_at': cached_at,
+                'hit_count': hit_count,
+                'tier': 'l1'
+            }
         
-        with self.cache_lock:
-            cache_key = self._calculate_cache_key(tikz_code, packages or [], tikz_libs or [], pgfplots_libs or [])
-            entry_size = self._estimate_svg_size(svg_content)
+        # L1 miss: look in the shared tiers (I/O outside the lock)
+        for index, tier in enumerate(self.tiers):
+            svg_content = tier.get(cache_key)
+            if svg_content is None:
+                continue
             
-            # Check if we need to make space
-            max_size_bytes = self.max_cache_size_mb * 1024 * 1024
-            if self.current_size_bytes + entry_size > max_size_bytes:
-                required_space = (self.current_size_bytes + entry_size) - max_size_bytes + (1024 * 1024)  # Extra 1MB buffer
-                self._evict_lru_entries(required_space)
+            # Promote into L1 and every tier above the one that hit
+            tags = self._entry_tags(packages, tikz_libs, pgfplots_libs, engine, svg_pipeline)
+            for upper_tier in self.tiers[:index]:
+                upper_tier.set(cache_key, svg_content, tags)
+            payload, raw_size = self._compress(svg_content)
+            with self.cache_lock:
+                self._store_l1(cache_key, payload, raw_size, tags)
+                self.stats['hits'] += not probe
+                self.stats[f"{tier.name}_hits"] += not probe
+                self.stats['promotions'] += 1
+            if self.hot_keys and not probe:
+                self.hot_keys.record(cache_key, hit=True, tikz_code=tikz_code)
             
-            # Add to cache
-            self.cache[cache_key] = {
+            return {
+                'found': True,
+                'failed': False,
                 'svg_content': svg_content,
+                'cache_key': cache_key,
                 'cached_at': time.time(),
-                'last_accessed': time.time(),
-                'hit_count': 0,
-                'size_bytes': entry_size,
-                'tikz_code_preview': tikz_code[:100] + '...' if len(tikz_code) > 100 else tikz_code
+                'hit_count': 1,
+                'tier': tier.name
             }
-            
-            self.current_size_bytes += entry_size
+        
+        # Cache miss
+        with self.cache_lock:
+            self.stats['misses'] += not probe
+        if self.hot_keys and not probe:
+            self.hot_keys.record(cache_key, hit=False, tikz_code=tikz_code)
+        return {
+            'found': False,
+            'cache_key': cache_key
+        }
+    
+    def set(self, tikz_code: str, svg_content: str, packages: list = None, tikz_libs: list = None, pgfplots_libs: list = None, engine: str = 'lualatex', svg_pipeline: str = 'pdf2svg'):
+        """Cache compilation result (write-through to every tier)"""
+        
+        cache_key = self._calculate_cache_key(tikz_code, packages or [], tikz_libs or [], pgfplots_libs or [], engine, svg_pipeline)
+        tags = self._entry_tags(packages, tikz_libs, pgfplots_libs, engine, svg_pipeline)
+        payload, raw_size = self._compress(svg_content)
+        with self.cache_lock:
+            self._store_l1(cache_key, payload, raw_size, tags)
+        for tier in self.tiers:
+            tier.set(cache_key, svg_content, tags)
+    
+    def set_failure(self, tikz_code: str, failure: dict, packages: list = None, tikz_libs: list = None, pgfplots_libs: list = None, engine: str = 'lualatex', svg_pipeline: str = 'pdf2svg'):
+        """
+        Cache a failed compilation (L1 only, negative_ttl_seconds)
+        failure: {'error_message', 'category', 'classification', 'log_excerpt'}
+        A later successful set() for the same key replaces it
+        """
+        if not self.negative_ttl_seconds:
+            return
+        
+        cache_key = self._calculate_cache_key(tikz_code, packages or [], tikz_libs or [], pgfplots_libs or [], engine, svg_pipeline)
+        tags = self._entry_tags(packages, tikz_libs, pgfplots_libs, engine, svg_pipeline)
+        payload, raw_size = self._compress(json.dumps(failure, ensure_ascii=False))
+        with self.cache_lock:
+            self._store_l1(cache_key, payload, raw_size, tags, failed=True, ttl_seconds=self.negative_ttl_seconds)
+            self.stats['negative_writes'] += 1
+    
+    def _store_l1(self, cache_key: str, payload: bytes, raw_size: int, tags: tuple = (), failed: bool = False, ttl_seconds: int = None):
+        """Insert into the in-process cache (called with cache_lock held)"""
+        if cache_key in self.cache:
+            self._drop_entry(cache_key)
+        
+        entry_size = len(payload)
+        
+        # Check if we need to make space (bytes and entry count)
+        max_size_bytes = self.max_cache_size_mb * 1024 * 1024
+        required_space = 0
+        if self.current_size_bytes + entry_size > max_size_bytes:
+            required_space = (self.current_size_bytes + entry_size) - max_size_bytes + (1024 * 1024)  # Extra 1MB buffer
+        required_slots = max(0, len(self.cache) + 1 - self.max_entries)
+        if required_space or required_slots:
+            self._evict_lru_entries(required_space, required_slots)
+        
+        # Add to cache (most recently used end)
+        now = time.time()
+        ttl_seconds = ttl_seconds or self.ttl_seconds
+        self.cache[cache_key] = {
+            'payload': payload,
+            'failed': failed,
+            'tags': tags,
+            'cached_at': now,
+            'last_accessed': now,
+            'expires_at': now + ttl_seconds if ttl_seconds else None,
+            'hit_count': 0,
+            'size_bytes': entry_size,
+            'raw_size_bytes': raw_size
+        }
+        
+        self.current_size_bytes += entry_size
+        self.raw_size_bytes += raw_size
+    
+    def _journal_size(self) -> int:
+        try:
+            return os.path.getsize(self.purge_journal) if self.purge_journal else 0
+        except OSError:
+            return 0
+    
+    def _purge_l1(self, tags: set) -> int:
+        """Drop L1 entries carrying any of tags (called with cache_lock held)"""
+        matching = [cache_key for cache_key, entry in self.cache.items() if tags.intersection(entry['tags'])]
+        for cache_key in matching:
+            self._drop_entry(cache_key)
+        self.stats['purged'] += len(matching)
+        return len(matching)
+    
+    def _sync_purges(self):
+        """Apply purges other workers appended to the journal (checked at most once per second)"""
+        now = time.time()
+        if not self.purge_journal or now - self.purge_checked_at < 1.0:
+            return
+        self.purge_checked_at = now
+        size = self._journal_size()
+        if size == self.purge_journal_offset:
+            return
+        offset = self.purge_journal_offset if size > self.purge_journal_offset else 0  # journal was rotated
+        try:
+            with open(self.purge_journal, 'r', encoding='utf-8') as f:
+                f.seek(offset)
+                lines = f.read().splitlines()
+        except OSError:
+            return
+        self.purge_journal_offset = size
+        tags = set()
+        for line in lines:
+            try:
+                tags.update(json.loads(line)['tags'])
+            except (ValueError, KeyError):
+                continue
+        if tags:
+            with self.cache_lock:
+                self._purge_l1(tags)
+    
+    def purge(self, tags: list) -> dict:
+        """Drop every entry tagged with any of tags, in all tiers and every worker's L1"""
+        tags = set(tags)
+        with self.cache_lock:
+            purged = {'l1': self._purge_l1(tags)}
+        for tier in self.tiers:
+            purged[tier.name] = tier.purge_tags(sorted(tags))
+        if self.purge_journal:
+            try:
+                with open(self.purge_journal, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps({'at': time.time(), 'tags': sorted(tags)}) + "\n")
+            except OSError as e:
+                print(f"[WARNING] Cache purge journal not writable: {e}", flush=True)
+        print(f"Cache: Purged {purged} for tags {sorted(tags)}")
+        return purged
+    
+    def list_tags(self) -> dict:
+        """Tag -> number of L1 entries, plus the tags known to each shared tier"""
+        with self.cache_lock:
+            counts = {}
+            for entry in self.cache.values():
+                for tag in entry['tags']:
+                    counts[tag] = counts.get(tag, 0) + 1
+        return {
+            'l1': counts,
+            **{tier.name: sorted(tier.list_tags()) for tier in self.tiers}
+        }
+    
+    def stale_tags(self, current_tags: list) -> list:
+        """Known tags sharing a kind ('template:', 'toolchain:') with current_tags but not current"""
+        kinds = {tag.split(':', 1)[0] + ':' for tag in current_tags}
+        known = self.list_tags()
+        candidates = set(known['l1']).union(*(set(tags) for name, tags in known.items() if name != 'l1'))
+        return sorted(
+            tag for tag in candidates
+            if tag not in current_tags and any(tag.startswith(kind) for kind in kinds)
+        )
     
     def get_stats(self) -> dict:
         """Get cache statistics"""
+        tier_stats = [tier.get_stats() for tier in self.tiers]   # may scan the L2 directory, keep outside the lock
         with self.cache_lock:
             hit_rate = (self.stats['hits'] / max(1, self.stats['total_requests'])) * 100
             
             return {
                 'entries_count': len(self.cache),
+                'negative_entries_count': sum(1 for entry in self.cache.values() if entry['failed']),
+                'max_entries': self.max_entries,
                 'size_mb': round(self.current_size_bytes / (1024 * 1024), 2),
+                'raw_size_mb': round(self.raw_size_bytes / (1024 * 1024), 2),
+                'compression_ratio': round(self.raw_size_bytes / max(1, self.current_size_bytes), 2),
                 'max_size_mb': self.max_cache_size_mb,
+                'ttl_seconds': self.ttl_seconds,
+                'negative_ttl_seconds': self.negative_ttl_seconds,
                 'hit_rate_percent': round(hit_rate, 2),
                 'total_requests': self.stats['total_requests'],
                 'hits': self.stats['hits'],
                 'misses': self.stats['misses'],
-                'evictions': self.stats['evictions']
+                'evictions': self.stats['evictions'],
+                'expirations': self.stats['expirations'],
+                'l1_hits': self.stats['l1_hits'],
+                'promotions': self.stats['promotions'],
+                'negative_hits': self.stats['negative_hits'],
+                'negative_writes': self.stats['negative_writes'],
+                'purged': self.stats['purged'],
+                'template_version': self.template_version,
+                'tier_hits': {tier.name: self.stats[f"{tier.name}_hits"] for tier in self.tiers},
+                'tiers': tier_stats
             }
     
-    def clear(self):
-        """Clear all cached entries"""
+    def clear(self, include_shared: bool = True):
+        """Clear all cached entries (and the shared tiers unless include_shared=False)"""
         with self.cache_lock:
             self.cache.clear()
             self.current_size_bytes = 0
-            print("Cache: All entries cleared")
+            self.raw_size_bytes = 0
+        if include_shared:
+            for tier in self.tiers:
+                tier.clear()
+        print("Cache: All entries cleared")
 
 # Global instances
-compilation_manager = ConcurrentCompilationManager()
-adaptive_limits = AdaptiveCompilationLimits()
-compilation_cache = CompilationCache(max_cache_size_mb=50)  # 50MB cache
+compilation_manager = ConcurrentCompilationManager(
+    max_concurrent=CompilationLimits.MAX_CONCURRENT,
+    max_per_user=CompilationLimits.MAX_PER_USER,
+    slots_dir=os.environ.get('TIKZ_SLOTS_DIR'),
+    max_queue=int(os.environ.get('TIKZ_COMPILE_QUEUE_SIZE', 0)) or None  # default 4 x slots
+)
+latex_sandbox = LaTeXSandbox(
+    nice=int(os.environ.get('TIKZ_SANDBOX_NICE', 10)),
+    ionice=os.environ.get('TIKZ_SANDBOX_IONICE', 'idle'),
+    address_space_overhead_mb=int(os.environ.get('TIKZ_RLIMIT_AS_OVERHEAD_MB', 700)),
+    cgroup_root=os.environ.get('TIKZ_CGROUP_ROOT'),  # delegated cgroup v2 dir, empty = RLIMIT_AS
+    cpu_percent=CompilationLimits.MAX_CPU_PERCENT
+)
+lualatex_warm_pool = LuaLaTeXWarmPool(
+    pool_dir=os.environ.get('TIKZ_WARM_POOL_DIR', '/tmp/tikz_warm'),
+    sandbox=latex_sandbox,
+    memory_mb=CompilationLimits.MAX_MEMORY_MB,
+    # Parked workers hold a host compile slot each and run under the adaptive memory limit
+    memory_limit=lambda: adaptive_limits.get_adaptive_limits(WARM_POOL_USER)['max_memory_mb'],
+    slots=compilation_manager.slots,
+    size=int(os.environ.get('TIKZ_WARM_POOL_SIZE', 2)),  # parked lualatex per worker process, 0 = off
+    max_idle_seconds=int(os.environ.get('TIKZ_WARM_POOL_MAX_IDLE', 300))
+)
+atexit.register(lualatex_warm_pool.shutdown)
+compile_workspaces = WorkspaceAllocator(
+    root=os.environ.get('TIKZ_WORKSPACE_ROOT') or DEFAULT_WORKSPACE_ROOT,
+    ttl_seconds=int(os.environ.get('TIKZ_WORKSPACE_TTL', 600)),
+    quota_bytes=int(os.environ.get('TIKZ_WORKSPACE_QUOTA_MB', 256)) * 1024 * 1024
+)
+system_load_sampler = SystemLoadSampler(
+    interval_seconds=float(os.environ.get('TIKZ_LOAD_SAMPLE_INTERVAL', 1.0)),
+    window_seconds=float(os.environ.get('TIKZ_LOAD_SAMPLE_WINDOW', 30)),
+    queue_stats=compilation_manager.get_stats
+)
+adaptive_limits = AdaptiveCompilationLimits(load_sampler=system_load_sampler)
+compilation_cache_tiers = [SharedFileCache(
+    root=os.environ.get('TIKZ_CACHE_L2_DIR') or DEFAULT_L2_DIR,
+    max_size_mb=int(os.environ.get('TIKZ_CACHE_L2_SIZE_MB', 256))
+)] if os.environ.get('TIKZ_CACHE_L2', '1') == '1' else []
+if os.environ.get('TIKZ_CACHE_REDIS_URL'):
+    try:
+        compilation_cache_tiers.append(RedisCache(
+            os.environ['TIKZ_CACHE_REDIS_URL'],
+            ttl_seconds=int(os.environ.get('TIKZ_CACHE_REDIS_TTL', 7 * 24 * 3600))
+        ))
+    except ImportError:
+        print("[WARNING] redis package not installed, L3 cache disabled", flush=True)
+compilation_cache = CompilationCache(
+    max_cache_size_mb=50,  # 50MB of compressed SVGs per worker
+    tiers=compilation_cache_tiers,
+    max_entries=int(os.environ.get('TIKZ_CACHE_MAX_ENTRIES', 20000)),
+    ttl_seconds=int(os.environ.get('TIKZ_CACHE_TTL', 0)) or None,
+    negative_ttl_seconds=int(os.environ.get('TIKZ_NEGATIVE_CACHE_TTL', 120)),
+    purge_journal=os.path.join(os.environ.get('TIKZ_CACHE_L2_DIR') or DEFAULT_L2_DIR, 'purges.jsonl'),
+    hot_keys=HotKeyTracker(top_k=int(os.environ.get('TIKZ_HOT_KEYS_TOP_K', 50))) if os.environ.get('TIKZ_HOT_KEYS', '1') == '1' else None
+)
+compile_singleflight = SingleFlight(
+    lock_dir=(os.environ.get('TIKZ_SINGLEFLIGHT_DIR') or DEFAULT_FLIGHT_LOCK_DIR) if os.environ.get('TIKZ_SINGLEFLIGHT_HOST', '1') == '1' else None,
+    retry_errors=(CompilationCancelled,)  # a cancelled leader does not cancel identical requests of other editors
+)
+# Live-preview sessions: a newer request from the same editor tab cancels the older compile
+compile_sessions = CompileSessions(state_dir=os.environ.get('TIKZ_SESSIONS_DIR') or DEFAULT_SESSIONS_DIR)
+engine_router = CompilationEngineRouter(enabled=os.environ.get('TIKZ_ENGINE_ROUTING', '1') == '1')
+latex_format_pool = LaTeXFormatPool(
+    format_dir=os.environ.get('TIKZ_FORMAT_DIR', '/tmp/tikz_formats'),
+    max_formats=int(os.environ.get('TIKZ_FORMAT_POOL_SIZE', 8)),  # ~20MB per .fmt
+    enabled=os.environ.get('TIKZ_FORMAT_POOL_ENABLED', '1') == '1',
+    min_uses=int(os.environ.get('TIKZ_FORMAT_POOL_MIN_USES', 3)),
+    sandbox=latex_sandbox,
+    slots=compilation_manager.slots,
+    memory_mb=CompilationLimits.MAX_MEMORY_MB
+)
+compile_daemon_client = (
+    CompileDaemonClient(os.environ['TIKZ_COMPILE_DAEMON_SOCKET'])
+    if os.environ.get('TIKZ_COMPILE_DAEMON_SOCKET') else None
+)
 
 # Setup security logger
 security_logger = logging.getLogger('tikz_security')
@@ -766,23 +1186,20 @@ def log_security_event(event_type: str, user_id: str, ip_address: str, details:
         extra={'user_id': user_id, 'ip': ip_address}
     )
 
-def log_compilation_metrics(user_id: str, compilation_time: float, memory_used: float, success: bool):
-    """Log compilation performance metrics"""
+def log_compilation_metrics(user_id: str, compilation_time: float, memory_used: float, success: bool, engine: str = "lualatex", cpu_seconds: float = 0.0):
+    """Log compilation performance metrics (memory_used = peak RSS of the LaTeX subprocesses)"""
     metrics_logger = logging.getLogger('tikz_metrics')
     metrics_logger.info(
-        f"Compilation - Time:{compilation_time:.2f}s Memory:{memory_used:.1f}MB Success:{success}",
+        f"Compilation - Engine:{engine} Time:{compilation_time:.2f}s Memory:{memory_used:.1f}MB CPU:{cpu_seconds:.2f}s Success:{success}",
         extra={'user_id': user_id}
     )
 
 @contextmanager
-def compilation_resource_monitor():
+def compilation_resource_monitor(user_id: str = "anonymous", lane: str = "interactive", cancelled=None):
     """Context manager to monitor and limit compilation resources"""
     
-    # Check concurrent limit
-    with CompilationLimits._compilation_lock:
-        if CompilationLimits._active_compilations >= CompilationLimits.MAX_CONCURRENT:
-            raise Exception(f"Too many concurrent compilations (max: {CompilationLimits.MAX_CONCURRENT})")
-        CompilationLimits._active_compilations += 1
+    # Wait for a host-wide slot (fair per user, by lane); raises CompilationQueueFull / CompilationCancelled
+    compilation_id = compilation_manager.start_compilation(user_id, lane, cancelled=cancelled)
     
     try:
         # Monitor process during compilation
@@ -795,136 +1212,547 @@ def compilation_resource_monitor():
         }
         
     finally:
-        # Always decrement counter
-        with CompilationLimits._compilation_lock:
-            CompilationLimits._active_compilations -= 1
+        # Always release the slot
+        compilation_manager.end_compilation(compilation_id)
+
+def run_latex(latex_source: str, work_dir: str, timeout_seconds: int, engine: str = "lualatex", memory_mb: int = None,
+              cancelled=None) -> subprocess.CompletedProcess:
+    """
+    Write tikz.tex and run the LaTeX engine once (sandboxed: memory/CPU limits, low priority)
+    lualatex runs on a warm worker or from a precompiled format when available
+    Returns CompletedProcess with .usage = {'peak_rss_mb', 'cpu_seconds'}
+    Raises subprocess.TimeoutExpired on timeout, CompilationCancelled once cancelled()
+    turns true (process group killed in both cases)
+    Console output is watched while the engine runs: it is stopped right after the first
+    fatal error (.stopped_early); .document_line is the \begin{document} line for l.<n> mapping
+    """
+    tex_path = os.path.join(work_dir, "tikz.tex")
+    memory_mb = memory_mb or CompilationLimits.MAX_MEMORY_MB
+    
+    def watch_output():
+        return FatalErrorWatcher().feed if LOG_EARLY_ABORT_ENABLED else None
+    
+    if engine != "lualatex":
+        with open(tex_path, "w", encoding="utf-8") as f:
+            f.write(latex_source)
+        process = latex_sandbox.run([
+            engine,
+            "-interaction=nonstopmode",
+            "-halt-on-error",
+            "--output-directory=.",
+            "tikz.tex"
+        ],
+        cwd=work_dir,
+        timeout_seconds=timeout_seconds,
+        memory_mb=memory_mb,
+        cancelled=cancelled,
+        stop_on_output=watch_output()
+        )
+        process.document_line = document_line(latex_source)
+        return process
+    
+    # Warm worker already parked at \begin{document} with this preamble
+    warm_process = lualatex_warm_pool.run(latex_source, work_dir, timeout_seconds, cancelled=cancelled,
+                                          stop_on_output=watch_output())
+    if warm_process is not None:
+        print(f"🔥 Compiled on warm lualatex worker")
+        warm_process.document_line = 1  # l.<n> counts lines of body.tex, which starts after \begin{document}
+        return warm_process
+    
+    # Precompiled preamble format (built in background on first use)
+    precompiled_format = latex_format_pool.acquire(latex_source)
+    
+    with open(tex_path, "w", encoding="utf-8") as f:
+        f.write(precompiled_format['source'] if precompiled_format else latex_source)
+    
+    lualatex_cmd = [
+        "lualatex", 
+        "-interaction=nonstopmode", 
+        "-halt-on-error",
+        "--output-directory=.", 
+        "tikz.tex"
+    ]
+    if precompiled_format:
+        print(f"⚡ Using precompiled format: {precompiled_format['format_name']}")
+        lualatex_cmd.insert(1, f"-fmt={precompiled_format['format_name']}")
+    
+    lualatex_process = latex_sandbox.run(lualatex_cmd,
+    cwd=work_dir,
+    timeout_seconds=timeout_seconds,  # ADAPTIVE TIMEOUT
+    memory_mb=memory_mb,
+    env=precompiled_format['env'] if precompiled_format else None,
+    cancelled=cancelled,
+    stop_on_output=watch_output()
+    )
+    lualatex_process.document_line = document_line(precompiled_format['source'] if precompiled_format else latex_source)
+    
+    # Broken/evicted format: drop it and compile with the full preamble
+    if (lualatex_process.returncode != 0 and precompiled_format and
+            latex_format_pool.is_format_error(lualatex_process.stdout + lualatex_process.stderr)):
+        print(f"⚠️  Format {precompiled_format['format_name']} unusable, recompiling without it")
+        latex_format_pool.discard(precompiled_format['key'])
+        with open(tex_path, "w", encoding="utf-8") as f:
+            f.write(latex_source)
+        lualatex_process = latex_sandbox.run(lualatex_cmd[:1] + lualatex_cmd[2:],
+        cwd=work_dir,
+        timeout_seconds=timeout_seconds,
+        memory_mb=memory_mb,
+        cancelled=cancelled,
+        stop_on_output=watch_output()
+        )
+        lualatex_process.document_line = document_line(latex_source)
+    
+    return lualatex_process
+
+# SVG output pipelines: PDF -> pdf2svg (default) or DVI -> dvisvgm
+SVG_PIPELINES = ('pdf2svg', 'dvisvgm')
+SVG_PIPELINE = os.environ.get('TIKZ_SVG_PIPELINE', 'pdf2svg')
+DVISVGM_FONT_MODE = os.environ.get('TIKZ_DVISVGM_FONTS', 'paths')  # 'paths' (no fonts) | 'woff2'
+DVI_ENGINES = {'pdflatex': 'latex'}
+
+def select_svg_pipeline(requested: str, engine: str) -> str:
+    """
+    SVG pipeline for this compile
+    dvisvgm only handles the pdfLaTeX route: OpenType fonts loaded by luaotfload
+    are not usable from LuaTeX DVI output, so LuaLaTeX code stays on pdf2svg
+    """
+    pipeline = requested if requested in SVG_PIPELINES else SVG_PIPELINE
+    if pipeline == 'dvisvgm' and engine not in DVI_ENGINES:
+        return 'pdf2svg'
+    return pipeline
+
+_toolchain_versions = {}
+_toolchain_lock = threading.Lock()
+
+def _binary_version(binary: str) -> str:
+    """First line of `<binary> --version`; pdf2svg has no version flag, use its path/size/mtime"""
+    path = shutil.which(binary)
+    if not path:
+        return f"{binary}:missing"
+    if binary != 'pdf2svg':
+        try:
+            result = subprocess.run([path, "--version"], capture_output=True, text=True, timeout=10)
+            first_line = (result.stdout or result.stderr or "").strip().split("\n", 1)[0]
+            if first_line:
+                return first_line
+        except (OSError, subprocess.SubprocessError):
+            pass
+    st = os.stat(path)
+    return f"{path}:{st.st_size}:{int(st.st_mtime)}"
+
+def get_toolchain_version(engine: str, svg_pipeline: str) -> str:
+    """
+    Short hash of the binaries behind one (engine, SVG pipeline) route
+    Part of the cache key and of the 'toolchain:' tag: a TeX Live or converter
+    upgrade stops serving SVGs produced by the old binaries
+    """
+    route = (engine, svg_pipeline)
+    version = _toolchain_versions.get(route)
+    if version is not None:
+        return version
+    # Normally resolved at startup; a late route runs `--version` without holding any lock
+    binaries = [DVI_ENGINES.get(engine, engine), 'dvisvgm'] if svg_pipeline == 'dvisvgm' else [engine, 'pdf2svg']
+    versions = "\n".join(_binary_version(binary) for binary in binaries)
+    with _toolchain_lock:
+        return _toolchain_versions.setdefault(route, hashlib.sha256(versions.encode('utf-8')).hexdigest()[:12])
+
+def current_version_tags() -> list:
+    """'template:' and 'toolchain:' tags of entries this deployment can still serve"""
+    tags = [f"template:{TEMPLATE_VERSION}"]
+    for engine in ('lualatex', 'pdflatex'):
+        for pipeline in SVG_PIPELINES:
+            if select_svg_pipeline(pipeline, engine) == pipeline:
+                tags.append(f"toolchain:{get_toolchain_version(engine, pipeline)}")
+    return tags
+
+def adapt_source_for_dvisvgm(latex_source: str) -> str:
+    """Switch standalone/graphics and the PGF driver to dvisvgm"""
+    return re.sub(
+        r'\\documentclass\[([^\]]*)\]\{standalone\}',
+        lambda m: f"\\documentclass[{m.group(1)},dvisvgm]{{standalone}}\n\\def\\pgfsysdriver{{pgfsys-dvisvgm.def}}",
+        latex_source,
+        count=1
+    )
+
+def run_dvisvgm(work_dir: str, font_mode: str = None, timeout_seconds: int = CompilationLimits.SVG_TIMEOUT_SECONDS, cancelled=None) -> subprocess.CompletedProcess:
+    """Convert tikz.dvi -> tikz.svg (raises CalledProcessError/TimeoutExpired/CompilationCancelled)"""
+    font_mode = font_mode or DVISVGM_FONT_MODE
+    dvisvgm_cmd = ["dvisvgm", "--bbox=papersize", "--exact-bbox", "--output=tikz.svg"]
+    if font_mode == 'woff2':
+        dvisvgm_cmd.append("--font-format=woff2")
+    else:
+        dvisvgm_cmd.append("--no-fonts")  # glyphs as paths
+    dvisvgm_cmd.append("tikz.dvi")
+    
+    return latex_sandbox.run(dvisvgm_cmd,
+    cwd=work_dir,
+    timeout_seconds=timeout_seconds,
+    memory_mb=CompilationLimits.MAX_MEMORY_MB,
+    check=True,
+    cancelled=cancelled
+    )
+
+LOG_EXCERPT_MAX_CHARS = 4000
+
+# Structural pre-check before compiling (tex_syntax); 0 = always run LaTeX
+SYNTAX_PRECHECK_ENABLED = os.environ.get('TIKZ_SYNTAX_PRECHECK', '1') == '1'
+
+# Stop the LaTeX engine as soon as the first fatal error is printed (tex_log); 0 = let it exit by itself
+LOG_EARLY_ABORT_ENABLED = os.environ.get('TIKZ_LOG_EARLY_ABORT', '1') == '1'
+
+def latex_log_excerpt(work_dir: str, fallback: str = "", max_chars: int = LOG_EXCERPT_MAX_CHARS) -> str:
+    """
+    Short excerpt of tikz.log for failed compiles: '!' error lines with the two
+    lines after them (l.<n> context), otherwise the tail of the log
+    Only the last 64KB of the log are read
+    """
+    log_path = os.path.join(work_dir, "tikz.log")
+    try:
+        with open(log_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 64 * 1024))
+            log_text = f.read().decode('utf-8', errors='replace')
+    except OSError:
+        log_text = fallback
+    
+    lines = log_text.splitlines()
+    excerpt = []
+    for index, line in enumerate(lines):
+        if line.startswith("!"):
+            excerpt.extend(lines[index:index + 3])
+    text = "\n".join(excerpt) if excerpt else log_text
+    return text[:max_chars] if excerpt else text[-max_chars:]
+
+def cached_failure_result(failure: dict, work_dir: str, tikz_code: str) -> tuple[bool, str, str]:
+    """
+    Replay a negative cache entry: restore tikz.log (the excerpt) and tikz.error.json for callers that display them
+    The entry is shared by codes that differ only in comments/blank lines: the error's line is found again in tikz_code
+    """
+    if failure.get('error_identity'):
+        excerpt = relocate_error_excerpt(failure['error_identity'], tikz_code)
+        save_error_excerpt(work_dir, excerpt)
+        error_message = failure['message_prefix'] + format_error_excerpt(excerpt)
+    else:
+        error_message = failure['error_message']
+    log_path = os.path.join(work_dir, "tikz.log")
+    if failure.get('log_excerpt') and not os.path.exists(log_path):
+        try:
+            with open(log_path, 'w', encoding='utf-8') as f:
+                f.write(failure['log_excerpt'])
+        except OSError:
+            pass
+    return False, "", error_message
 
-def compile_tikz_enhanced_whitelist(tikz_code: str, work_dir: str, user_id: str = "anonymous") -> tuple[bool, str, str]:
+def compile_tikz_enhanced_whitelist(tikz_code: str, work_dir: str, user_id: str = "anonymous", svg_pipeline: str = None, lane: str = "interactive",
+                                    session_id: str = None, session_token: str = None) -> tuple[bool, str, str]:
     """
     Enhanced TikZ compilation with caching, adaptive limits, and security
+    svg_pipeline: 'pdf2svg' | 'dvisvgm' (None = TIKZ_SVG_PIPELINE default)
+    lane: scheduler lane 'interactive' | 'save' | 'batch'
+    session_id: editor session; a newer request of the same session (or POST
+    /api/compile/cancel) cancels this compile. session_token comes from
+    compile_sessions.begin() when the caller registered the request earlier
+    (e.g. at job submit time); otherwise it is registered here
     Returns: (success, svg_content, error_message)
+    Raises CompilationQueueFull when no compile slot is available (-> 503 + Retry-After)
+    Raises CompilationCancelled when superseded (LaTeX process group already killed)
     """
     
+    cancelled = None
+    was_cancelled = False
+    if valid_session_id(session_id):
+        session_token = session_token or compile_sessions.begin(user_id, session_id)
+        cancelled = compile_sessions.cancelled_check(user_id, session_id, session_token)
+    
     try:
-        with compilation_resource_monitor() as monitor:
+        # 1. Pattern Security Check
+        security_check_result = LaTeXSecurityValidator.validate_tikz_security(tikz_code)
+        if not security_check_result['safe']:
+            return False, "", f"Security validation failed: {security_check_result['reason']}"
             
-            # 1. Pattern Security Check
-            security_check_result = LaTeXSecurityValidator.validate_tikz_security(tikz_code)
-            if not security_check_result['safe']:
-                return False, "", f"Security validation failed: {security_check_result['reason']}"
+        # 2. Generate LaTeX (existing whitelist logic)
+        extra_packages, extra_tikz_libs, extra_pgfplots_libs = detect_required_packages(tikz_code)
+        preamble_strategy = PREAMBLE_STRATEGY
             
-            # 2. Generate LaTeX (existing whitelist logic)
-            extra_packages, extra_tikz_libs, extra_pgfplots_libs = detect_required_packages(tikz_code)
+        try:
+            # Validate whitelist (raises ValueError)
+            generate_latex_source(
+                tikz_code=tikz_code,
+                extra_packages=extra_packages,
+                extra_tikz_libs=extra_tikz_libs,
+                extra_pgfplots_libs=extra_pgfplots_libs
+            )
+        except ValueError as e:
+            # Package not in whitelist - use basic template
+            print(f"[WARN] Package not allowed: {e}")
+            extra_packages, extra_tikz_libs, extra_pgfplots_libs = [], [], []
+            preamble_strategy = 'full'
+        
+        # 2b. Structural pre-check: unbalanced braces, \begin/\end mismatches, unterminated math, ...
+        # fail here in milliseconds instead of in a LaTeX run
+        if SYNTAX_PRECHECK_ENABLED:
+            syntax_errors = check_tex_syntax(tikz_code, extra_packages, extra_tikz_libs, extra_pgfplots_libs)
+            if syntax_errors:
+                try:
+                    with open(os.path.join(work_dir, "tikz.log"), 'w', encoding='utf-8') as f:
+                        f.write(format_syntax_errors(tikz_code, syntax_errors))
+                except OSError:
+                    pass
+                first = syntax_errors[0]
+                save_error_excerpt(work_dir, make_error_excerpt(
+                    first['message'], tikz_code, line=first['line'], column=first['column'],
+                    context=format_syntax_errors(tikz_code, syntax_errors[:1]).splitlines()[1:3]
+                ))
+                print(f"⛔ Syntax pre-check: {len(syntax_errors)} error(s), skipping compilation")
+                return False, "", syntax_error_summary(syntax_errors)
             
-            try:
-                latex_source = generate_latex_source(
-                    tikz_code=tikz_code,
-                    extra_packages=extra_packages,
-                    extra_tikz_libs=extra_tikz_libs,
-                    extra_pgfplots_libs=extra_pgfplots_libs
-                )
-            except ValueError as e:
-                # Package not in whitelist - use basic template
-                print(f"[WARN] Package not allowed: {e}")
-                latex_source = TEX_TEMPLATE.replace("{tikz_code}", tikz_code)
-                extra_packages, extra_tikz_libs, extra_pgfplots_libs = [], [], []
+        # Engine routing: pdfLaTeX unless the code needs LuaLaTeX features
+        engine_route = engine_router.route(tikz_code, extra_packages, extra_tikz_libs)
+        compile_engine = engine_route['engine']
+        requested_pipeline = svg_pipeline
+        svg_pipeline = select_svg_pipeline(requested_pipeline, compile_engine)
             
-            # 3. Check cache for existing compilation
-            cache_result = compilation_cache.get(
+        # 3. Check cache for existing compilation
+        cache_result = compilation_cache.get(
+            tikz_code=tikz_code,
+            packages=extra_packages,
+            tikz_libs=extra_tikz_libs,
+            pgfplots_libs=extra_pgfplots_libs,
+            engine=compile_engine,
+            svg_pipeline=svg_pipeline
+        )
+            
+        if cache_result['found'] and cache_result['failed']:
+            print(f"⛔ Negative cache HIT ({cache_result['failure']['category']}), skipping compilation")
+            return cached_failure_result(cache_result['failure'], work_dir, tikz_code)
+        
+        if cache_result['found']:
+            print(f"✅ Cache HIT! Returning cached result (hit #{cache_result['hit_count']})")
+            return True, cache_result['svg_content'], ""
+        
+        def fallback_cache_hit() -> Optional[str]:
+            # SVGs are cached under the engine/pipeline that produced them: a pdfLaTeX route that fell back
+            # to LuaLaTeX earlier finds its result under the lualatex key
+            if compile_engine == 'lualatex':
+                return None
+            fallback = compilation_cache.get(
                 tikz_code=tikz_code,
                 packages=extra_packages,
                 tikz_libs=extra_tikz_libs,
-                pgfplots_libs=extra_pgfplots_libs
+                pgfplots_libs=extra_pgfplots_libs,
+                engine='lualatex',
+                svg_pipeline=select_svg_pipeline(requested_pipeline, 'lualatex'),
+                probe=True
             )
+            if fallback['found'] and not fallback['failed']:
+                return fallback['svg_content']
+            return None
+        
+        fallback_svg = fallback_cache_hit()
+        if fallback_svg is not None:
+            print("✅ Cache HIT (lualatex fallback result)")
+            return True, fallback_svg, ""
+        
+        def cache_failure(error_message: str, log_fallback: str = "", error_excerpt: dict = None) -> tuple[bool, str, str]:
+            # Deterministic failures (LaTeX errors, timeouts) are cached briefly under the same key
+            classification = CompilationErrorClassifier.classify_error(error_message, tikz_code)
+            failure = {
+                'error_message': error_message,
+                'category': classification['category'],
+                'classification': classification,
+                'log_excerpt': latex_log_excerpt(work_dir, fallback=log_fallback)
+            }
+            if error_excerpt:
+                save_error_excerpt(work_dir, error_excerpt)
+                # Lines and source text belong to this submission: keep the error, not its position
+                formatted = format_error_excerpt(error_excerpt)
+                if error_message.endswith(formatted):
+                    failure['message_prefix'] = error_message[:-len(formatted)]
+                    failure['error_message'] = failure['message_prefix'] + error_excerpt['message']
+                    failure['error_identity'] = error_identity(error_excerpt, tikz_code)
+            compilation_cache.set_failure(
+                tikz_code=tikz_code,
+                failure=failure,
+                packages=extra_packages,
+                tikz_libs=extra_tikz_libs,
+                pgfplots_libs=extra_pgfplots_libs,
+                engine=compile_engine,
+                svg_pipeline=svg_pipeline
+            )
+            return False, "", error_message
+        
+        # Single-flight: identical concurrent requests (same cache key) share one compile
+        def compile_uncached() -> tuple[bool, str, str]:
+            print(f"⚪ Cache MISS. Proceeding with compilation...")
+            strategy = preamble_strategy
+            with compilation_resource_monitor(user_id, lane, cancelled=cancelled) as monitor:
             
-            if cache_result['found']:
-                print(f"✅ Cache HIT! Returning cached result (hit #{cache_result['hit_count']})")
-                return True, cache_result['svg_content'], ""
+                # 4. Get adaptive resource limits
+                limits = adaptive_limits.get_adaptive_limits(user_id)
+                timeout_seconds = limits['timeout_seconds']
+                memory_limit_mb = limits['max_memory_mb']
             
-            print(f"⚪ Cache MISS. Proceeding with compilation...")
+                print(f"🚀 Starting enhanced compilation with adaptive limits:")
+                print(f"   User: {user_id} (tier: {limits['user_tier']})")
+                print(f"   System load: {limits['system_load']}")
+                print(f"   Timeout: {timeout_seconds}s, memory: {memory_limit_mb}MB (multiplier: {limits['multiplier_applied']:.2f})")
+                print(f"   Engine: {compile_engine} ({engine_route['reason']}), preamble: {strategy}, SVG: {svg_pipeline}")
             
-            # 4. Get adaptive resource limits
-            limits = adaptive_limits.get_adaptive_limits(user_id)
-            timeout_seconds = limits['timeout_seconds']
+                # 5. Output paths (tikz.tex is written by run_latex)
+                pdf_path = os.path.join(work_dir, "tikz.pdf")
+                svg_path = os.path.join(work_dir, "tikz.svg")
             
-            print(f"🚀 Starting enhanced compilation with adaptive limits:")
-            print(f"   User: {user_id} (tier: {limits['user_tier']})")
-            print(f"   System load: {limits['system_load']}")
-            print(f"   Timeout: {timeout_seconds}s (multiplier: {limits['multiplier_applied']:.2f})")
+                # Peak RSS / CPU time over every subprocess of this compile (fallbacks included)
+                resource_usage = {'peak_rss_mb': 0.0, 'cpu_seconds': 0.0}
             
-            # 5. Write TEX file
-            tex_path = os.path.join(work_dir, "tikz.tex")
-            pdf_path = os.path.join(work_dir, "tikz.pdf")
-            svg_path = os.path.join(work_dir, "tikz.svg")
+                def record_usage(process: subprocess.CompletedProcess):
+                    usage = getattr(process, 'usage', None) or {}
+                    resource_usage['peak_rss_mb'] = max(resource_usage['peak_rss_mb'], usage.get('peak_rss_mb', 0.0))
+                    resource_usage['cpu_seconds'] += usage.get('cpu_seconds', 0.0)
             
-            with open(tex_path, "w", encoding="utf-8") as f:
-                f.write(latex_source)
+                def compile_with(engine: str, strategy: str) -> subprocess.CompletedProcess:
+                    latex_source = build_compile_source(
+                        tikz_code, extra_packages, extra_tikz_libs, extra_pgfplots_libs,
+                        engine=engine, strategy=strategy
+                    )
+                    if select_svg_pipeline(requested_pipeline, engine) == 'dvisvgm':
+                        process = run_latex(adapt_source_for_dvisvgm(latex_source), work_dir, timeout_seconds,
+                                            engine=DVI_ENGINES[engine], memory_mb=memory_limit_mb, cancelled=cancelled)
+                    else:
+                        process = run_latex(latex_source, work_dir, timeout_seconds, engine=engine, memory_mb=memory_limit_mb,
+                                            cancelled=cancelled)
+                    record_usage(process)
+                    if getattr(process, 'stopped_early', False):
+                        print(f"✋ Stopped {engine} at the first fatal error")
+                        write_console_log(work_dir, process.stdout)
+                    return process
             
-            # 6. Enhanced compilation with adaptive limits
-            try:
-                # Run with adaptive timeout and resource monitoring
-                lualatex_process = subprocess.run([
-                    "lualatex", 
-                    "-interaction=nonstopmode", 
-                    "-halt-on-error",
-                    "--output-directory=.", 
-                    "tikz.tex"
-                ],
-                cwd=work_dir,
-                capture_output=True,
-                text=True,
-                timeout=timeout_seconds  # ADAPTIVE TIMEOUT
-                )
+                # 6. Enhanced compilation with adaptive limits
+                used_engine = compile_engine
+                try:
+                    # Run with adaptive timeout and resource monitoring
+                    lualatex_process = compile_with(used_engine, strategy)
                 
-                # Check if process succeeded
-                if lualatex_process.returncode != 0:
-                    error_output = lualatex_process.stderr or lualatex_process.stdout
-                    return False, "", f"LaTeX compilation failed: {error_output}"
+                    # Minimal preamble missed a package/library: retry with the full template
+                    if (lualatex_process.returncode != 0 and strategy == 'minimal' and
+                            needs_full_preamble(lualatex_process.stdout + lualatex_process.stderr)):
+                        print(f"↩️  Minimal preamble incomplete, retrying with full template")
+                        strategy = 'full'
+                        lualatex_process = compile_with(used_engine, strategy)
                 
-                # 7. Convert to SVG with timeout
-                subprocess.run([
-                    "pdf2svg", pdf_path, svg_path
-                ], 
-                cwd=work_dir, 
-                check=True, 
-                timeout=15,  # PDF2SVG timeout
-                stdout=subprocess.DEVNULL, 
-                stderr=subprocess.DEVNULL
-                )
+                    # Fast engine failed: retry with LuaLaTeX, unless the error would repeat on any engine
+                    if (lualatex_process.returncode != 0 and used_engine != 'lualatex' and
+                            engine_router.fallback_may_help(lualatex_process.stdout, full_preamble=strategy == 'full')):
+                        print(f"↩️  {used_engine} failed, retrying with lualatex")
+                        engine_router.record_result(used_engine, success=False, fallback=True)
+                        used_engine = 'lualatex'
+                        lualatex_process = compile_with(used_engine, strategy)
+                
+                    # Check if process succeeded
+                    if lualatex_process.returncode != 0:
+                        # First fatal error with its line in the user's code, not the whole console output
+                        error_excerpt = latex_error_excerpt(lualatex_process.stdout, tikz_code,
+                                                            getattr(lualatex_process, 'document_line', None),
+                                                            stopped_early=getattr(lualatex_process, 'stopped_early', False))
+                        if error_excerpt:
+                            error_output = format_error_excerpt(error_excerpt)
+                        else:
+                            error_output = (lualatex_process.stderr or lualatex_process.stdout)[-LOG_EXCERPT_MAX_CHARS:]
+                        log_compilation_metrics(user_id, time.time() - monitor['start_time'], resource_usage['peak_rss_mb'], False,
+                                                engine=used_engine, cpu_seconds=resource_usage['cpu_seconds'])
+                        failure = cache_failure(f"LaTeX compilation failed: {error_output}", log_fallback=error_output,
+                                                error_excerpt=error_excerpt)
+                        compile_workspaces.prune(work_dir, keep=KEEP_AFTER_FAILURE)
+                        return failure
                 
-                # 8. Read SVG result
-                if os.path.exists(svg_path):
-                    with open(svg_path, 'r', encoding='utf-8') as f:
-                        svg_content = f.read()
+                    # 7. Convert to SVG with timeout (the fallback engine may need another pipeline)
+                    used_pipeline = select_svg_pipeline(requested_pipeline, used_engine)
+                    if used_pipeline == 'dvisvgm':
+                        record_usage(run_dvisvgm(work_dir, cancelled=cancelled))
+                    else:
+                        record_usage(latex_sandbox.run([
+                            "pdf2svg", pdf_path, svg_path
+                        ], 
+                        cwd=work_dir, 
+                        timeout_seconds=CompilationLimits.SVG_TIMEOUT_SECONDS,
+                        memory_mb=memory_limit_mb,
+                        check=True,
+                        cancelled=cancelled
+                        ))
+                
+                    # 8. Read SVG result
+                    if os.path.exists(svg_path):
+                        with open(svg_path, 'r', encoding='utf-8') as f:
+                            svg_content = f.read()
+                        compile_workspaces.prune(work_dir)  # .aux/.log/.pdf/.dvi are not needed any more
                     
-                    # Check SVG size limit
-                    if len(svg_content) > 5 * 1024 * 1024:  # 5MB limit
-                        return False, "", "Generated SVG too large (>5MB)"
+                        # Check SVG size limit
+                        if len(svg_content) > 5 * 1024 * 1024:  # 5MB limit
+                            return False, "", "Generated SVG too large (>5MB)"
                     
-                    # 9. Cache successful compilation
-                    compilation_cache.set(
-                        tikz_code=tikz_code,
-                        svg_content=svg_content,
-                        packages=extra_packages,
-                        tikz_libs=extra_tikz_libs,
-                        pgfplots_libs=extra_pgfplots_libs
-                    )
+                        # 9. Cache successful compilation under the engine/pipeline that produced this SVG
+                        compilation_cache.set(
+                            tikz_code=tikz_code,
+                            svg_content=svg_content,
+                            packages=extra_packages,
+                            tikz_libs=extra_tikz_libs,
+                            pgfplots_libs=extra_pgfplots_libs,
+                            engine=used_engine,
+                            svg_pipeline=used_pipeline
+                        )
                     
-                    compilation_time = time.time() - monitor['start_time']
-                    print(f"✅ Enhanced compilation successful in {compilation_time:.2f}s (cached for future)")
+                        compilation_time = time.time() - monitor['start_time']
+                        engine_router.record_result(used_engine, success=True)
+                        log_compilation_metrics(user_id, compilation_time, resource_usage['peak_rss_mb'], True,
+                                                engine=used_engine, cpu_seconds=resource_usage['cpu_seconds'])
+                        print(f"✅ Enhanced compilation successful in {compilation_time:.2f}s with {used_engine} (cached for future)")
                     
-                    return True, svg_content, ""
-                else:
-                    return False, "", "SVG file not generated"
+                        return True, svg_content, ""
+                    else:
+                        return False, "", "SVG file not generated"
                     
-            except subprocess.TimeoutExpired:
-                return False, "", f"Compilation timeout ({timeout_seconds}s adaptive limit)"
+                except subprocess.TimeoutExpired:
+                    log_compilation_metrics(user_id, time.time() - monitor['start_time'], resource_usage['peak_rss_mb'], False,
+                                            engine=used_engine, cpu_seconds=resource_usage['cpu_seconds'])
+                    return cache_failure(f"Compilation timeout ({timeout_seconds}s adaptive limit)")
                 
-            except Exception as e:
-                return False, "", f"Compilation error: {str(e)}"
-    
+                except CompilationCancelled:
+                    # Not a property of the code: no negative caching, no failure metrics
+                    raise
+                
+                except Exception as e:
+                    return False, "", f"Compilation error: {str(e)}"
+        
+        def recheck_cache():
+            # Another worker compiled this key while we waited: its result is in the shared tiers
+            shared = compilation_cache.get(
+                tikz_code=tikz_code,
+                packages=extra_packages,
+                tikz_libs=extra_tikz_libs,
+                pgfplots_libs=extra_pgfplots_libs,
+                engine=compile_engine,
+                svg_pipeline=svg_pipeline
+            )
+            if not shared['found']:
+                fallback_svg = fallback_cache_hit()
+                return (True, fallback_svg, "") if fallback_svg is not None else None
+            if shared['failed']:
+                return cached_failure_result(shared['failure'], work_dir, tikz_code)
+            return True, shared['svg_content'], ""
+        
+        return compile_singleflight.run(cache_result['cache_key'], compile_uncached, recheck=recheck_cache)
+    
+    except CompilationQueueFull:
+        raise
+    except CompilationCancelled:
+        was_cancelled = True
+        print(f"🛑 Compilation cancelled: superseded in session {session_id}")
+        raise
     except Exception as e:
         return False, "", f"Resource limit error: {str(e)}"
+    finally:
+        if cancelled is not None:
+            compile_sessions.end(user_id, session_id, session_token, cancelled=was_cancelled)
 
 # =================================================================
 # ✅ USER CLASS
@@ -970,33 +1798,8 @@ def load_user(user_id):
         print(f"Error loading user: {e}", flush=True)
         return None
 
-# Cleanup thread
-import threading
-import time
-
-def cleanup_tmp_folder():
-    while True:
-        try:
-            now = time.time()
-            tmp_root = '/tmp'
-            for folder in os.listdir(tmp_root):
-                folder_path = os.path.join(tmp_root, folder)
-                if os.path.isdir(folder_path):
-                    if len(folder) >= 30 and '-' in folder:
-                        mtime = os.path.getmtime(folder_path)
-                        if now - mtime > 600:  # hơn 10 phút
-                            print(f"[CLEANUP] Removing old tmp folder: {folder_path}", flush=True)
-                            try:
-                                import shutil
-                                shutil.rmtree(folder_path)
-                            except Exception as e:
-                                print(f"[CLEANUP] Error removing {folder_path}: {e}", flush=True)
-        except Exception as e:
-            print(f"[CLEANUP] Error in cleanup: {e}", flush=True)
-        time.sleep(300)  # Chạy mỗi 5 phút
-
-cleanup_thread = threading.Thread(target=cleanup_tmp_folder, daemon=True)
-cleanup_thread.start()
+# Workspace cleanup: compile_workspaces (expiry heap + quota) replaces the old /tmp scan
+compile_workspaces.ensure_started()
 
 # Session config
 app.config.update(
@@ -1148,6 +1951,14 @@ TEX_TEMPLATE = r"""
 \end{document}
 """
 
+# 2b) Template cho pdfLaTeX (không có fontspec), giữ đồng bộ với TEX_TEMPLATE
+# T1 + lmodern: Latin Modern dạng vector như mặc định của fontspec, không dùng font EC bitmap,
+# SVG từ pdflatex và lualatex trông giống nhau
+TEX_TEMPLATE_PDFLATEX = TEX_TEMPLATE.replace(
+    r"\usepackage{fontspec}",
+    r"\usepackage[T1]{fontenc}" "\n" r"\usepackage{lmodern}"
+)
+
 # 3) Hàm tạo nguồn LaTeX, chèn động \usepackage / \usetikzlibrary / \usepgfplotslibrary
 def generate_latex_source(
     tikz_code: str,
@@ -1200,6 +2011,227 @@ def generate_latex_source(
         full = base_template
     return full.replace("{tikz_code}", cleaned_tikz_code)
 
+# 3b) Template tối thiểu: chỉ lõi nhỏ, phần còn lại do build_preamble_profile chèn vào
+# Font giống TEX_TEMPLATE/TEX_TEMPLATE_PDFLATEX theo engine: SVG của minimal và full trông như nhau
+TEX_TEMPLATE_MINIMAL = r"""
+\documentclass[12pt,border=10pt]{standalone}
+
+% Lõi tối thiểu
+\usepackage{fontspec}
+\usepackage{amsmath,amssymb,amsfonts}
+\usepackage{tikz}
+
+% ==== EXTRA AUTO-INJECT START ====
+% (Sẽ được chèn thêm ở đây)
+% ==== EXTRA AUTO-INJECT END ====
+
+\begin{document}
+{tikz_code}
+\end{document}
+"""
+
+TEX_TEMPLATE_MINIMAL_PDFLATEX = TEX_TEMPLATE_MINIMAL.replace(
+    r"\usepackage{fontspec}",
+    r"\usepackage[T1]{fontenc}" "\n" r"\usepackage{lmodern}"
+)
+
+# 'minimal' = TEX_TEMPLATE_MINIMAL + profile, 'full' = TEX_TEMPLATE luôn
+# Mặc định 'full': preamble chung cho mọi hình nên format pool (.fmt) dùng lại được
+PREAMBLE_STRATEGY = os.environ.get('TIKZ_PREAMBLE_STRATEGY', 'full')
+
+# Gói nặng của TEX_TEMPLATE -> các dấu hiệu sử dụng trong code
+PREAMBLE_PROFILE_PACKAGES = {
+    "fontspec": ["\\setmainfont", "\\setsansfont", "\\setmonofont", "\\fontspec", "\\newfontfamily", "\\addfontfeature"],
+    "graphicx": ["\\includegraphics", "\\rotatebox", "\\scalebox", "\\resizebox", "\\reflectbox"],
+    "pgfplots": ["\\begin{axis}", "axis}", "\\addplot", "\\pgfplotsset", "\\begin{groupplot}", "\\pgfplots"],
+    "tikz-3dplot": ["\\tdplot"],
+    "tkz-euclide": ["\\tkzDef", "\\tkzDraw", "\\tkzLabel", "\\tkzMark", "\\tkzGetPoint", "\\tkzInit", "\\tkzClip",
+                    "\\tkzFill", "\\tkzInterL", "\\tkzInterC", "\\tkzCalc", "\\tkzPicAngle", "\\tkzText",
+                    "\\tkzAuto", "\\tkzFind", "\\tkzGet", "\\tkzShow", "\\tkzSet", "\\tkzProtract", "\\tkzDuplicate"],
+    "tkz-tab": ["\\tkzTab"],
+}
+
+# Thư viện TikZ mặc định của TEX_TEMPLATE -> các dấu hiệu sử dụng
+PREAMBLE_PROFILE_TIKZ_LIBS = {
+    "calc": ["($", "\\tikz@cc", "let \\p", "let\\p"],
+    "math": ["\\tikzmath"],
+    "positioning": ["=of ", "= of ", "above=", "below=", "left=", "right=", "node distance"],
+    "arrows.meta": ["Stealth", "Latex[", "Latex]", "Triangle[", "{Latex", "{Stealth", "-{", ">={", "Straight Barb", "Kite"],
+    "intersections": ["name path", "name intersections"],
+    "angles": ["{angle", "{ angle", "{right angle", "{ right angle"],
+    "quotes": ['["', '[ "', ', "', ',"'],
+    "decorations.markings": ["decorat", "mark=at position", "markings"],
+    "decorations.pathreplacing": ["decorat", "brace"],
+    "decorations.text": ["text along path"],
+    "patterns": ["pattern"],
+    "patterns.meta": ["pattern={", "pattern = {"],
+    "shadings": ["shade", "shading"],
+    "hobby": ["hobby", "use Hobby"],
+    "spy": ["\\spy", "spy using"],
+    "backgrounds": ["background", "framed", "gridded", "show background"],
+}
+
+# pgfplots libs mặc định của TEX_TEMPLATE
+PREAMBLE_PROFILE_PGFPLOTS_LIBS = {
+    "polar": ["polaraxis"],
+}
+
+# Lỗi cho thấy preamble tối thiểu thiếu gói/thư viện -> biên dịch lại với TEX_TEMPLATE
+MINIMAL_PREAMBLE_FALLBACK_PATTERNS = [
+    r'Undefined control sequence',
+    r'Environment \S+ undefined',
+    r'I do not know the key',
+    r'Unknown arrow tip kind',
+    r"I do not know the shape",
+    r'Unknown pattern',
+]
+
+def build_preamble_profile(
+    tikz_code: str,
+    extra_packages: Iterable = (),
+    extra_tikz_libs: Iterable[str] = (),
+    extra_pgfplots_libs: Iterable[str] = (),
+) -> dict:
+    """
+    Preamble profile tối thiểu cho một hình: các gói/thư viện do detect_required_packages
+    tìm thấy + các phần của TEX_TEMPLATE mà code thực sự dùng.
+    Returns: {'packages': [...], 'tikz_libs': [...], 'pgfplots_libs': [...]}
+    """
+    packages = []
+    for name, triggers in PREAMBLE_PROFILE_PACKAGES.items():
+        if any(t in tikz_code for t in triggers):
+            packages.append({'name': name, 'options': ''})
+    
+    # Gói phát hiện/thủ công giữ nguyên options, không trùng lặp
+    known = {p['name'] for p in packages}
+    for pkg in extra_packages or []:
+        pkg_name = pkg.get('name', '') if isinstance(pkg, dict) else str(pkg)
+        if pkg_name and pkg_name not in known:
+            packages.append(pkg if isinstance(pkg, dict) else {'name': pkg_name, 'options': ''})
+            known.add(pkg_name)
+    
+    tikz_libs = [lib for lib, triggers in PREAMBLE_PROFILE_TIKZ_LIBS.items() if any(t in tikz_code for t in triggers)]
+    pgfplots_libs = [lib for lib, triggers in PREAMBLE_PROFILE_PGFPLOTS_LIBS.items() if any(t in tikz_code for t in triggers)]
+    
+    return {
+        'packages': packages,
+        'tikz_libs': list(dict.fromkeys(tikz_libs + list(extra_tikz_libs or []))),
+        'pgfplots_libs': list(dict.fromkeys(pgfplots_libs + list(extra_pgfplots_libs or []))),
+    }
+
+def generate_minimal_latex_source(
+    tikz_code: str,
+    extra_packages: Iterable = (),
+    extra_tikz_libs: Iterable[str] = (),
+    extra_pgfplots_libs: Iterable[str] = (),
+    engine: str = "lualatex",
+) -> str:
+    """Nguồn LaTeX dùng TEX_TEMPLATE_MINIMAL (font theo engine) + preamble profile của hình"""
+    profile = build_preamble_profile(tikz_code, extra_packages, extra_tikz_libs, extra_pgfplots_libs)
+    
+    # fontspec (lualatex) / fontenc + lmodern (pdflatex) đã nằm trong template
+    packages = [p for p in profile['packages'] if p['name'] != 'fontspec']
+    source = generate_latex_source(
+        tikz_code=tikz_code,
+        extra_packages=packages,
+        extra_tikz_libs=profile['tikz_libs'],
+        extra_pgfplots_libs=profile['pgfplots_libs'],
+        base_template=TEX_TEMPLATE_MINIMAL_PDFLATEX if engine == 'pdflatex' else TEX_TEMPLATE_MINIMAL
+    )
+    
+    if any(p['name'] == 'pgfplots' for p in packages):
+        source = source.replace(
+            "% ==== EXTRA AUTO-INJECT END ====",
+            "\\pgfplotsset{compat=1.17}\n% ==== EXTRA AUTO-INJECT END ====",
+            1
+        )
+    return source
+
+def build_compile_source(
+    tikz_code: str,
+    extra_packages: Iterable = (),
+    extra_tikz_libs: Iterable[str] = (),
+    extra_pgfplots_libs: Iterable[str] = (),
+    engine: str = "lualatex",
+    strategy: str = "full",
+) -> str:
+    """Nguồn LaTeX cho một engine (lualatex/pdflatex) và chiến lược preamble (minimal/full)"""
+    if strategy == 'minimal':
+        return generate_minimal_latex_source(tikz_code, extra_packages, extra_tikz_libs, extra_pgfplots_libs, engine=engine)
+    return generate_latex_source(
+        tikz_code=tikz_code,
+        extra_packages=extra_packages,
+        extra_tikz_libs=extra_tikz_libs,
+        extra_pgfplots_libs=extra_pgfplots_libs,
+        base_template=TEX_TEMPLATE_PDFLATEX if engine == 'pdflatex' else TEX_TEMPLATE
+    )
+
+def needs_full_preamble(latex_output: str) -> bool:
+    """Lỗi biên dịch có phải do preamble tối thiểu thiếu định nghĩa không (xét lỗi '!' đầu tiên)"""
+    error = first_fatal_error(latex_output)
+    text = error['message'] if error else (latex_output or "")
+    return any(re.search(pattern, text) for pattern in MINIMAL_PREAMBLE_FALLBACK_PATTERNS)
+
+# Phiên bản template: sửa template/profile preamble -> khoá cache mới, SVG cũ không bị dùng lại
+TEMPLATE_VERSION = hashlib.sha256(json.dumps([
+    TEX_TEMPLATE, TEX_TEMPLATE_PDFLATEX, TEX_TEMPLATE_MINIMAL, TEX_TEMPLATE_MINIMAL_PDFLATEX, PREAMBLE_STRATEGY,
+    PREAMBLE_PROFILE_PACKAGES, PREAMBLE_PROFILE_TIKZ_LIBS, PREAMBLE_PROFILE_PGFPLOTS_LIBS
+], sort_keys=True).encode('utf-8')).hexdigest()[:12]
+compilation_cache.template_version = TEMPLATE_VERSION
+# Resolve every route's toolchain version now (once, before gunicorn forks the workers):
+# cache lookups never wait on `--version` subprocesses
+current_version_tags()
+
+def _package_rules_connection():
+    return mysql.connector.connect(
+        host=os.environ.get('DB_HOST', 'localhost'),
+        user=os.environ.get('DB_USER', 'hiep1987'),
+        password=os.environ.get('DB_PASSWORD', ''),
+        database=os.environ.get('DB_NAME', 'tikz2svg')
+    )
+
+def fetch_package_rules_signature() -> tuple:
+    """Row counts + last update of the tables the detection rules come from"""
+    conn = _package_rules_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT (SELECT COUNT(*) FROM supported_packages),
+                   (SELECT MAX(updated_at) FROM supported_packages),
+                   (SELECT COUNT(*) FROM package_detection_rules),
+                   (SELECT MAX(updated_at) FROM package_detection_rules)
+        """)
+        signature = tuple(cursor.fetchone())
+        cursor.close()
+        return signature
+    finally:
+        conn.close()
+
+def fetch_package_detection_rules() -> list:
+    """Active DB triggers whose target is a supported package: [(trigger, kind, target)]"""
+    conn = _package_rules_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT r.trigger_text, r.target_type, r.target_name
+            FROM package_detection_rules r
+            JOIN supported_packages sp ON sp.package_name = r.target_name
+            WHERE r.is_active = 1
+            ORDER BY r.id
+        """)
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+    finally:
+        conn.close()
+
+package_detector = PackageDetector(
+    load_rules=fetch_package_detection_rules,
+    rules_signature=fetch_package_rules_signature,
+    allowed={'package': SAFE_PACKAGES, 'tikz_lib': SAFE_TIKZ_LIBS, 'pgfplots_lib': SAFE_PGFPLOTS_LIBS},
+    refresh_seconds=float(os.environ.get('TIKZ_PACKAGE_RULES_REFRESH', 60)),
+)
+
 # 4) Hàm helper để tự động phát hiện packages cần thiết từ TikZ code
 def detect_required_packages(tikz_code: str) -> tuple[list[str], list[str], list[str]]:
     """
@@ -1207,8 +2239,6 @@ def detect_required_packages(tikz_code: str) -> tuple[list[str], list[str], list
     Hỗ trợ cú pháp thủ công: %!<...> để chỉ định packages
     Returns: (packages, tikz_libs, pgfplots_libs)
     """
-    code_lower = tikz_code.lower()
-    
     # Phát hiện packages từ cú pháp thủ công %!<...>
     manual_packages = []
     manual_tikz_libs = []
@@ -1248,182 +2278,8 @@ def detect_required_packages(tikz_code: str) -> tuple[list[str], list[str], list
                         lib_name = lib_match.group(1).strip()
                         manual_pgfplots_libs.append(lib_name)
     
-    # Phát hiện packages tự động
-    packages = []
-    
-    # siunitx - cho đơn vị đo lường
-    if any(cmd in tikz_code for cmd in ["\\si{", "\\SI{", "\\num{", "\\ang{", "\\unit{"]):
-        packages.append("siunitx")
-    
-    # circuitikz - cho mạch điện
-    if any(cmd in tikz_code for cmd in ["\\ohm", "\\volt", "\\ampere", "\\resistor", "\\capacitor", "\\inductor", "\\battery", "\\lamp"]):
-        packages.append("circuitikz")
-    
-    # tikz-timing - cho timing diagrams
-    if any(cmd in tikz_code for cmd in ["\\timing", "\\timingD{", "\\timingL{", "\\timingH{", "\\timingX{"]):
-        packages.append("tikz-timing")
-    
-    # physics - cho ký hiệu vật lý
-    if any(cmd in tikz_code for cmd in ["\\vec{", "\\abs{", "\\norm{", "\\order{", "\\qty{", "\\mrm{"]):
-        packages.append("physics")
-    
-    # mathtools - cho toán học nâng cao
-    if any(cmd in tikz_code for cmd in ["\\DeclarePairedDelimiter", "\\DeclareMathOperator", "\\mathclap", "\\mathllap", "\\mathrlap"]):
-        packages.append("mathtools")
-    
-    # tikz-cd - cho commutative diagrams
-    if any(cmd in tikz_code for cmd in ["\\begin{tikzcd}", "\\arrow[", "\\arrow{r}", "\\arrow{d}"]):
-        packages.append("tikz-cd")
-    
-    # tikz-network - cho network diagrams
-    if any(cmd in tikz_code for cmd in ["\\begin{tikzpicture}[network]", "\\Vertex[", "\\Edge[", "\\tikzstyle{VertexStyle}"]):
-        packages.append("tikz-network")
-    
-    # tikzpeople - cho people diagrams
-    if any(cmd in tikz_code for cmd in ["\\person[", "\\tikzstyle{PersonStyle}", "\\begin{tikzpicture}[person"]):
-        packages.append("tikzpeople")
-    
-    # tikzmark - cho annotations
-    if any(cmd in tikz_code for cmd in ["\\tikzmark{", "\\tikzmarkin{", "\\tikzmarkend{"]):
-        packages.append("tikzmark")
-    
-    # pgfornament - cho ornaments
-    if any(cmd in tikz_code for cmd in ["\\pgfornament{", "\\pgfornament[", "\\pgfornament["]):
-        packages.append("pgfornament")
-    
-    # Phát hiện tikz libraries
-    tikz_libs = []
-    
-    # decorations
-    if any(cmd in tikz_code for cmd in ["\\draw[decorate", "\\draw[decoration", "\\decorate", "\\decoration{"]):
-        tikz_libs.extend(["decorations.markings", "decorations.pathreplacing"])
-    
-    # patterns
-    if any(cmd in tikz_code for cmd in ["\\draw[pattern", "\\pattern", "\\fill[pattern"]):
-        tikz_libs.append("patterns")
-    
-    # shadings
-    if any(cmd in tikz_code for cmd in ["\\draw[shade", "\\shade", "\\shadedraw", "\\shading"]):
-        tikz_libs.append("shadings")
-    
-    # hobby curves
-    if any(cmd in tikz_code for cmd in ["\\draw[hobby", "\\hobby", "\\curve{"]):
-        tikz_libs.append("hobby")
-    
-    # spy (magnifying glass)
-    if "\\spy" in tikz_code:
-        tikz_libs.append("spy")
-    
-    # backgrounds
-    if any(cmd in tikz_code for cmd in ["\\begin{scope}[on background layer]", "\\begin{background}", "\\background"]):
-        tikz_libs.append("backgrounds")
-    
-    # intersections
-    if any(cmd in tikz_code for cmd in ["\\path[name intersections", "\\coordinate[name intersections", "\\draw[name intersections"]):
-        tikz_libs.append("intersections")
-    
-    # angles
-    if any(cmd in tikz_code for cmd in ["\\pic[angle", "\\angle", "\\draw pic[angle"]):
-        tikz_libs.append("angles")
-    
-    # quotes
-    if any(cmd in tikz_code for cmd in ["\\draw[quotes", "\\quotes", "\\draw[quotes="]):
-        tikz_libs.append("quotes")
-    
-    # positioning
-    if any(cmd in tikz_code for cmd in ["\\node[above", "\\node[below", "\\node[left", "\\node[right", "\\node[above left", "\\node[above right", "\\node[below left", "\\node[below right"]):
-        tikz_libs.append("positioning")
-    
-    # arrows.meta
-    if any(cmd in tikz_code for cmd in ["\\draw[-{", "\\draw[->{", "\\draw[<->{", "\\draw[arrows="]):
-        tikz_libs.append("arrows.meta")
-    
-    # shapes.geometric
-    if any(cmd in tikz_code for cmd in ["\\draw[regular polygon", "\\draw[star", "\\draw[diamond", "\\draw[ellipse", "\\draw[circle"]):
-        tikz_libs.append("shapes.geometric")
-    
-    # shapes.symbols
-    if any(cmd in tikz_code for cmd in ["\\draw[signal", "\\draw[tape", "\\draw[magnifying glass", "\\draw[cloud"]):
-        tikz_libs.append("shapes.symbols")
-    
-    # shapes.arrows
-    if any(cmd in tikz_code for cmd in ["\\draw[arrow box", "\\draw[strike out", "\\draw[rounded rectangle"]):
-        tikz_libs.append("shapes.arrows")
-    
-    # fit
-    if any(cmd in tikz_code for cmd in ["\\node[fit=", "\\fit{", "\\draw[fit="]):
-        tikz_libs.append("fit")
-    
-    # matrix
-    if any(cmd in tikz_code for cmd in ["\\matrix[", "\\matrix of", "\\matrix (", "\\matrix{"]):
-        tikz_libs.append("matrix")
-    
-    # chains
-    if any(cmd in tikz_code for cmd in ["\\begin{scope}[start chain", "\\chainin", "\\chainin (", "\\onchain"]):
-        tikz_libs.append("chains")
-    
-    # automata
-    if any(cmd in tikz_code for cmd in ["\\begin{tikzpicture}[automaton", "\\node[state", "\\path[->] node[state"]):
-        tikz_libs.append("automata")
-    
-    # petri
-    if any(cmd in tikz_code for cmd in ["\\begin{tikzpicture}[petri", "\\place[", "\\transition[", "\\arc["]):
-        tikz_libs.append("petri")
-    
-    # mindmap
-    if any(cmd in tikz_code for cmd in ["\\begin{tikzpicture}[mindmap", "\\concept[", "\\concept color="]):
-        tikz_libs.append("mindmap")
-    
-    # trees
-    if any(cmd in tikz_code for cmd in ["\\begin{tikzpicture}[tree", "\\node[level", "\\child[", "\\child {"]):
-        tikz_libs.append("trees")
-    
-    # graphs
-    if any(cmd in tikz_code for cmd in ["\\begin{tikzpicture}[graph", "\\graph[", "\\graph {", "\\graph ("]):
-        tikz_libs.append("graphs")
-    
-    # shadows
-    if any(cmd in tikz_code for cmd in ["\\draw[shadow", "\\shadow", "\\shadow{", "\\draw[drop shadow"]):
-        tikz_libs.append("shadows")
-    
-    # fadings
-    if any(cmd in tikz_code for cmd in ["\\begin{tikzfadingfrompicture", "\\tikzfading", "\\path[fading="]):
-        tikz_libs.append("fadings")
-    
-    # Phát hiện pgfplots libraries
-    pgfplots_libs = []
-    
-    # fillbetween
-    if any(cmd in tikz_code for cmd in ["\\addplot[fill between", "\\addplot[fillbetween", "\\fillbetween"]):
-        pgfplots_libs.append("fillbetween")
-    
-    # statistics
-    if any(cmd in tikz_code for cmd in ["\\addplot[statistics", "\\addplot[hist", "\\addplot[boxplot", "\\addplot[error bars"]):
-        pgfplots_libs.append("statistics")
-    
-    # dateplot
-    if any(cmd in tikz_code for cmd in ["\\addplot[date coordinates", "\\addplot[dateplot", "\\dateplot"]):
-        pgfplots_libs.append("dateplot")
-    
-    # colorbrewer
-    if any(cmd in tikz_code for cmd in ["\\addplot[colorbrewer", "\\colormap[colorbrewer", "\\pgfplotsset{colormap name="]):
-        pgfplots_libs.append("colorbrewer")
-    
-    # groupplots
-    if any(cmd in tikz_code for cmd in ["\\begin{groupplot}", "\\nextgroupplot", "\\groupplot[", "\\pgfplotsset{groupplot"]):
-        pgfplots_libs.append("groupplots")
-    
-    # ternary
-    if any(cmd in tikz_code for cmd in ["\\begin{ternaryaxis}", "\\ternaryaxis[", "\\addplot3[ternary", "\\ternaryaxis"]):
-        pgfplots_libs.append("ternary")
-    
-    # smithchart
-    if any(cmd in tikz_code for cmd in ["\\begin{smithchart}", "\\smithchart[", "\\addplot[smithchart", "\\smithchart"]):
-        pgfplots_libs.append("smithchart")
-    
-    # units
-    if any(cmd in tikz_code for cmd in ["\\begin{axis}[x unit=", "\\begin{axis}[y unit=", "\\addplot[unit="]):
-        pgfplots_libs.append("units")
+    # Phát hiện packages tự động: một lượt Aho-Corasick qua mọi trigger (package_detector)
+    packages, tikz_libs, pgfplots_libs = package_detector.detect(tikz_code)
     
     # Kết hợp packages tự động và thủ công
     # Tự động phát hiện trả về string, thủ công trả về dict
@@ -1875,7 +2731,9 @@ def index():
     svg_temp_url = None
     svg_temp_id = None
     tikz_code = ""
-    error_log_full = None
+    error_log_excerpt = None  # bounded excerpt; the full tikz.log is fetched from error_log_url on demand
+    error_log_url = None
+    retry_after = None
     
     # Cho phép preview khi chưa đăng nhập
     # Chỉ yêu cầu đăng nhập khi lưu server (xử lý ở route /save_svg)
@@ -1888,8 +2746,7 @@ def index():
         else:
             now = datetime.now(tz_vn)
             file_id = str(uuid.uuid4())
-            work_dir = f"/tmp/{file_id}"
-            os.makedirs(work_dir, exist_ok=True)
+            work_dir = compile_workspaces.create(file_id)
             tex_path = os.path.join(work_dir, "tikz.tex")
             pdf_path = os.path.join(work_dir, "tikz.pdf")
             svg_path_tmp = os.path.join(work_dir, "tikz.svg")
@@ -1899,8 +2756,19 @@ def index():
             
             try:
                 # Use enhanced compilation function with user context
-                user_id = str(current_user.id) if current_user.is_authenticated else "anonymous"
-                success, svg_content, compilation_error = compile_tikz_enhanced_whitelist(tikz_code, work_dir, user_id)
+                user_id = compile_user_key()
+                svg_pipeline = request.form.get("svg_pipeline")  # None = server default
+                session_id = request.form.get("session_id")  # editor tab: newer requests cancel this one
+                try:
+                    success, svg_content, compilation_error = compile_tikz_enhanced_whitelist(tikz_code, work_dir, user_id, svg_pipeline=svg_pipeline, lane='interactive',
+                                                                                              session_id=session_id)
+                except CompilationQueueFull as busy:
+                    retry_after = busy.retry_after
+                    success, svg_content, compilation_error = False, None, str(busy)
+                except CompilationCancelled:
+                    # Đã có request mới hơn từ cùng editor: không ai xem kết quả này nữa
+                    compile_workspaces.release(work_dir)
+                    return Response("Superseded by a newer compile request", status=409, mimetype='text/plain')
                 
                 if success:
                     # Enhanced compilation successful
@@ -1918,16 +2786,13 @@ def index():
                         except Exception as write_err:
                             print(f"⚠️  Warning: Failed to save temp SVG: {write_err}")
                     
-                    # Log successful compilation
-                    if current_user.is_authenticated:
-                        log_compilation_metrics(
-                            user_id=str(current_user.id),
-                            compilation_time=0.0,  # Will be calculated in function
-                            memory_used=0.0,       # Will be calculated in function
-                            success=True
-                        )
+                    # Metrics (time, engine) are logged by compile_tikz_enhanced_whitelist
                     
                     print(f"✅ Enhanced compilation successful - SVG generated")
+                elif retry_after:
+                    # Load shedding: server busy, not a problem with the user's code
+                    print(f"⏳ Compilation shed: {compilation_error} (retry after {retry_after}s)")
+                    error = f"<strong>Máy chủ đang bận, vui lòng thử lại sau {retry_after} giây.</strong>"
                 else:
                     # Enhanced compilation failed
                     print(f"❌ Enhanced compilation failed: {compilation_error}")
@@ -1944,19 +2809,14 @@ def index():
                             details=compilation_error
                         )
                     
-                    # ✅ FIX: Read full log file for display
-                    log_path = os.path.join(work_dir, "tikz.log")
-                    if os.path.exists(log_path):
-                        try:
-                            with open(log_path, 'r', encoding='utf-8') as log_file:
-                                error_log_full = log_file.read()
-                            print(f"✅ Read error log: {len(error_log_full)} characters")
-                        except Exception as log_err:
-                            print(f"⚠️  Failed to read log file: {log_err}")
-                            error_log_full = compilation_error  # Fallback to compilation error
+                    # Structured excerpt (first error + line in the user's code), not the whole log
+                    error_excerpt = load_error_excerpt(work_dir)
+                    if error_excerpt:
+                        error_log_excerpt = format_error_excerpt(error_excerpt)
                     else:
-                        print(f"⚠️  Log file not found: {log_path}")
-                        error_log_full = compilation_error  # Use compilation error as log
+                        error_log_excerpt = latex_log_excerpt(work_dir, fallback=compilation_error)
+                    if os.path.exists(os.path.join(work_dir, "tikz.log")):
+                        error_log_url = f"/compile_log/{file_id}"
                     
                     # ✅ FIX: Format error as HTML string for template
                     error_html = f"<strong>{error_classification['user_message']}</strong>"
@@ -1993,10 +2853,8 @@ def index():
                 log_path = os.path.join(work_dir, "tikz.log")
                 if os.path.exists(log_path):
                     error_log = os.path.join(ERROR_TIKZ_DIR, f'{timestamp}_{file_id}.log')
-                    with open(log_path, 'r', encoding='utf-8') as src, open(error_log, 'w', encoding='utf-8') as dst:
-                        log_content = src.read()
-                        dst.write(log_content)
-                        error_log_full = log_content
+                    shutil.copyfile(log_path, error_log)
+                    error_log_excerpt = latex_log_excerpt(work_dir)
                         
                 error = "Lỗi khi biên dịch hoặc chuyển đổi SVG."
                 if hasattr(ex, 'stderr') and ex.stderr:
@@ -2013,6 +2871,15 @@ def index():
                                 error += "<br><br><b>Chi tiết lỗi từ Log:</b><pre>" + "\n".join(error_details) + "</pre>"
                     except Exception:
                         pass
+            
+            # Giữ workspace khi preview thành công (/temp_svg, /save_svg) hoặc khi còn log lỗi (/compile_log)
+            if svg_temp_id:
+                compile_workspaces.settle(work_dir)
+            elif error_log_url:
+                compile_workspaces.prune(work_dir, keep=KEEP_AFTER_FAILURE)
+                compile_workspaces.settle(work_dir)
+            else:
+                compile_workspaces.release(work_dir)
                         
     # =====================================================
     # PAGINATION: Lấy danh sách SVG với phân trang
@@ -2114,7 +2981,7 @@ def index():
         page_numbers = [1]
         page = 1
     
-    return render_template("index.html",
+    response = make_response(render_template("index.html",
                            tikz_code=tikz_code,
                            svg_url=svg_url,
                            svg_full_url=svg_full_url,
@@ -2124,7 +2991,8 @@ def index():
                            error=error,
                            svg_temp_url=svg_temp_url,
                            svg_temp_id=svg_temp_id,
-                           error_log_full=error_log_full,
+                           error_log_excerpt=error_log_excerpt,
+                           error_log_url=error_log_url,
                            logged_in=logged_in,
                            user_email=user_email,
                            username=username,
@@ -2137,15 +3005,31 @@ def index():
                            has_prev=has_prev,
                            has_next=has_next,
                            page_numbers=page_numbers
-    )
+    ))
+    if retry_after:
+        response.status_code = 503
+        response.headers['Retry-After'] = str(retry_after)
+    return response
 
 @app.route('/temp_svg/<file_id>')
 def serve_temp_svg(file_id):
-    svg_path = f"/tmp/{file_id}/tikz.svg"
-    if os.path.exists(svg_path):
+    work_dir = compile_workspaces.path(file_id)
+    svg_path = os.path.join(work_dir, "tikz.svg") if work_dir else None
+    if svg_path and os.path.exists(svg_path):
+        compile_workspaces.touch(work_dir)
         return send_file(svg_path, mimetype='image/svg+xml')
     return "Not found", 404
 
+@app.route('/compile_log/<file_id>')
+def serve_compile_log(file_id):
+    """Full tikz.log of a failed preview (the page only embeds the excerpt)"""
+    work_dir = compile_workspaces.path(file_id)
+    log_path = os.path.join(work_dir, "tikz.log") if work_dir else None
+    if log_path and os.path.exists(log_path):
+        compile_workspaces.touch(work_dir)
+        return send_file(log_path, mimetype='text/plain; charset=utf-8')
+    return "Not found", 404
+
 @app.route('/save_svg', methods=['POST'])
 @login_required
 def save_svg():
@@ -2157,7 +3041,9 @@ def save_svg():
     if not file_id:
         return jsonify({"error": "Thiếu file_id"}), 400
 
-    work_dir = f"/tmp/{file_id}"
+    work_dir = compile_workspaces.path(file_id)
+    if not work_dir:
+        return jsonify({"error": "file_id không hợp lệ"}), 400
     svg_path_tmp = os.path.join(work_dir, "tikz.svg")
     if not os.path.exists(svg_path_tmp):
         return jsonify({"error": "Không tìm thấy file tạm"}), 404
@@ -2281,8 +3167,7 @@ def save_svg():
         print(f"❌ ERROR inserting into DB: {e}", flush=True)
 
     # Xóa thư mục tạm
-    import shutil
-    shutil.rmtree(work_dir, ignore_errors=True)
+    compile_workspaces.release(work_dir)
 
     return jsonify({"success": True, "filename": svg_filename, "url": f"/static/{svg_filename}"})
 
@@ -3026,9 +3911,9 @@ def delete_temp_svg():
     file_id = data.get('file_id')
     if not file_id:
         return jsonify({"error": "Thiếu file_id"}), 400
-    work_dir = f"/tmp/{file_id}"
-    import shutil
-    shutil.rmtree(work_dir, ignore_errors=True)
+    work_dir = compile_workspaces.path(file_id)
+    if work_dir:
+        compile_workspaces.release(work_dir)
     return jsonify({"success": True})
 
 @app.route('/temp_convert', methods=['POST'])
@@ -3041,9 +3926,9 @@ def temp_convert():
     dpi = data.get('dpi')
     if not file_id or fmt not in ('png', 'jpeg'):
         return jsonify({'error': 'Tham số không hợp lệ!'}), 400
-    work_dir = f"/tmp/{file_id}"
-    svg_path = os.path.join(work_dir, "tikz.svg")
-    if not os.path.exists(svg_path):
+    work_dir = compile_workspaces.path(file_id)
+    svg_path = os.path.join(work_dir, "tikz.svg") if work_dir else None
+    if not svg_path or not os.path.exists(svg_path):
         return jsonify({'error': 'Không tìm thấy file SVG tạm!'}), 404
     out_name = f"tikz.{fmt}"
     out_path = os.path.join(work_dir, out_name)
@@ -3068,6 +3953,8 @@ def temp_convert():
                 background.save(out_path, 'JPEG', quality=95)
             os.remove(tmp_png)
         url = f"/temp_img/{file_id}/{out_name}"
+        compile_workspaces.touch(work_dir)
+        compile_workspaces.settle(work_dir)  # PNG/JPEG count towards the quota
 
         # Add file size and actual image dimensions similar to /convert endpoint
         file_size = os.path.getsize(out_path) if os.path.exists(out_path) else None
@@ -3085,7 +3972,10 @@ def temp_convert():
 
 @app.route('/temp_img/<file_id>/<filename>')
 def serve_temp_img(file_id, filename):
-    img_path = f"/tmp/{file_id}/{filename}"
+    work_dir = compile_workspaces.path(file_id)
+    if not work_dir or filename not in ('tikz.png', 'tikz.jpeg'):
+        return "Not found", 404
+    img_path = os.path.join(work_dir, filename)
     if os.path.exists(img_path):
         if filename.endswith('.png'):
             return send_file(img_path, mimetype='image/png')
@@ -4504,6 +5394,125 @@ def api_follow_status(user_id):
             "error": "Database error"
         }), 500
 
+# =====================================================
+# ASYNC COMPILE JOB API
+# =====================================================
+
+def _compile_job_runner(tikz_code, work_dir, user_id, **options):
+    """Run in job threads; resolves the (tracking-wrapped) compile function at call time"""
+    return compile_tikz_enhanced_whitelist(tikz_code, work_dir, user_id, **options)
+
+init_compile_job_queue(
+    compile_func=_compile_job_runner,
+    error_classifier=CompilationErrorClassifier.classify_error,
+    jobs_dir=os.environ.get('TIKZ_JOBS_DIR', '/tmp/tikz_jobs'),
+    workspaces=compile_workspaces,
+    max_workers=CompilationLimits.MAX_CONCURRENT,
+    max_pending=int(os.environ.get('TIKZ_JOBS_MAX_PENDING', 50))
+)
+
+# An SSE stream holds its worker for the whole compile: only worth it on threaded/async
+# workers (gunicorn.conf.py turns it on with the compile daemon's gthread workers).
+# Sync workers: clients poll status_url
+COMPILE_EVENTS_ENABLED = os.environ.get('TIKZ_COMPILE_EVENTS') == '1'
+
+@app.route('/api/compile', methods=['POST'])
+@limiter.limit(RATE_LIMITS['api_write'])
+def api_compile_submit():
+    """
+    Enqueue a TikZ compile job and return immediately
+    
+    Body (JSON or form): code, svg_pipeline (optional), lane ('batch' for non-interactive work),
+    session_id (optional: a newer job of the same editor session cancels this one)
+    Returns: 202 {'job_id', 'status', 'status_url', 'events_url'}
+    (events_url only when TIKZ_COMPILE_EVENTS=1, otherwise poll status_url)
+    """
+    data = request.get_json(silent=True) or request.form
+    tikz_code = clean_control_chars(data.get('code') or data.get('tikz_code') or '')
+    if not tikz_code.strip():
+        return jsonify({"success": False, "error": "Vui lòng nhập code TikZ!"}), 400
+    
+    user_id = compile_user_key()
+    # Clients may only downgrade their jobs to the batch lane
+    lane = 'batch' if data.get('lane') == 'batch' else 'interactive'
+    options = {'svg_pipeline': data.get('svg_pipeline'), 'lane': lane}
+    if valid_session_id(data.get('session_id')):
+        # Registered now, not when a job thread picks it up: an older queued job must not supersede this one
+        options['session_id'] = data['session_id']
+        options['session_token'] = compile_sessions.begin(user_id, data['session_id'])
+    job = None
+    if compile_daemon_client:
+        try:
+            job = compile_daemon_client.submit(tikz_code, user_id, **options)
+        except CompileDaemonUnavailable as e:
+            print(f"[WARNING] {e} - queueing in-process", flush=True)
+            job = get_compile_job_queue().submit(tikz_code, user_id, **options)
+        except CompileDaemonError as e:
+            print(f"[ERROR] {e}", flush=True)
+            return jsonify({"success": False, "error": f"Compile service error: {e}"}), 502
+    else:
+        job = get_compile_job_queue().submit(tikz_code, user_id, **options)
+    if job is None:
+        slot_stats = compilation_manager.get_stats()
+        response = jsonify({"success": False, "error": "Compile queue is full, please retry shortly"})
+        response.headers['Retry-After'] = str(max(1, math.ceil(slot_stats['estimated_wait_seconds'])))
+        return response, 503
+    
+    response = {
+        "success": True,
+        "job_id": job['job_id'],
+        "status": job['status'],
+        "status_url": f"/api/compile/{job['job_id']}"
+    }
+    if COMPILE_EVENTS_ENABLED:
+        response["events_url"] = f"/api/compile/{job['job_id']}/events"
+    return jsonify(response), 202
+
+@app.route('/api/compile/cancel', methods=['POST'])
+@limiter.limit(RATE_LIMITS['api_general'])
+def api_compile_cancel():
+    """
+    Drop the in-flight compile of an editor session (its result is stale)
+    
+    Body (JSON or form): session_id
+    Returns: {'success', 'cancelled'}; cancelled is False when nothing was in flight
+    """
+    data = request.get_json(silent=True) or request.form
+    session_id = data.get('session_id')
+    if not valid_session_id(session_id):
+        return jsonify({"success": False, "error": "Invalid session_id"}), 400
+    
+    user_id = compile_user_key()
+    return jsonify({"success": True, "cancelled": compile_sessions.cancel(user_id, session_id)})
+
+@app.route('/api/compile/<job_id>')
+@limiter.limit(RATE_LIMITS['api_general'])
+def api_compile_status(job_id):
+    """Poll a compile job: queued/running/done/failed/cancelled + svg_url or structured error"""
+    job = get_compile_job_queue().get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    return jsonify({"success": True, **CompileJobQueue.public_view(job)})
+
+@app.route('/api/compile/<job_id>/events')
+@limiter.limit(RATE_LIMITS['api_general'])
+def api_compile_events(job_id):
+    """
+    Server-sent events stream of job status changes (ends on done/failed/cancelled)
+    Only with TIKZ_COMPILE_EVENTS=1 (threaded/async workers): on a sync worker the
+    stream would block the whole worker until the compile ends
+    """
+    if not COMPILE_EVENTS_ENABLED:
+        return jsonify({"success": False, "error": "Event stream disabled on this server, poll the status URL"}), 404
+    queue = get_compile_job_queue()
+    if queue.get(job_id) is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    return Response(
+        queue.stream_events(job_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/compile_with_packages', methods=['POST'])
 @login_required
 def compile_with_packages():
@@ -4518,13 +5527,14 @@ def compile_with_packages():
         return jsonify({"error": "Vui lòng nhập code TikZ!"}), 400
     
     tikz_code = clean_control_chars(tikz_code)
+    work_dir = None
+    keep_workspace = False
     
     try:
         # Tạo workspace tạm
         now = datetime.now(tz_vn)
         file_id = str(uuid.uuid4())
-        work_dir = f"/tmp/{file_id}"
-        os.makedirs(work_dir, exist_ok=True)
+        work_dir = compile_workspaces.create(file_id)
         tex_path = os.path.join(work_dir, "tikz.tex")
         pdf_path = os.path.join(work_dir, "tikz.pdf")
         svg_path_tmp = os.path.join(work_dir, "tikz.svg")
@@ -4544,22 +5554,26 @@ def compile_with_packages():
         with open(tex_path, "w", encoding="utf-8") as f:
             f.write(latex_source)
         
-        # Biên dịch
-        lualatex_process = subprocess.run([
-            "lualatex", "-interaction=nonstopmode", "--output-directory=.", "tikz.tex"
-        ],
-        cwd=work_dir,
-        capture_output=True,
-        text=True,
-        check=True
-        )
-        
-        subprocess.run(["pdf2svg", pdf_path, svg_path_tmp],
-                       cwd=work_dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # Biên dịch (save lane of the compile scheduler)
+        with compilation_resource_monitor(str(current_user.id), lane='save'):
+            lualatex_process = latex_sandbox.run([
+                "lualatex", "-interaction=nonstopmode", "--output-directory=.", "tikz.tex"
+            ],
+            cwd=work_dir,
+            timeout_seconds=CompilationLimits.TIMEOUT_SECONDS,
+            memory_mb=CompilationLimits.MAX_MEMORY_MB,
+            check=True
+            )
+            
+            latex_sandbox.run(["pdf2svg", pdf_path, svg_path_tmp],
+                              cwd=work_dir, timeout_seconds=15, memory_mb=CompilationLimits.MAX_MEMORY_MB, check=True)
         
         # Đọc SVG content
         with open(svg_path_tmp, 'r', encoding='utf-8') as f:
             svg_content = f.read()
+        compile_workspaces.prune(work_dir)
+        compile_workspaces.settle(work_dir)
+        keep_workspace = True
         
         return jsonify({
             "success": True,
@@ -4568,6 +5582,11 @@ def compile_with_packages():
             "svg_content": svg_content
         })
         
+    except CompilationQueueFull as busy:
+        response = jsonify({"error": "Máy chủ đang bận, vui lòng thử lại sau", "retry_after": busy.retry_after})
+        response.headers['Retry-After'] = str(busy.retry_after)
+        return response, 503
+        
     except subprocess.CalledProcessError as ex:
         # Xử lý lỗi biên dịch
         log_path = os.path.join(work_dir, "tikz.log")
@@ -4590,6 +5609,10 @@ def compile_with_packages():
         
     except Exception as e:
         return jsonify({"error": f"Lỗi không xác định: {str(e)}"}), 500
+    
+    finally:
+        if work_dir and not keep_workspace:
+            compile_workspaces.release(work_dir)
 
 @app.route('/api/debug_parse_packages', methods=['POST'])
 def api_debug_parse_packages():
@@ -4628,7 +5651,7 @@ def api_clear_compilation_cache():
     """DEBUG endpoint để clear compilation cache"""
     try:
         # Clear the compilation cache
-        compilation_cache.cache.clear()
+        compilation_cache.clear()
         return jsonify({
             "success": True,
             "message": "Compilation cache cleared successfully"
@@ -4682,24 +5705,26 @@ def api_platform_info():
 def api_system_status():
     """Return system status and performance metrics"""
     
-    with compilation_manager.lock:
-        active_compilations = compilation_manager.active_count
-        max_concurrent = compilation_manager.max_concurrent
+    slot_stats = compilation_manager.get_stats()
+    active_compilations = slot_stats['active_count']
+    max_concurrent = slot_stats['max_concurrent']
     
-    # Get system metrics
+    # Get system metrics (latest background sample, no blocking measurement)
     try:
-        cpu_percent = psutil.cpu_percent(interval=0.1)
-        memory = psutil.virtual_memory()
+        load = system_load_sampler.snapshot()
+        cpu_percent = load['cpu_percent']
+        memory_percent = load['memory_percent']
         disk = psutil.disk_usage('/')
     except:
+        load = None
         cpu_percent = 0
-        memory = None
+        memory_percent = 0
         disk = None
     
     system_health = "healthy"
-    if cpu_percent > 90 or (memory and memory.percent > 90):
+    if cpu_percent > 90 or memory_percent > 90:
         system_health = "critical"
-    elif cpu_percent > 70 or (memory and memory.percent > 70):
+    elif cpu_percent > 70 or memory_percent > 70:
         system_health = "degraded"
     
     return jsonify({
@@ -4709,7 +5734,19 @@ def api_system_status():
             "active_count": active_compilations,
             "max_concurrent": max_concurrent,
             "available_slots": max_concurrent - active_compilations,
-            "queue_status": "available" if active_compilations < max_concurrent else "full"
+            "queue_status": "available" if active_compilations < max_concurrent else "full",
+            "scope": slot_stats['scope'],
+            "active_users": slot_stats['active_users'],
+            "max_per_user": slot_stats['max_per_user'],
+            "warm_pool": lualatex_warm_pool.get_stats(),
+            "sandbox": latex_sandbox.get_stats(),
+            "workspaces": compile_workspaces.get_stats(),
+            "package_detection": package_detector.get_stats(),
+            "sessions": compile_sessions.get_stats(),
+            "compile_daemon": {
+                "socket": compile_daemon_client.socket_path,
+                "reachable": compile_daemon_client.ping()
+            } if compile_daemon_client else None
         },
         "security": {
             "patterns_active": len(LaTeXSecurityValidator.DANGEROUS_PATTERNS),
@@ -4718,8 +5755,10 @@ def api_system_status():
         },
         "system": {
             "cpu_percent": cpu_percent if cpu_percent else 0,
-            "memory_percent": memory.percent if memory else 0,
+            "avg_cpu_percent": load['avg_cpu_percent'] if load else 0,
+            "memory_percent": memory_percent,
             "disk_percent": disk.percent if disk else 0,
+            "load_average": [load['load_1m'], load['load_5m']] if load else None,
             "load_level": "high" if cpu_percent > 80 else "medium" if cpu_percent > 50 else "low"
         },
         "limits": {
@@ -4797,6 +5836,9 @@ def api_cache_stats():
     
     return jsonify({
         "cache_statistics": cache_stats,
+        "single_flight": compile_singleflight.get_stats(),
+        "cache_warmer": cache_warmer.get_stats(),
+        "format_pool": latex_format_pool.get_stats(),
         "timestamp": time.time(),
         "performance_analysis": {
             "efficiency": "excellent" if cache_stats['hit_rate_percent'] > 70 else 
@@ -4815,28 +5857,37 @@ def api_dashboard_metrics():
     """Comprehensive dashboard metrics for administrators"""
     
     # Get compilation metrics
-    with compilation_manager.lock:
-        compilation_metrics = {
-            "active_compilations": compilation_manager.active_count,
-            "max_concurrent": compilation_manager.max_concurrent,
-            "queue_length": len(compilation_manager.compilation_queue),
-            "available_slots": compilation_manager.max_concurrent - compilation_manager.active_count
-        }
+    slot_stats = compilation_manager.get_stats()
+    compilation_metrics = {
+        "active_compilations": slot_stats['active_count'],
+        "max_concurrent": slot_stats['max_concurrent'],
+        "queue_length": slot_stats['active_count'],
+        "available_slots": slot_stats['available_slots'],
+        "active_users": slot_stats['active_users'],
+        "worker_pids": slot_stats['worker_pids'],
+        "reaped_leases": slot_stats['reaped_leases']
+    }
     
     # Get system metrics
     try:
-        cpu_percent = psutil.cpu_percent(interval=0.1)
-        memory = psutil.virtual_memory()
+        load = system_load_sampler.snapshot()
+        cpu_percent = load['cpu_percent']
+        memory_percent = load['memory_percent']
         disk = psutil.disk_usage('/')
         
         system_metrics = {
             "cpu_percent": cpu_percent,
-            "memory_percent": memory.percent,
-            "memory_available_gb": round(memory.available / (1024**3), 2),
+            "avg_cpu_percent": load['avg_cpu_percent'],
+            "max_cpu_percent": load['max_cpu_percent'],
+            "memory_percent": memory_percent,
+            "memory_available_gb": round(load['memory_available_mb'] / 1024, 2),
+            "load_average": [load['load_1m'], load['load_5m']],
+            "avg_compiles_queued": load['avg_compiles_queued'],
+            "sample_window": load['window_samples'],
             "disk_percent": disk.percent,
             "disk_free_gb": round(disk.free / (1024**3), 2),
-            "system_health": "healthy" if cpu_percent < 70 and memory.percent < 80 else 
-                           "degraded" if cpu_percent < 90 and memory.percent < 90 else "critical"
+            "system_health": "healthy" if cpu_percent < 70 and memory_percent < 80 else 
+                           "degraded" if cpu_percent < 90 and memory_percent < 90 else "critical"
         }
     except:
         system_metrics = {"error": "Could not retrieve system metrics"}
@@ -4868,6 +5919,8 @@ def api_dashboard_metrics():
             "compilation": compilation_metrics,
             "system": system_metrics,
             "cache": cache_stats,
+            "hot_keys": compilation_cache.hot_keys.get_stats() if compilation_cache.hot_keys else None,
+            "engine_routing": engine_router.get_stats(),
             "security": security_metrics,
             "adaptive_limits": {
                 "baseline": baseline_limits,
@@ -4886,13 +5939,35 @@ def api_dashboard_metrics():
         }
     })
 
+ADMIN_TOKEN = os.environ.get('TIKZ_ADMIN_TOKEN', '')
+CACHE_CONTROL_ADMIN_ACTIONS = ('clear', 'purge', 'purge_stale', 'warm')
+
+def admin_token_valid() -> bool:
+    """X-Admin-Token header matches TIKZ_ADMIN_TOKEN (never valid when the token is not configured)"""
+    supplied = request.headers.get('X-Admin-Token', '')
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(supplied.encode('utf-8'), ADMIN_TOKEN.encode('utf-8'))
+
 @app.route('/api/admin/cache-control', methods=['POST'])
 def api_cache_control():
-    """Cache management endpoint"""
+    """
+    Cache management endpoint
+    
+    Actions: 'stats', 'clear' (everything), 'tags' (known purge tags),
+    'purge' with 'tags': ["package:circuitikz", "template:<hash>", ...],
+    'purge_stale' (template/toolchain versions this deployment no longer serves),
+    'warm' (start a cache warm-up run in the background now)
+    'clear', 'purge', 'purge_stale' and 'warm' need the X-Admin-Token header (TIKZ_ADMIN_TOKEN)
+    """
     
     data = request.get_json() or {}
     action = data.get('action', '')
     
+    if action in CACHE_CONTROL_ADMIN_ACTIONS and not admin_token_valid():
+        return jsonify({
+            "success": False,
+            "error": "Admin token required for this action"
+        }), 403
+    
     if action == 'clear':
         compilation_cache.clear()
         return jsonify({
@@ -4908,11 +5983,51 @@ def api_cache_control():
             "timestamp": time.time()
         })
     
+    elif action == 'tags':
+        return jsonify({
+            "success": True,
+            "current_version_tags": current_version_tags(),
+            "tags": compilation_cache.list_tags(),
+            "timestamp": time.time()
+        })
+    
+    elif action == 'purge':
+        tags = data.get('tags') or []
+        if not isinstance(tags, list) or not tags or not all(isinstance(tag, str) and ':' in tag for tag in tags):
+            return jsonify({
+                "success": False,
+                "error": "'tags' must be a non-empty list like [\"package:circuitikz\"]"
+            }), 400
+        return jsonify({
+            "success": True,
+            "tags": tags,
+            "purged": compilation_cache.purge(tags),
+            "timestamp": time.time()
+        })
+    
+    elif action == 'purge_stale':
+        stale = compilation_cache.stale_tags(current_version_tags())
+        return jsonify({
+            "success": True,
+            "tags": stale,
+            "purged": compilation_cache.purge(stale) if stale else {},
+            "timestamp": time.time()
+        })
+    
+    elif action == 'warm':
+        threading.Thread(target=cache_warmer.run_once, kwargs={'force': True}, daemon=True).start()
+        return jsonify({
+            "success": True,
+            "message": "Cache warm-up started",
+            "warmer": cache_warmer.get_stats(),
+            "timestamp": time.time()
+        })
+    
     else:
         return jsonify({
             "success": False,
-            "error": "Invalid action. Use 'clear' or 'stats'",
-            "available_actions": ["clear", "stats"]
+            "error": "Invalid action. Use 'clear', 'stats', 'tags', 'purge', 'purge_stale' or 'warm'",
+            "available_actions": ["clear", "stats", "tags", "purge", "purge_stale", "warm"]
         }), 400
 
 # ✅ EMAIL SYSTEM ROUTES
@@ -6312,10 +7427,12 @@ def mark_all_notifications_read():
 
 # Import package routes
 try:
-    from package_routes import setup_package_routes, update_package_usage
+    from package_routes import setup_package_routes, update_package_usage, on_package_cache_clear
     
     # Setup package management routes - Pass the main limiter to avoid conflicts
     setup_package_routes(app, limiter=limiter)
+    # Approved/changed packages: rebuild the detection automaton on the next compile
+    on_package_cache_clear(package_detector.invalidate)
     
     print("[INFO] Package Management System routes loaded successfully", flush=True)
     
@@ -6331,19 +7448,19 @@ except Exception as e:
 # Modify the existing compilation function to track package usage
 original_compile_tikz_enhanced_whitelist = compile_tikz_enhanced_whitelist
 
-def compile_tikz_enhanced_whitelist_with_tracking(tikz_code, output_dir, filename_base):
+def compile_tikz_enhanced_whitelist_with_tracking(tikz_code, output_dir, filename_base, **kwargs):
     """Enhanced compilation with package usage tracking"""
     try:
         # Call original compilation function
         # Returns: (success: bool, svg_content: str, error_message: str)
-        result = original_compile_tikz_enhanced_whitelist(tikz_code, output_dir, filename_base)
+        result = original_compile_tikz_enhanced_whitelist(tikz_code, output_dir, filename_base, **kwargs)
         
         # Check if result is a tuple (expected format)
         if isinstance(result, tuple) and len(result) >= 3:
             success, svg_content, error_message = result
             
-            # Track package usage if compilation was successful
-            if success:
+            # Track package usage if compilation was successful (warm-up compiles are not usage)
+            if success and filename_base != WARMER_USER_ID:
                 try:
                     # Extract packages from tikz_code
                     import re
@@ -6369,14 +7486,110 @@ def compile_tikz_enhanced_whitelist_with_tracking(tikz_code, output_dir, filenam
         
         return result
         
+    except (CompilationQueueFull, CompilationCancelled):
+        raise
     except Exception as e:
         print(f"[ERROR] Error in enhanced compilation with tracking: {e}", flush=True)
         # Fallback to original function
-        return original_compile_tikz_enhanced_whitelist(tikz_code, output_dir, filename_base)
+        return original_compile_tikz_enhanced_whitelist(tikz_code, output_dir, filename_base, **kwargs)
 
 # Replace the compilation function
 compile_tikz_enhanced_whitelist = compile_tikz_enhanced_whitelist_with_tracking
 
+# =====================================================
+# COMPILE DAEMON DELEGATION
+# =====================================================
+
+# With TIKZ_COMPILE_DAEMON_SOCKET set, web workers hand compiles to the
+# standalone compile daemon (compile_daemon.py) and only wait on the socket.
+# The daemon imports this module with the variable unset and compiles locally.
+local_compile_tikz_enhanced_whitelist = compile_tikz_enhanced_whitelist
+
+def compile_tikz_via_daemon(tikz_code, work_dir, user_id="anonymous", **kwargs):
+    """
+    Compile in the daemon; fall back to in-process compilation only if it cannot be reached
+    A daemon that took the request and then timed out or failed is a failed compile, not a retry here
+    """
+    try:
+        return compile_daemon_client.compile(tikz_code, work_dir, user_id, **kwargs)
+    except CompileDaemonUnavailable as e:
+        print(f"[WARNING] {e} - compiling in-process", flush=True)
+        return local_compile_tikz_enhanced_whitelist(tikz_code, work_dir, user_id, **kwargs)
+    except CompileDaemonError as e:
+        print(f"[ERROR] {e}", flush=True)
+        return False, "", f"Compile service error: {e}"
+
+if compile_daemon_client:
+    compile_tikz_enhanced_whitelist = compile_tikz_via_daemon
+
+# =====================================================
+# CACHE WARM-UP
+# =====================================================
+
+def fetch_cache_warm_candidates(limit: int) -> list:
+    """
+    Most-liked and most recently saved gallery code, interleaved, without duplicates
+    Hot editor inputs seen by this worker's HotKeyTracker go first
+    """
+    conn = mysql.connector.connect(
+        host=os.environ.get('DB_HOST', 'localhost'),
+        user=os.environ.get('DB_USER', 'hiep1987'),
+        password=os.environ.get('DB_PASSWORD', ''),
+        database=os.environ.get('DB_NAME', 'tikz2svg')
+    )
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT s.tikz_code
+            FROM svg_image s
+            LEFT JOIN svg_like sl ON s.id = sl.svg_image_id
+            WHERE s.tikz_code IS NOT NULL AND s.tikz_code != ''
+            GROUP BY s.id, s.tikz_code, s.created_at
+            ORDER BY COUNT(sl.id) DESC, s.created_at DESC
+            LIMIT %s
+        """, (limit,))
+        popular = [row[0] for row in cursor.fetchall()]
+        cursor.execute("""
+            SELECT tikz_code FROM svg_image
+            WHERE tikz_code IS NOT NULL AND tikz_code != ''
+            ORDER BY created_at DESC
+            LIMIT %s
+        """, (limit,))
+        recent = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+    finally:
+        conn.close()
+    
+    candidates = [entry['sample'] for entry in (compilation_cache.hot_keys.hot_keys() if compilation_cache.hot_keys else [])
+                  if entry['sample'] and entry['requests'] >= 2]
+    for pair in zip(popular, recent):
+        candidates.extend(pair)
+    candidates.extend(popular[len(recent):] + recent[len(popular):])
+    return list(dict.fromkeys(candidates))[:limit]
+
+def _cache_warm_compile(tikz_code, work_dir):
+    # Same path as user compiles (the daemon when configured), batch lane
+    return compile_tikz_enhanced_whitelist(tikz_code, work_dir, WARMER_USER_ID, lane='batch')
+
+cache_warmer = CacheWarmer(
+    fetch_candidates=fetch_cache_warm_candidates,
+    compile_func=_cache_warm_compile,
+    load_level=adaptive_limits.get_system_load_level,
+    cpu_meter=latex_sandbox.cpu_meter,      # CPU of the warm-up's own LaTeX runs only
+    workspaces=compile_workspaces,
+    max_items=int(os.environ.get('TIKZ_CACHE_WARM_ITEMS', 50)),
+    cpu_budget_seconds=float(os.environ.get('TIKZ_CACHE_WARM_CPU_SECONDS', 120)),
+    start_delay_seconds=int(os.environ.get('TIKZ_CACHE_WARM_DELAY', 60)),
+    interval_seconds=int(os.environ.get('TIKZ_CACHE_WARM_INTERVAL', 6 * 3600)),
+    enabled=os.environ.get('TIKZ_CACHE_WARM', '1') == '1'
+)
+
+@app.before_request
+def start_cache_warmer():
+    # With a compile daemon the warmer runs there (compile_daemon.main); otherwise in one elected worker
+    if not compile_daemon_client:
+        cache_warmer.ensure_started()
+
 if __name__ == "__main__":
     import os
     port = int(os.environ.get('FLASK_RUN_PORT', 5000))
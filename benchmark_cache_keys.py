@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Benchmark: cache key trên code nguyên văn (.strip()) vs code đã chuẩn hoá (tex_normalize)
+Phát lại các lần gửi TikZ thực tế theo thứ tự thời gian với cache không giới hạn
+và so sánh hit rate của hai cách tính khoá.
+
+Nguồn dữ liệu (chọn một):
+    --from-db             bảng svg_image (DB_HOST/DB_USER/DB_PASSWORD/DB_NAME)
+    --sql-dump FILE       bản dump mysqldump có INSERT INTO `svg_image`
+    --tex-dir DIR         thư mục *.tex (vd. error_tikz/), theo tên file
+
+Usage:
+    python benchmark_cache_keys.py --sql-dump tikz2svg_production_backup_20251004_085512.sql
+"""
+
+import os
+import re
+import sys
+import glob
+import json
+import hashlib
+import argparse
+from datetime import datetime
+
+from tex_normalize import normalize_tikz_code
+
+
+def load_from_db() -> list:
+    import mysql.connector
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    conn = mysql.connector.connect(
+        host=os.environ.get('DB_HOST', 'localhost'),
+        user=os.environ.get('DB_USER'),
+        password=os.environ.get('DB_PASSWORD'),
+        database=os.environ.get('DB_NAME', 'tikz2svg_local')
+    )
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT tikz_code FROM svg_image WHERE tikz_code IS NOT NULL ORDER BY created_at, id")
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+
+def _parse_sql_values(values: str) -> list:
+    """Rows of a mysqldump VALUES (...),(...) list (strings with backslash escapes)"""
+    escapes = {'n': '\n', 'r': '\r', 't': '\t', '0': '\0', 'Z': '\x1a'}
+    rows, row, index = [], None, 0
+    while index < len(values):
+        char = values[index]
+        if char == '(' and row is None:
+            row = []
+        elif char == ')' and row is not None:
+            rows.append(row)
+            row = None
+        elif char == "'":
+            index += 1
+            chunk = []
+            while values[index] != "'" or values[index + 1:index + 2] == "'":
+                if values[index] == '\\':
+                    index += 1
+                    chunk.append(escapes.get(values[index], values[index]))
+                elif values[index] == "'":
+                    chunk.append("'")
+                    index += 1
+                else:
+                    chunk.append(values[index])
+                index += 1
+            row.append(''.join(chunk))
+        elif row is not None and char not in ', \n':
+            end = index
+            while values[end] not in ',)':
+                end += 1
+            token = values[index:end]
+            row.append(None if token == 'NULL' else token)
+            index = end - 1
+        index += 1
+    return rows
+
+
+def load_from_sql_dump(path: str) -> list:
+    """tikz_code của svg_image theo (created_at, id); cột lấy từ CREATE TABLE"""
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        dump = f.read()
+    create = re.search(r'CREATE TABLE `svg_image` \((.*?)\n\)', dump, re.S)
+    columns = re.findall(r'^\s*`(\w+)`', create.group(1), re.M) if create else []
+    rows = []
+    for match in re.finditer(r'INSERT INTO `svg_image` VALUES (.*?);\n', dump, re.S):
+        rows.extend(_parse_sql_values(match.group(1)))
+    if not {'tikz_code', 'created_at', 'id'} <= set(columns):
+        raise ValueError(f"{path}: không có bảng svg_image với cột tikz_code")
+    code_col, created_col, id_col = (columns.index(c) for c in ('tikz_code', 'created_at', 'id'))
+    rows = [r for r in rows if r[code_col]]
+    rows.sort(key=lambda r: (r[created_col] or '', int(r[id_col])))
+    return [r[code_col] for r in rows]
+
+
+def load_from_tex_dir(path: str) -> list:
+    submissions = []
+    for tex_path in sorted(glob.glob(os.path.join(path, '*.tex'))):
+        with open(tex_path, 'r', encoding='utf-8', errors='replace') as f:
+            submissions.append(f.read())
+    return submissions
+
+
+def replay(submissions: list, key_func) -> dict:
+    """Hit rate với cache không giới hạn: lần đầu mỗi khoá là miss"""
+    seen = set()
+    hits = 0
+    for tikz_code in submissions:
+        key = hashlib.sha256(key_func(tikz_code).encode('utf-8')).hexdigest()
+        if key in seen:
+            hits += 1
+        seen.add(key)
+    return {
+        'requests': len(submissions),
+        'hits': hits,
+        'distinct_keys': len(seen),
+        'hit_rate_percent': round(hits / max(1, len(submissions)) * 100, 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay TikZ submissions: verbatim vs normalized cache keys")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--from-db', action='store_true', help="Đọc svg_image từ database")
+    source.add_argument('--sql-dump', help="File mysqldump chứa svg_image")
+    source.add_argument('--tex-dir', help="Thư mục chứa các file .tex")
+    parser.add_argument('--output', help="Ghi kết quả JSON ra file")
+    args = parser.parse_args()
+
+    if args.from_db:
+        submissions = load_from_db()
+    elif args.sql_dump:
+        submissions = load_from_sql_dump(args.sql_dump)
+    else:
+        submissions = load_from_tex_dir(args.tex_dir)
+
+    report = {
+        'generated_at': datetime.now().isoformat(),
+        'verbatim': replay(submissions, lambda code: code.strip()),
+        'normalized': replay(submissions, normalize_tikz_code),
+    }
+
+    print("=" * 60)
+    for label in ('verbatim', 'normalized'):
+        print(f"{label:<11}: {json.dumps(report[label])}")
+    print("=" * 60)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(f"❌ ERROR: {e}")
+        sys.exit(1)
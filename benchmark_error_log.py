@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Benchmark: log lỗi khi biên dịch thất bại (tex_log)
+- chèn một lệnh không tồn tại (\\tikzbenchundefined) vào một dòng ngẫu nhiên của
+  code thật, biên dịch bằng lualatex: chạy hết vs dừng ở lỗi '!' đầu tiên
+  (stop_on_output=FatalErrorWatcher)
+- so sánh kích thước tikz.log (trước đây nhúng nguyên vào trang) với trích
+  đoạn có cấu trúc (tikz.error.json)
+- tỉ lệ dòng lỗi được ánh xạ đúng về dòng trong code của người dùng
+
+Nguồn code thật (chọn một):
+    --sql-dump FILE       bản dump mysqldump có INSERT INTO `svg_image`
+    --tex-dir DIR         thư mục *.tex (vd. error_tikz/)
+
+Usage:
+    python benchmark_error_log.py --sql-dump tikz2svg_production_backup_20251004_085512.sql --limit 30
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import statistics
+from datetime import datetime
+
+from app import build_compile_source, detect_required_packages, latex_sandbox
+from tex_log import FatalErrorWatcher, document_line, latex_error_excerpt
+from benchmark_cache_keys import load_from_sql_dump, load_from_tex_dir
+
+UNDEFINED_COMMAND = "\\tikzbenchundefined"
+
+
+def inject_error(tikz_code: str, rng: random.Random):
+    """(mutated code, 1-based line of the injected command) inside the tikzpicture, or None"""
+    lines = tikz_code.split('\n')
+    candidates = [index for index, line in enumerate(lines)
+                  if line.strip().startswith('\\draw') or line.strip().startswith('\\node')]
+    if not candidates:
+        return None
+    index = rng.choice(candidates)
+    lines[index] = lines[index].replace('\\', UNDEFINED_COMMAND + ' \\', 1)
+    return '\n'.join(lines), index + 1
+
+
+def compile_once(latex_source: str, stop: bool, timeout: int) -> dict:
+    work_dir = tempfile.mkdtemp(prefix="bench_errlog_")
+    try:
+        with open(os.path.join(work_dir, "tikz.tex"), "w", encoding="utf-8") as f:
+            f.write(latex_source)
+        started = time.perf_counter()
+        process = latex_sandbox.run(
+            ["lualatex", "-interaction=nonstopmode", "-halt-on-error", "--output-directory=.", "tikz.tex"],
+            cwd=work_dir, timeout_seconds=timeout, memory_mb=2048,
+            stop_on_output=FatalErrorWatcher().feed if stop else None
+        )
+        elapsed = time.perf_counter() - started
+        log_path = os.path.join(work_dir, "tikz.log")
+        return {
+            'seconds': elapsed,
+            'stdout': process.stdout,
+            'stopped_early': process.stopped_early,
+            'log_bytes': os.path.getsize(log_path) if os.path.exists(log_path) else 0
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Early stop at the first LaTeX error + structured log excerpt")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--sql-dump', help="File mysqldump chứa svg_image")
+    source.add_argument('--tex-dir', help="Thư mục chứa các file .tex")
+    parser.add_argument('--limit', type=int, default=30)
+    parser.add_argument('--timeout', type=int, default=45)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="Ghi kết quả JSON ra file")
+    args = parser.parse_args()
+
+    submissions = load_from_sql_dump(args.sql_dump) if args.sql_dump else load_from_tex_dir(args.tex_dir)
+    rng = random.Random(args.seed)
+    cases = [case for case in (inject_error(code, rng) for code in submissions) if case][:args.limit]
+
+    rows = []
+    for tikz_code, injected_line in cases:
+        packages, tikz_libs, pgfplots_libs = detect_required_packages(tikz_code)
+        latex_source = build_compile_source(tikz_code, packages, tikz_libs, pgfplots_libs, strategy='full')
+        full = compile_once(latex_source, stop=False, timeout=args.timeout)
+        stopped = compile_once(latex_source, stop=True, timeout=args.timeout)
+        excerpt = latex_error_excerpt(stopped['stdout'], tikz_code, document_line(latex_source),
+                                      stopped_early=stopped['stopped_early'])
+        rows.append({
+            'full_seconds': full['seconds'],
+            'stopped_seconds': stopped['seconds'],
+            'stopped_early': stopped['stopped_early'],
+            'log_bytes': full['log_bytes'],
+            'excerpt_bytes': len(json.dumps(excerpt, ensure_ascii=False).encode('utf-8')) if excerpt else 0,
+            'line_mapped': bool(excerpt and excerpt['line'] == injected_line)
+        })
+        print(f"{len(rows):>3}  {full['seconds']:.2f}s -> {stopped['seconds']:.2f}s  "
+              f"log {full['log_bytes']:>7}B  excerpt {rows[-1]['excerpt_bytes']:>4}B  "
+              f"line {'ok' if rows[-1]['line_mapped'] else 'MISS'}")
+
+    if not rows:
+        print("❌ No test cases (no \\draw/\\node lines found)")
+        return
+
+    report = {
+        'generated_at': datetime.now().isoformat(),
+        'cases': len(rows),
+        'median_full_seconds': round(statistics.median(r['full_seconds'] for r in rows), 3),
+        'median_stopped_seconds': round(statistics.median(r['stopped_seconds'] for r in rows), 3),
+        'stopped_early': sum(r['stopped_early'] for r in rows),
+        'median_log_bytes': statistics.median(r['log_bytes'] for r in rows),
+        'max_log_bytes': max(r['log_bytes'] for r in rows),
+        'median_excerpt_bytes': statistics.median(r['excerpt_bytes'] for r in rows),
+        'line_mapped': sum(r['line_mapped'] for r in rows)
+    }
+    print("=" * 72)
+    print(json.dumps(report, indent=2))
+    print("=" * 72)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'summary': report, 'rows': rows}, f, indent=2)
+        print(f"✅ Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(f"❌ ERROR: {e}")
+        sys.exit(1)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Benchmark: phát hiện package bằng automaton Aho-Corasick (package_detector)
+vs ~40 lần any(cmd in tikz_code ...) của detect_required_packages cũ.
+Đo thời gian trên code thật và trên code tổng hợp cỡ lớn, đồng thời kiểm tra
+hai cách cho cùng (packages, tikz_libs, pgfplots_libs).
+
+Cách cũ được chạy lại từ BUILTIN_RULES (cùng trigger, cùng thứ tự if).
+
+Nguồn code thật (chọn một):
+    --sql-dump FILE       bản dump mysqldump có INSERT INTO `svg_image`
+    --tex-dir DIR         thư mục *.tex (vd. error_tikz/)
+
+Usage:
+    python benchmark_package_detection.py --sql-dump tikz2svg_production_backup_20251004_085512.sql
+"""
+
+import sys
+import json
+import time
+import argparse
+from datetime import datetime
+
+from package_detector import BUILTIN_RULES, KINDS, PackageDetector
+from benchmark_cache_keys import load_from_sql_dump, load_from_tex_dir
+
+SYNTHETIC_SIZES = (1000, 10000, 50000)
+
+
+def legacy_detect(tikz_code: str) -> tuple:
+    """Các khối if any(...) cũ: mỗi rule quét lại toàn bộ code"""
+    detected = {kind: [] for kind in KINDS}
+    for kind, targets, triggers in BUILTIN_RULES:
+        if any(cmd in tikz_code for cmd in triggers):
+            detected[kind].extend(targets)
+    return tuple(detected[kind] for kind in KINDS)
+
+
+def synthetic_inputs(submissions: list) -> dict:
+    """Code thật nối lại tới cỡ size (nhiều lệnh, ít trigger khớp) và code không có backslash"""
+    corpus = "\n".join(submissions) or "\\draw[thick] (0,0) -- (1,1) node[midway] {$x$};\n"
+    inputs = {}
+    for size in SYNTHETIC_SIZES:
+        inputs[f'corpus_{size}'] = (corpus * (size // len(corpus) + 1))[:size]
+        inputs[f'plain_draw_{size}'] = ("\\draw (0,0) -- (1,1);\n" * (size // 22 + 1))[:size]
+        inputs[f'no_commands_{size}'] = ("(0,0) -- (1,1) " * (size // 16 + 1))[:size]
+    return inputs
+
+
+def best_time(func, inputs: list, repeat: int = 5) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for tikz_code in inputs:
+            func(tikz_code)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def compare(submissions: list, detector: PackageDetector) -> dict:
+    mismatches = []
+    for index, tikz_code in enumerate(submissions):
+        legacy = legacy_detect(tikz_code)
+        automaton = detector.detect(tikz_code)
+        if legacy != automaton:
+            mismatches.append({'index': index, 'legacy': legacy, 'automaton': automaton,
+                               'excerpt': tikz_code[:200]})
+    return {'submissions': len(submissions), 'mismatches': len(mismatches), 'examples': mismatches[:10]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aho-Corasick vs any() package detection")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--sql-dump', help="File mysqldump chứa svg_image")
+    source.add_argument('--tex-dir', help="Thư mục chứa các file .tex")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help="Ghi kết quả JSON ra file")
+    args = parser.parse_args()
+
+    submissions = []
+    if args.sql_dump:
+        submissions = load_from_sql_dump(args.sql_dump)
+    elif args.tex_dir:
+        submissions = load_from_tex_dir(args.tex_dir)
+
+    started = time.perf_counter()
+    detector = PackageDetector()
+    build_ms = (time.perf_counter() - started) * 1000
+
+    report = {'generated_at': datetime.now().isoformat(), 'automaton': {**detector.get_stats(), 'build_ms': round(build_ms, 2)},
+              'timings': {}}
+
+    print("=" * 72)
+    print(f"automaton: {report['automaton']}")
+    print(f"{'input':<24}{'items':>7}{'any() ms':>14}{'automaton ms':>16}{'speedup':>10}")
+    cases = {'submissions': submissions} if submissions else {}
+    cases.update({label: [code] for label, code in synthetic_inputs(submissions).items()})
+    for label, inputs in cases.items():
+        legacy_seconds = best_time(legacy_detect, inputs, args.repeat)
+        automaton_seconds = best_time(detector.detect, inputs, args.repeat)
+        speedup = legacy_seconds / max(automaton_seconds, 1e-9)
+        print(f"{label:<24}{len(inputs):>7}{legacy_seconds * 1000:>14.2f}{automaton_seconds * 1000:>16.2f}{speedup:>9.2f}x")
+        report['timings'][label] = {
+            'items': len(inputs),
+            'any_ms': round(legacy_seconds * 1000, 3),
+            'automaton_ms': round(automaton_seconds * 1000, 3)
+        }
+    print("=" * 72)
+
+    report['parity'] = compare(submissions + list(synthetic_inputs(submissions).values()), detector)
+    print(f"parity: {json.dumps(report['parity'], ensure_ascii=False)[:2000]}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(f"❌ ERROR: {e}")
+        sys.exit(1)
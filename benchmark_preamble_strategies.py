@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Benchmark: full TEX_TEMPLATE vs minimal per-diagram preamble
+So sánh thời gian biên dịch và tỉ lệ thành công của 2 chiến lược preamble
+trên tập svg_image.tikz_code đã lưu trong database.
+
+Usage:
+    python benchmark_preamble_strategies.py --limit 200 --output preamble_benchmark_results.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime
+
+import mysql.connector
+from dotenv import load_dotenv
+
+from app import (
+    TEX_TEMPLATE,
+    generate_latex_source,
+    generate_minimal_latex_source,
+    detect_required_packages,
+    needs_full_preamble,
+)
+
+load_dotenv()
+
+
+def get_db_connection():
+    return mysql.connector.connect(
+        host=os.environ.get('DB_HOST', 'localhost'),
+        user=os.environ.get('DB_USER', 'hiep1987'),
+        password=os.environ.get('DB_PASSWORD', ''),
+        database=os.environ.get('DB_NAME', 'tikz2svg')
+    )
+
+
+def load_corpus(limit):
+    """Lấy tikz_code từ bảng svg_image"""
+    conn = get_db_connection()
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute("""
+        SELECT id, tikz_code FROM svg_image
+        WHERE tikz_code IS NOT NULL AND tikz_code != ''
+        ORDER BY id DESC
+        LIMIT %s
+    """, (limit,))
+    rows = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    return rows
+
+
+def run_lualatex(latex_source, timeout):
+    """Biên dịch một lần trong thư mục tạm, trả về (success, seconds, output)"""
+    work_dir = tempfile.mkdtemp(prefix="preamble-bench-")
+    try:
+        with open(os.path.join(work_dir, "tikz.tex"), "w", encoding="utf-8") as f:
+            f.write(latex_source)
+        start = time.perf_counter()
+        try:
+            result = subprocess.run(
+                ["lualatex", "-interaction=nonstopmode", "-halt-on-error", "--output-directory=.", "tikz.tex"],
+                cwd=work_dir, capture_output=True, text=True, timeout=timeout
+            )
+            elapsed = time.perf_counter() - start
+            success = result.returncode == 0 and os.path.exists(os.path.join(work_dir, "tikz.pdf"))
+            return success, elapsed, result.stdout + result.stderr
+        except subprocess.TimeoutExpired:
+            return False, time.perf_counter() - start, "timeout"
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def bench_one(tikz_code, timeout):
+    """Chạy cả 2 chiến lược cho một hình"""
+    packages, tikz_libs, pgfplots_libs = detect_required_packages(tikz_code)
+    try:
+        full_source = generate_latex_source(tikz_code, packages, tikz_libs, pgfplots_libs)
+        minimal_source = generate_minimal_latex_source(tikz_code, packages, tikz_libs, pgfplots_libs)
+    except ValueError:
+        full_source = TEX_TEMPLATE.replace("{tikz_code}", tikz_code)
+        minimal_source = None
+
+    full_ok, full_time, _ = run_lualatex(full_source, timeout)
+
+    fallback = False
+    if minimal_source is None:
+        minimal_ok, minimal_time = full_ok, full_time
+        fallback = True
+    else:
+        minimal_ok, minimal_time, output = run_lualatex(minimal_source, timeout)
+        if not minimal_ok and needs_full_preamble(output):
+            fallback = True
+            retry_ok, retry_time, _ = run_lualatex(full_source, timeout)
+            minimal_ok = retry_ok
+            minimal_time += retry_time
+
+    return {
+        'full': {'success': full_ok, 'seconds': round(full_time, 3)},
+        'minimal': {'success': minimal_ok, 'seconds': round(minimal_time, 3), 'fallback': fallback},
+    }
+
+
+def summarize(results, strategy):
+    times = [r[strategy]['seconds'] for r in results]
+    successes = sum(1 for r in results if r[strategy]['success'])
+    summary = {
+        'count': len(results),
+        'success_rate_percent': round(successes / max(1, len(results)) * 100, 2),
+        'mean_seconds': round(statistics.mean(times), 3) if times else 0,
+        'p50_seconds': round(statistics.median(times), 3) if times else 0,
+        'p95_seconds': round(sorted(times)[int(len(times) * 0.95) - 1], 3) if len(times) >= 20 else None,
+        'total_seconds': round(sum(times), 2),
+    }
+    if strategy == 'minimal':
+        summary['fallback_rate_percent'] = round(
+            sum(1 for r in results if r['minimal']['fallback']) / max(1, len(results)) * 100, 2
+        )
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark full vs minimal LaTeX preamble")
+    parser.add_argument('--limit', type=int, default=100, help="Số hình lấy từ svg_image")
+    parser.add_argument('--timeout', type=int, default=45, help="Timeout mỗi lần biên dịch (giây)")
+    parser.add_argument('--output', help="Ghi kết quả JSON ra file")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.limit)
+    print(f"📊 Benchmarking {len(corpus)} diagrams from svg_image...")
+
+    results = []
+    for index, row in enumerate(corpus, 1):
+        result = bench_one(row['tikz_code'], args.timeout)
+        result['svg_id'] = row['id']
+        results.append(result)
+        print(f"  [{index}/{len(corpus)}] #{row['id']}: "
+              f"full {result['full']['seconds']:.2f}s ({'ok' if result['full']['success'] else 'fail'}) | "
+              f"minimal {result['minimal']['seconds']:.2f}s ({'ok' if result['minimal']['success'] else 'fail'}"
+              f"{', fallback' if result['minimal']['fallback'] else ''})")
+
+    report = {
+        'generated_at': datetime.now().isoformat(),
+        'corpus_size': len(results),
+        'full': summarize(results, 'full'),
+        'minimal': summarize(results, 'minimal'),
+        'results': results,
+    }
+
+    print("=" * 60)
+    for strategy in ('full', 'minimal'):
+        print(f"{strategy:>8}: {json.dumps(report[strategy])}")
+    print("=" * 60)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(f"❌ ERROR: {e}")
+        sys.exit(1)
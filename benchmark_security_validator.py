@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Benchmark: LaTeXSecurityValidator một lượt (tex_security) vs vòng lặp regex cũ
+Đo thời gian trên các input đối kháng 50KB (backtracking .*\\{.*\\{.*, nhiều
+\\input{ không đóng, ...) và so sánh kết luận safe/unsafe trên code thật.
+
+Nguồn code thật (tuỳ chọn, để kiểm tra hai cách cho cùng kết luận):
+    --sql-dump FILE       bản dump mysqldump có INSERT INTO `svg_image`
+    --tex-dir DIR         thư mục *.tex (vd. error_tikz/)
+
+Usage:
+    python benchmark_security_validator.py --sql-dump tikz2svg_production_backup_20251004_085512.sql
+"""
+
+import re
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from datetime import datetime
+
+from tex_security import scan_tex_security, DANGEROUS_PATTERNS, MAX_CODE_BYTES
+from benchmark_cache_keys import load_from_sql_dump, load_from_tex_dir
+
+SIZES = (5000, 10000, 20000, 50000)
+LEGACY_TIMEOUT_SECONDS = 20
+
+
+def legacy_violation(tikz_code: str):
+    """Vòng lặp cũ: mỗi regex quét lại toàn bộ input (trước kiểm tra kích thước)"""
+    for pattern in DANGEROUS_PATTERNS:
+        if re.search(pattern, tikz_code, re.IGNORECASE | re.MULTILINE):
+            return pattern
+    return None
+
+
+def adversarial_inputs(size: int) -> dict:
+    """Các input cỡ size ký tự (một dòng) nhắm vào backtracking của regex cũ"""
+    return {
+        'pgfmathdeclfunction_two_braces': ("\\pgfmathdeclfunction{f}{" + "x" * size)[:size],
+        'tikzset_execute_no_begin': ("\\tikzset{execute=" * (size // 17))[:size],
+        'catcode_no_13': ("\\catcode=" * (size // 9))[:size],
+        'foreach_twice_per_line': ("\\foreach\\x in {1}" * 2 + " " + "x" * size)[:size],
+        'unclosed_input_args': ("\\input{a" * (size // 8))[:size],
+        'deep_braces': "{" * (size // 2) + "}" * (size // 2),
+        'plain_tikz': ("\\draw (0,0) -- (1,1);\n" * (size // 22 + 1))[:size],
+    }
+
+
+def _time_legacy(tikz_code: str, queue):
+    started = time.perf_counter()
+    legacy_violation(tikz_code)
+    queue.put(time.perf_counter() - started)
+
+
+def time_legacy(tikz_code: str, timeout: float):
+    """Seconds, or None when the regex loop did not finish within timeout"""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_time_legacy, args=(tikz_code, queue))
+    process.start()
+    process.join(timeout)
+    if process.is_alive():
+        process.terminate()
+        process.join()
+        return None
+    return queue.get()
+
+
+def time_scanner(tikz_code: str, repeat: int = 5) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        scan_tex_security(tikz_code, max_bytes=len(tikz_code))
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def compare_verdicts(submissions: list) -> dict:
+    """Cùng kết luận safe/unsafe? (input > 50KB bị chặn ở cả hai)"""
+    mismatches = []
+    for index, tikz_code in enumerate(submissions):
+        if len(tikz_code) > MAX_CODE_BYTES:
+            continue
+        legacy = legacy_violation(tikz_code)
+        scanned = scan_tex_security(tikz_code)['violation']
+        if (legacy is None) != (scanned is None):
+            mismatches.append({'index': index, 'legacy': legacy, 'single_pass': scanned,
+                               'excerpt': tikz_code[:200]})
+    return {'submissions': len(submissions), 'mismatches': len(mismatches), 'examples': mismatches[:10]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Single-pass vs regex-loop LaTeX security validation")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--sql-dump', help="File mysqldump chứa svg_image")
+    source.add_argument('--tex-dir', help="Thư mục chứa các file .tex")
+    parser.add_argument('--legacy-timeout', type=float, default=LEGACY_TIMEOUT_SECONDS)
+    parser.add_argument('--output', help="Ghi kết quả JSON ra file")
+    args = parser.parse_args()
+
+    report = {'generated_at': datetime.now().isoformat(), 'adversarial': {}}
+
+    print("=" * 72)
+    print(f"{'input':<32}{'size':>7}{'single-pass ms':>16}{'regex loop ms':>18}")
+    for size in SIZES:
+        for label, tikz_code in adversarial_inputs(size).items():
+            scanner_seconds = time_scanner(tikz_code)
+            legacy_seconds = time_legacy(tikz_code, args.legacy_timeout)
+            legacy_text = f"{legacy_seconds * 1000:.1f}" if legacy_seconds is not None else f">{args.legacy_timeout * 1000:.0f}"
+            print(f"{label:<32}{size:>7}{scanner_seconds * 1000:>16.2f}{legacy_text:>18}")
+            report['adversarial'].setdefault(label, []).append({
+                'size': size,
+                'single_pass_ms': round(scanner_seconds * 1000, 3),
+                'regex_loop_ms': round(legacy_seconds * 1000, 3) if legacy_seconds is not None else None
+            })
+    print("=" * 72)
+
+    if args.sql_dump or args.tex_dir:
+        submissions = load_from_sql_dump(args.sql_dump) if args.sql_dump else load_from_tex_dir(args.tex_dir)
+        report['verdicts'] = compare_verdicts(submissions)
+        print(f"verdicts: {json.dumps(report['verdicts'], ensure_ascii=False)[:2000]}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(f"❌ ERROR: {e}")
+        sys.exit(1)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Benchmark: PDF -> pdf2svg vs DVI -> dvisvgm
+So sánh thời gian (LaTeX + chuyển đổi) và kích thước SVG của 2 pipeline
+trên một tập TikZ cố định (pdfLaTeX route, vì dvisvgm chỉ dùng cho route này).
+
+Usage:
+    python benchmark_svg_pipelines.py --repeat 3 --output svg_pipeline_benchmark_results.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime
+
+from app import (
+    build_compile_source,
+    detect_required_packages,
+    adapt_source_for_dvisvgm,
+    run_dvisvgm,
+    DVI_ENGINES,
+)
+
+# Tập TikZ cố định: hình đơn giản, hình học, đồ thị, nhiều chữ, tô bóng
+CORPUS = {
+    'lines': r"""
+\begin{tikzpicture}
+\draw (0,0) -- (2,0) -- (1,1.5) -- cycle;
+\end{tikzpicture}
+""",
+    'grid_axes': r"""
+\begin{tikzpicture}
+\draw[step=0.5,gray!40,very thin] (-2,-2) grid (2,2);
+\draw[->] (-2.2,0) -- (2.2,0) node[right] {$x$};
+\draw[->] (0,-2.2) -- (0,2.2) node[above] {$y$};
+\draw[blue,thick,domain=-1.5:1.5,samples=60] plot (\x,{\x*\x-1});
+\end{tikzpicture}
+""",
+    'geometry_labels': r"""
+\begin{tikzpicture}
+\coordinate[label=left:$A$] (A) at (0,0);
+\coordinate[label=right:$B$] (B) at (4,0);
+\coordinate[label=above:$C$] (C) at (1.5,3);
+\draw[thick] (A) -- (B) -- (C) -- cycle;
+\draw[dashed] (C) -- ($(A)!(C)!(B)$) node[below] {$H$};
+\draw (A) circle (0.3);
+\end{tikzpicture}
+""",
+    'pgfplots_axis': r"""
+\begin{tikzpicture}
+\begin{axis}[xlabel={$x$}, ylabel={$f(x)$}, grid=major]
+\addplot[domain=-3:3, samples=100, red] {sin(deg(x))};
+\addplot[domain=-3:3, samples=100, blue] {cos(deg(x))};
+\end{axis}
+\end{tikzpicture}
+""",
+    'many_nodes': r"""
+\begin{tikzpicture}
+\foreach \i in {0,...,9} {
+  \foreach \j in {0,...,4} {
+    \node[draw,circle,inner sep=1pt] at (\i,\j) {\small $a_{\i\j}$};
+  }
+}
+\end{tikzpicture}
+""",
+    'shading': r"""
+\begin{tikzpicture}
+\shade[ball color=blue!60] (0,0) circle (1);
+\shade[left color=red, right color=yellow] (2,-1) rectangle (4,1);
+\end{tikzpicture}
+""",
+}
+
+
+def timed(cmd, cwd, timeout):
+    start = time.perf_counter()
+    result = subprocess.run(cmd, cwd=cwd, capture_output=True, text=True, timeout=timeout)
+    return result.returncode == 0, time.perf_counter() - start
+
+
+def run_pipeline(tikz_code, pipeline, font_mode, timeout):
+    """Biên dịch một hình theo pipeline, trả về dict kết quả"""
+    packages, tikz_libs, pgfplots_libs = detect_required_packages(tikz_code)
+    latex_source = build_compile_source(tikz_code, packages, tikz_libs, pgfplots_libs, engine='pdflatex', strategy='full')
+    work_dir = tempfile.mkdtemp(prefix="svg-bench-")
+    try:
+        if pipeline == 'dvisvgm':
+            latex_source = adapt_source_for_dvisvgm(latex_source)
+            engine = DVI_ENGINES['pdflatex']
+        else:
+            engine = 'pdflatex'
+
+        with open(os.path.join(work_dir, "tikz.tex"), "w", encoding="utf-8") as f:
+            f.write(latex_source)
+
+        latex_ok, latex_time = timed(
+            [engine, "-interaction=nonstopmode", "-halt-on-error", "--output-directory=.", "tikz.tex"],
+            work_dir, timeout
+        )
+        if not latex_ok:
+            return {'success': False, 'latex_seconds': round(latex_time, 3)}
+
+        start = time.perf_counter()
+        try:
+            if pipeline == 'dvisvgm':
+                run_dvisvgm(work_dir, font_mode=font_mode)
+            else:
+                subprocess.run(["pdf2svg", "tikz.pdf", "tikz.svg"], cwd=work_dir, check=True, timeout=15,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            return {'success': False, 'latex_seconds': round(latex_time, 3)}
+        convert_time = time.perf_counter() - start
+
+        svg_path = os.path.join(work_dir, "tikz.svg")
+        return {
+            'success': os.path.exists(svg_path),
+            'latex_seconds': round(latex_time, 3),
+            'convert_seconds': round(convert_time, 3),
+            'total_seconds': round(latex_time + convert_time, 3),
+            'svg_bytes': os.path.getsize(svg_path) if os.path.exists(svg_path) else 0,
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pdf2svg vs dvisvgm")
+    parser.add_argument('--repeat', type=int, default=3, help="Số lần chạy mỗi hình")
+    parser.add_argument('--timeout', type=int, default=45, help="Timeout LaTeX (giây)")
+    parser.add_argument('--output', help="Ghi kết quả JSON ra file")
+    args = parser.parse_args()
+
+    variants = [('pdf2svg', None), ('dvisvgm', 'paths'), ('dvisvgm', 'woff2')]
+    report = {'generated_at': datetime.now().isoformat(), 'repeat': args.repeat, 'diagrams': {}, 'summary': {}}
+
+    for name, tikz_code in CORPUS.items():
+        report['diagrams'][name] = {}
+        for pipeline, font_mode in variants:
+            label = pipeline if not font_mode else f"{pipeline}-{font_mode}"
+            runs = [run_pipeline(tikz_code, pipeline, font_mode, args.timeout) for _ in range(args.repeat)]
+            ok_runs = [r for r in runs if r['success']]
+            report['diagrams'][name][label] = {
+                'success': len(ok_runs) == len(runs),
+                'median_total_seconds': round(statistics.median(r['total_seconds'] for r in ok_runs), 3) if ok_runs else None,
+                'svg_bytes': ok_runs[0]['svg_bytes'] if ok_runs else None,
+            }
+            result = report['diagrams'][name][label]
+            print(f"  {name:<16} {label:<14} "
+                  f"{'ok' if result['success'] else 'FAIL':<5} "
+                  f"{result['median_total_seconds'] or 0:>7.3f}s {result['svg_bytes'] or 0:>9} bytes")
+
+    for pipeline, font_mode in variants:
+        label = pipeline if not font_mode else f"{pipeline}-{font_mode}"
+        results = [d[label] for d in report['diagrams'].values() if d[label]['success']]
+        report['summary'][label] = {
+            'succeeded': len(results),
+            'total_seconds': round(sum(r['median_total_seconds'] for r in results), 3),
+            'total_svg_bytes': sum(r['svg_bytes'] for r in results),
+        }
+
+    print("=" * 60)
+    for label, summary in report['summary'].items():
+        print(f"{label:<14}: {json.dumps(summary)}")
+    print("=" * 60)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(f"❌ ERROR: {e}")
+        sys.exit(1)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Benchmark: pre-check cú pháp TeX (tex_syntax) trước khi biên dịch
+- code thật (đã biên dịch thành công): số lần báo lỗi nhầm và thời gian kiểm tra
+- biến thể hỏng sinh từ code thật (xoá một }, xoá \\end{...}, xoá một $, ...):
+  tỉ lệ bị chặn trước LaTeX theo từng kiểu hỏng
+
+Nguồn code thật (chọn một):
+    --sql-dump FILE       bản dump mysqldump có INSERT INTO `svg_image`
+    --tex-dir DIR         thư mục *.tex (vd. error_tikz/)
+
+Usage:
+    python benchmark_syntax_precheck.py --sql-dump tikz2svg_production_backup_20251004_085512.sql
+"""
+
+import re
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import datetime
+
+from tex_syntax import check_tex_syntax
+from benchmark_cache_keys import load_from_sql_dump, load_from_tex_dir
+
+
+def _drop_one(pattern: str):
+    """Mutation: delete one random match of pattern"""
+    def mutate(tikz_code: str, rng: random.Random):
+        matches = list(re.finditer(pattern, tikz_code))
+        if not matches:
+            return None
+        match = rng.choice(matches)
+        return tikz_code[:match.start()] + tikz_code[match.end():]
+    return mutate
+
+
+MUTATIONS = {
+    'drop_close_brace': _drop_one(r'(?<!\\)\}'),
+    'drop_open_brace': _drop_one(r'(?<!\\)\{'),
+    'drop_end_environment': _drop_one(r'\\end\{[^}]*\}'),
+    'drop_dollar': _drop_one(r'(?<!\\)\$'),
+    'drop_option_close': _drop_one(r'(?<=\\draw\[)[^\]]*\]'),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TeX syntax pre-check: false positives, detection rate, timing")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--sql-dump', help="File mysqldump chứa svg_image")
+    source.add_argument('--tex-dir', help="Thư mục chứa các file .tex")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="Ghi kết quả JSON ra file")
+    args = parser.parse_args()
+
+    submissions = load_from_sql_dump(args.sql_dump) if args.sql_dump else load_from_tex_dir(args.tex_dir)
+    rng = random.Random(args.seed)
+    report = {'generated_at': datetime.now().isoformat(), 'submissions': len(submissions)}
+
+    timings = []
+    flagged = []
+    for index, tikz_code in enumerate(submissions):
+        started = time.perf_counter()
+        errors = check_tex_syntax(tikz_code)
+        timings.append(time.perf_counter() - started)
+        if errors:
+            flagged.append({'index': index, 'errors': errors[:2], 'excerpt': tikz_code[:200]})
+    timings.sort()
+    report['valid_code'] = {
+        'flagged': len(flagged),
+        'examples': flagged[:10],
+        'median_ms': round(timings[len(timings) // 2] * 1000, 3) if timings else 0,
+        'max_ms': round(timings[-1] * 1000, 3) if timings else 0,
+        'total_chars': sum(len(code) for code in submissions)
+    }
+
+    report['mutations'] = {}
+    for label, mutate in MUTATIONS.items():
+        mutated = [m for m in (mutate(code, rng) for code in submissions) if m is not None]
+        caught = sum(1 for code in mutated if check_tex_syntax(code))
+        report['mutations'][label] = {'cases': len(mutated), 'caught': caught,
+                                      'rate': round(caught / max(1, len(mutated)), 3)}
+
+    print("=" * 72)
+    print(f"valid code: {report['valid_code']['flagged']} flagged of {len(submissions)}, "
+          f"median {report['valid_code']['median_ms']} ms, max {report['valid_code']['max_ms']} ms")
+    for label, result in report['mutations'].items():
+        print(f"{label:<24}{result['caught']:>5}/{result['cases']:<5}{result['rate'] * 100:>7.1f}%")
+    print("=" * 72)
+    if flagged:
+        print(f"false positives: {json.dumps(flagged[:3], ensure_ascii=False)[:2000]}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(f"❌ ERROR: {e}")
+        sys.exit(1)
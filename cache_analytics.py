@@ -0,0 +1,190 @@
+"""
+Compile-Key Analytics
+=====================
+Streaming, fixed-memory statistics over CompilationCache lookups, so hot
+snippets and the working-set size are visible without logging every
+submission.
+
+- CountMinSketch: approximate per-key request and miss counts
+  (depth x width counters; over-estimates by at most ~e/width of the total
+  with probability 1 - e^-depth)
+- HyperLogLog: approximate number of distinct keys (working set)
+- HotKeyTracker: the two sketches plus a top-K min-heap of the most requested
+  keys; only those K keys keep a code sample (for the admin view and warm-up)
+- counters are halved every decay_every lookups, so the view follows recent
+  traffic instead of all-time totals
+
+Keys are SHA256 hex digests: the sketches slice them for their hash values
+instead of hashing again.
+"""
+
+import math
+import heapq
+import threading
+from array import array
+
+SAMPLE_MAX_CHARS = 20000
+
+
+class CountMinSketch:
+    """depth rows of width counters; estimate = min over rows"""
+
+    def __init__(self, width: int = 4096, depth: int = 4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('L', [0]) * width for _ in range(depth)]
+
+    def _columns(self, key: str):
+        # Row i uses hex digits [8i, 8i+8) of the SHA256 key
+        return [int(key[8 * i:8 * i + 8], 16) % self.width for i in range(self.depth)]
+
+    def add(self, key: str, count: int = 1) -> int:
+        """Add count and return the new estimate"""
+        estimate = None
+        for row, column in zip(self.rows, self._columns(key)):
+            row[column] += count
+            estimate = row[column] if estimate is None else min(estimate, row[column])
+        return estimate
+
+    def estimate(self, key: str) -> int:
+        return min(row[column] for row, column in zip(self.rows, self._columns(key)))
+
+    def halve(self):
+        for row in self.rows:
+            for column in range(self.width):
+                row[column] >>= 1
+
+
+class HyperLogLog:
+    """2^precision one-byte registers (4KB at precision 12, ~1.6% standard error)"""
+
+    def __init__(self, precision: int = 12):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+    def add(self, key: str):
+        value = int(key[32:48], 16)            # 64 bits not used by the count-min rows
+        index = value >> (64 - self.precision)
+        rest = value & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size ** 2 / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.size and zeros:
+            estimate = self.size * math.log(self.size / zeros)   # linear counting for small sets
+        return int(estimate)
+
+    def clear(self):
+        self.registers = bytearray(self.size)
+
+
+class HotKeyTracker:
+    """Per-key request/miss frequencies, top-K hot keys and working-set size"""
+
+    def __init__(self, top_k: int = 50, width: int = 4096, depth: int = 4, decay_every: int = 100000):
+        self.top_k = top_k
+        self.decay_every = decay_every
+        self.requests = CountMinSketch(width, depth)
+        self.misses = CountMinSketch(width, depth)
+        self.distinct = HyperLogLog()
+        self.lock = threading.Lock()
+
+        self.top = {}            # key -> {'count', 'sample'}; at most top_k entries
+        self.heap = []           # (count, key) min-heap over self.top, stale entries skipped lazily
+        self.total = 0
+        self.total_misses = 0
+        self.since_decay = 0
+
+    def record(self, key: str, hit: bool, tikz_code: str = None):
+        """Count one cache lookup for key"""
+        with self.lock:
+            count = self.requests.add(key)
+            if not hit:
+                self.misses.add(key)
+                self.total_misses += 1
+            self.distinct.add(key)
+            self.total += 1
+
+            if key in self.top:
+                self.top[key]['count'] = count
+                heapq.heappush(self.heap, (count, key))
+                if len(self.heap) > 4 * self.top_k:
+                    self._rebuild_heap()
+            elif len(self.top) < self.top_k or count > self._min_top_count():
+                if len(self.top) >= self.top_k:
+                    _, evicted = heapq.heappop(self.heap)
+                    del self.top[evicted]
+                sample = tikz_code if tikz_code and len(tikz_code) <= SAMPLE_MAX_CHARS else ''   # whole code or none: samples get recompiled
+                self.top[key] = {'count': count, 'sample': sample}
+                heapq.heappush(self.heap, (count, key))
+
+            self.since_decay += 1
+            if self.since_decay >= self.decay_every:
+                self._decay()
+
+    def _min_top_count(self) -> int:
+        """Smallest current count in the top-K (drops stale heap entries)"""
+        while self.heap:
+            count, key = self.heap[0]
+            if key in self.top and self.top[key]['count'] == count:
+                return count
+            heapq.heappop(self.heap)
+        return 0
+
+    def _decay(self):
+        self.requests.halve()
+        self.misses.halve()
+        self.distinct.clear()    # working set = distinct keys since the last decay
+        for entry in self.top.values():
+            entry['count'] >>= 1
+        self._rebuild_heap()
+        self.since_decay = 0
+
+    def _rebuild_heap(self):
+        self.heap = [(entry['count'], key) for key, entry in self.top.items()]
+        heapq.heapify(self.heap)
+
+    def hot_keys(self, limit: int = None) -> list:
+        """Top keys by estimated requests: [{'key', 'requests', 'misses', 'miss_ratio', 'sample'}]"""
+        with self.lock:
+            ranked = sorted(self.top.items(), key=lambda item: item[1]['count'], reverse=True)[:limit or self.top_k]
+            result = []
+            for key, entry in ranked:
+                requests = max(1, self.requests.estimate(key))
+                misses = min(requests, self.misses.estimate(key))
+                result.append({
+                    'key': key,
+                    'requests': requests,
+                    'misses': misses,
+                    'miss_ratio': round(misses / requests, 3),
+                    'sample': entry['sample']
+                })
+            return result
+
+    def get_stats(self, limit: int = 20, sample_chars: int = 120) -> dict:
+        hot = self.hot_keys(limit)
+        with self.lock:
+            total, total_misses = self.total, self.total_misses
+            working_set = self.distinct.count()
+            window_requests = sum(self.requests.rows[0])   # every lookup lands in exactly one column per row
+        top_requests = sum(entry['requests'] for entry in hot)
+        return {
+            'lookups': total,
+            'miss_ratio': round(total_misses / max(1, total), 3),
+            'working_set_keys': working_set,
+            'top_share_percent': round(min(top_requests, window_requests) / max(1, window_requests) * 100, 2),
+            'hot_keys': [
+                {**entry, 'key': entry['key'][:16], 'sample': entry['sample'][:sample_chars]}
+                for entry in hot
+            ],
+            # Keys requested repeatedly but still missing: evicted too early or failing
+            'churning_keys': [
+                {'key': entry['key'][:16], 'requests': entry['requests'], 'miss_ratio': entry['miss_ratio']}
+                for entry in hot if entry['requests'] >= 3 and entry['miss_ratio'] >= 0.5
+            ]
+        }
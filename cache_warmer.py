@@ -0,0 +1,197 @@
+"""
+Compilation Cache Warmer
+========================
+Background job that recompiles popular and recently saved gallery diagrams
+after a deploy, so the shared cache tiers are warm before visitors re-open
+them in the editor.
+
+- candidates come from fetch_candidates(limit) (most-liked and most recently
+  saved svg_image.tikz_code rows); items already in the cache return at once
+- one warmer per host: the background thread only starts in the process
+  holding the leader lock (the compile daemon when there is one, otherwise
+  the first gunicorn worker to get it; another takes over when it exits), and
+  runs are guarded by an fcntl lock and a shared state file, so recycled
+  workers and forced runs do not warm again within interval_seconds
+- compiles go through the batch lane of the compile scheduler and only start
+  while the system load level is 'low'; if it does not drop within
+  idle_wait_seconds the run stops
+- a run stops once its own compiles have used cpu_budget_seconds of CPU,
+  measured by cpu_meter (LaTeXSandbox.cpu_meter: wait4() rusage of the runs
+  made on the warmer thread, so user compiles in the same worker do not count)
+- work dirs come from the compile workspace allocator when one is given
+"""
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import logging
+import tempfile
+import threading
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATE_DIR = "/dev/shm/tikz_cache_warmer" if os.path.isdir("/dev/shm") else "/tmp/tikz_cache_warmer"
+
+IDLE_POLL_SECONDS = 5
+LEADER_RETRY_SECONDS = 60
+WARMER_USER_ID = "cache-warmer"     # user_id of warm-up compiles (not counted as package usage)
+
+
+class CacheWarmer:
+    """Host-wide, low-priority warm-up of the compilation cache"""
+
+    def __init__(self, fetch_candidates: Callable, compile_func: Callable, load_level: Callable,
+                 cpu_meter: Callable, state_dir: str = DEFAULT_STATE_DIR, max_items: int = 50,
+                 cpu_budget_seconds: float = 120, start_delay_seconds: int = 60, interval_seconds: int = 6 * 3600,
+                 idle_wait_seconds: int = 600, enabled: bool = True, workspaces=None):
+        self.fetch_candidates = fetch_candidates      # (limit) -> [tikz_code, ...] in priority order
+        self.compile_func = compile_func              # (tikz_code, work_dir) -> (ok, svg, error)
+        self.load_level = load_level                  # () -> 'low' | 'medium' | 'high'
+        self.cpu_meter = cpu_meter                    # () -> context manager yielding {'cpu_seconds'}
+        self.workspaces = workspaces                  # WorkspaceAllocator (tmpfs root, quota); None = mkdtemp
+        self.state_dir = state_dir
+        self.max_items = max_items
+        self.cpu_budget_seconds = cpu_budget_seconds
+        self.start_delay_seconds = start_delay_seconds
+        self.interval_seconds = interval_seconds      # 0 = warm once per host boot (state on tmpfs)
+        self.idle_wait_seconds = idle_wait_seconds
+        self.enabled = enabled and max_items > 0
+
+        self.lock = threading.Lock()
+        self._started_pid = None
+        self._leader_file = None                      # held open for the life of the leader process
+        self._next_election = 0.0
+        self.running = False
+        self.last_report = None
+
+        os.makedirs(self.state_dir, exist_ok=True)
+        self.state_path = os.path.join(self.state_dir, "state.json")
+        self.lock_path = os.path.join(self.state_dir, "warmer.lock")
+        self.leader_path = os.path.join(self.state_dir, "leader.lock")
+
+    def _take_leadership(self) -> bool:
+        """Non-blocking leader lock; released by the kernel when this process exits"""
+        leader_file = open(self.leader_path, "a")
+        try:
+            fcntl.flock(leader_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            leader_file.close()
+            return False
+        self._leader_file = leader_file
+        return True
+
+    def ensure_started(self):
+        """Start the background thread in the leader process only (cheap to call on every request)"""
+        if not self.enabled or self._started_pid == os.getpid() or time.time() < self._next_election:
+            return
+        with self.lock:
+            if self._started_pid == os.getpid() or time.time() < self._next_election:
+                return
+            self._next_election = time.time() + LEADER_RETRY_SECONDS
+            if not self._take_leadership():
+                return
+            self._started_pid = os.getpid()
+        threading.Thread(target=self._loop, name="cache-warmer", daemon=True).start()
+
+    def _loop(self):
+        time.sleep(self.start_delay_seconds)
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Cache warm-up failed")
+            if not self.interval_seconds:
+                return
+            time.sleep(max(60, self.interval_seconds // 4))   # re-check; the state file decides if a run is due
+
+    def _load_state(self) -> dict:
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, state: dict):
+        tmp_path = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _wait_for_idle(self) -> bool:
+        deadline = time.time() + self.idle_wait_seconds
+        while self.load_level() != 'low':
+            if time.time() >= deadline:
+                return False
+            time.sleep(IDLE_POLL_SECONDS)
+        return True
+
+    def run_once(self, force: bool = False) -> Optional[dict]:
+        """Warm the cache unless another process holds the lock or a run is not due; returns the report"""
+        with open(self.lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None   # another worker is warming
+            try:
+                state = self._load_state()
+                last_run_at = state.get('last_run_at')
+                if not force and last_run_at and (not self.interval_seconds or time.time() - last_run_at < self.interval_seconds):
+                    return None
+                report = self._warm()
+                self._save_state({'last_run_at': time.time(), 'last_report': report})
+                return report
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _warm(self) -> dict:
+        self.running = True
+        report = {'started_at': time.time(), 'candidates': 0, 'compiled': 0, 'failed': 0,
+                  'cpu_seconds': 0.0, 'stopped': None}
+        try:
+            candidates = self.fetch_candidates(self.max_items)
+            report['candidates'] = len(candidates)
+            with self.cpu_meter() as meter:
+                for tikz_code in candidates:
+                    if meter['cpu_seconds'] >= self.cpu_budget_seconds:
+                        report['stopped'] = 'cpu_budget'
+                        break
+                    if not self._wait_for_idle():
+                        report['stopped'] = 'system_busy'
+                        break
+                    work_dir = self.workspaces.create() if self.workspaces else tempfile.mkdtemp(prefix="tikz_warm_")
+                    try:
+                        success, _, _ = self.compile_func(tikz_code, work_dir)
+                        report['compiled' if success else 'failed'] += 1
+                    except Exception as e:
+                        # Shed by the scheduler or crashed: user traffic wins, stop this run
+                        logger.info(f"Cache warm-up stopped: {e}")
+                        report['stopped'] = 'compile_error'
+                        break
+                    finally:
+                        if self.workspaces:
+                            self.workspaces.release(work_dir)
+                        else:
+                            shutil.rmtree(work_dir, ignore_errors=True)
+            report['cpu_seconds'] = round(meter['cpu_seconds'], 2)
+        finally:
+            report['finished_at'] = time.time()
+            self.running = False
+            self.last_report = report
+        logger.info(f"Cache warm-up finished: {report}")
+        return report
+
+    def get_stats(self) -> dict:
+        state = self._load_state()
+        return {
+            'enabled': self.enabled,
+            'running_here': self.running,
+            'leader_here': self._started_pid == os.getpid(),
+            'max_items': self.max_items,
+            'cpu_budget_seconds': self.cpu_budget_seconds,
+            'interval_seconds': self.interval_seconds,
+            'last_run_at': state.get('last_run_at'),
+            'last_report': state.get('last_report') or self.last_report
+        }
@@ -0,0 +1,330 @@
+"""
+Shared Compilation Cache Tiers
+==============================
+Lower tiers behind the in-process CompilationCache (L1):
+
+- L2 SharedFileCache: content-addressed SVG files (<root>/<key[:2]>/<key>.svg)
+  on tmpfs (/dev/shm) or disk, shared by every gunicorn worker and surviving
+  worker recycles (and reboots when on disk). LRU by file mtime, bounded by
+  max_size_mb; the size check runs in a background thread (at most every
+  evict_interval_seconds), tag markers of evicted files are swept with it.
+- L3 RedisCache (optional): shared across hosts, expiry by TTL.
+
+Every tier has the same interface: get(key) -> str | None,
+set(key, svg, tags), purge_tags(tags) -> int, list_tags() -> list, clear(),
+get_stats(). Tags ('package:circuitikz', 'template:<hash>', ...) are indexed
+per tier so a purge only touches the matching entries. Tier errors never fail
+a compile: they count as misses.
+"""
+
+import os
+import time
+import shutil
+from urllib.parse import quote, unquote
+import logging
+import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_L2_DIR = "/dev/shm/tikz_cache" if os.path.isdir("/dev/shm") else "/tmp/tikz_cache"
+
+
+class SharedFileCache:
+    """L2: content-addressed files shared by all processes on the host"""
+
+    name = 'l2_files'
+
+    def __init__(self, root: str = DEFAULT_L2_DIR, max_size_mb: int = 256, evict_interval_seconds: float = 30):
+        self.root = root
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self.evict_interval_seconds = evict_interval_seconds
+        self.lock = threading.Lock()
+        self.last_evict_check = 0.0
+        self.evicting = False
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0, 'errors': 0}
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.svg")
+
+    def _tag_dir(self, tag: str) -> str:
+        """<root>/tags/<tag>/ holds one empty marker file per tagged key"""
+        return os.path.join(self.root, "tags", quote(tag, safe=''))
+
+    def _mark(self, tag: str, key: str):
+        tag_dir = self._tag_dir(tag)
+        for _ in range(2):
+            os.makedirs(tag_dir, exist_ok=True)
+            try:
+                open(os.path.join(tag_dir, key), "a").close()
+                return
+            except FileNotFoundError:
+                continue   # emptied tag dir removed by _sweep_tags in between
+        raise FileNotFoundError(tag_dir)
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                svg_content = f.read()
+            os.utime(path, None)   # mtime = last access, the LRU clock for eviction
+        except FileNotFoundError:
+            with self.lock:
+                self.stats['misses'] += 1
+            return None
+        except OSError as e:
+            logger.warning(f"L2 cache read failed for {key}: {e}")
+            with self.lock:
+                self.stats['errors'] += 1
+            return None
+        with self.lock:
+            self.stats['hits'] += 1
+        return svg_content
+
+    def set(self, key: str, svg_content: str, tags: list = ()):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(svg_content)
+            os.replace(tmp_path, path)   # readers never see a partial file
+            for tag in tags:
+                self._mark(tag, key)
+        except OSError as e:
+            logger.warning(f"L2 cache write failed for {key}: {e}")
+            with self.lock:
+                self.stats['errors'] += 1
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        with self.lock:
+            self.stats['writes'] += 1
+        self._maybe_evict()
+
+    def _maybe_evict(self):
+        """Size check off the request path: at most one background scan per evict_interval_seconds"""
+        now = time.monotonic()
+        with self.lock:
+            if self.evicting or now - self.last_evict_check < self.evict_interval_seconds:
+                return
+            self.evicting = True
+            self.last_evict_check = now
+        threading.Thread(target=self._evict_in_background, name="l2-cache-evict", daemon=True).start()
+
+    def _evict_in_background(self):
+        try:
+            self._evict()
+        except Exception as e:
+            logger.warning(f"L2 cache eviction failed: {e}")
+        finally:
+            with self.lock:
+                self.evicting = False
+
+    def purge_tags(self, tags: list) -> int:
+        """Remove every entry carrying any of tags; returns the number of SVG files removed"""
+        purged = 0
+        for tag in tags:
+            tag_dir = self._tag_dir(tag)
+            try:
+                keys = os.listdir(tag_dir)
+            except FileNotFoundError:
+                continue
+            for key in keys:
+                try:
+                    os.remove(self._path(key))
+                    purged += 1
+                except OSError:
+                    pass   # already evicted or purged through another tag
+            shutil.rmtree(tag_dir, ignore_errors=True)
+        if purged:
+            self._sweep_tags()   # the purged keys' markers under their other tags
+        return purged
+
+    def list_tags(self) -> list:
+        try:
+            return [unquote(name) for name in os.listdir(os.path.join(self.root, "tags"))]
+        except FileNotFoundError:
+            return []
+
+    def _scan(self) -> list:
+        """[(mtime, size, path)] of all cached files"""
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if dirpath == self.root and "tags" in dirnames:
+                dirnames.remove("tags")
+            for name in filenames:
+                if not name.endswith(".svg"):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict(self):
+        """Remove least recently used files until under 90% of the budget"""
+        entries = self._scan()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_size_bytes:
+            return
+        target = self.max_size_bytes * 0.9
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                evicted += 1
+            except OSError:
+                pass
+        with self.lock:
+            self.stats['evictions'] += evicted
+        self._sweep_tags()
+
+    def _sweep_tags(self):
+        """Drop tag markers whose SVG is gone (evicted, or purged through another tag) and empty tag dirs"""
+        tags_root = os.path.join(self.root, "tags")
+        try:
+            tag_names = os.listdir(tags_root)
+        except FileNotFoundError:
+            return
+        for tag_name in tag_names:
+            tag_dir = os.path.join(tags_root, tag_name)
+            try:
+                keys = os.listdir(tag_dir)
+            except OSError:
+                continue
+            for key in keys:
+                if not os.path.exists(self._path(key)):
+                    try:
+                        os.remove(os.path.join(tag_dir, key))
+                    except OSError:
+                        pass
+            try:
+                os.rmdir(tag_dir)   # only succeeds when empty
+            except OSError:
+                pass
+
+    def clear(self):
+        for _, _, path in self._scan():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        shutil.rmtree(os.path.join(self.root, "tags"), ignore_errors=True)
+
+    def get_stats(self) -> dict:
+        entries = self._scan()
+        with self.lock:
+            return {
+                'tier': self.name,
+                'root': self.root,
+                'entries_count': len(entries),
+                'size_mb': round(sum(size for _, size, _ in entries) / (1024 * 1024), 2),
+                'max_size_mb': round(self.max_size_bytes / (1024 * 1024), 2),
+                **self.stats
+            }
+
+
+class RedisCache:
+    """L3: optional Redis tier (shared across hosts, TTL expiry)"""
+
+    name = 'l3_redis'
+
+    def __init__(self, url: str, ttl_seconds: int = 7 * 24 * 3600, prefix: str = "tikz:svg:",
+                 socket_timeout: float = 0.5, retry_after_error_seconds: int = 30):
+        import redis   # optional dependency, only needed when TIKZ_CACHE_REDIS_URL is set
+
+        self.client = redis.Redis.from_url(url, socket_timeout=socket_timeout, socket_connect_timeout=socket_timeout)
+        self.url = url
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+        self.retry_after_error_seconds = retry_after_error_seconds
+        self.down_until = 0.0        # skip Redis for a while after an error instead of stalling compiles
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'errors': 0}
+
+    def _available(self) -> bool:
+        return time.time() >= self.down_until
+
+    def _failed(self, action: str, e: Exception):
+        logger.warning(f"L3 Redis cache {action} failed: {e}")
+        with self.lock:
+            self.stats['errors'] += 1
+            self.down_until = time.time() + self.retry_after_error_seconds
+
+    def get(self, key: str) -> Optional[str]:
+        if not self._available():
+            return None
+        try:
+            value = self.client.get(self.prefix + key)
+        except Exception as e:
+            self._failed('get', e)
+            return None
+        with self.lock:
+            self.stats['hits' if value is not None else 'misses'] += 1
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key: str, svg_content: str, tags: list = ()):
+        if not self._available():
+            return
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.set(self.prefix + key, svg_content.encode("utf-8"), ex=self.ttl_seconds)
+            for tag in tags:
+                # Tag sets live as long as their newest member
+                pipe.sadd(self.prefix + "tag:" + tag, key)
+                pipe.expire(self.prefix + "tag:" + tag, self.ttl_seconds)
+            pipe.execute()
+        except Exception as e:
+            self._failed('set', e)
+            return
+        with self.lock:
+            self.stats['writes'] += 1
+
+    def purge_tags(self, tags: list) -> int:
+        purged = 0
+        try:
+            for tag in tags:
+                tag_key = self.prefix + "tag:" + tag
+                keys = [self.prefix + member.decode("utf-8") for member in self.client.smembers(tag_key)]
+                for start in range(0, len(keys), 500):
+                    purged += self.client.delete(*keys[start:start + 500])
+                self.client.delete(tag_key)
+        except Exception as e:
+            self._failed('purge', e)
+        return purged
+
+    def list_tags(self) -> list:
+        try:
+            return [key.decode("utf-8")[len(self.prefix) + 4:]
+                    for key in self.client.scan_iter(match=self.prefix + "tag:*", count=500)]
+        except Exception as e:
+            self._failed('list_tags', e)
+            return []
+
+    def clear(self):
+        try:
+            keys = list(self.client.scan_iter(match=self.prefix + "*", count=500))
+            for start in range(0, len(keys), 500):
+                self.client.delete(*keys[start:start + 500])
+        except Exception as e:
+            self._failed('clear', e)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                'tier': self.name,
+                'url': self.url.split('@')[-1],   # never expose credentials
+                'available': self._available(),
+                'ttl_seconds': self.ttl_seconds,
+                **self.stats
+            }
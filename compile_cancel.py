@@ -0,0 +1,158 @@
+"""
+Cancellable Compile Sessions
+============================
+Live preview re-submits the code on every pause in typing, so one editor can
+have several compiles in flight, of which only the newest will ever be shown.
+Each request is tagged with a client session id (one per editor tab):
+
+- begin() stores a fresh token as the session's latest request; every older
+  compile of the same (user, session) now sees a different token and is
+  superseded
+- cancel() (POST /api/compile/cancel) replaces the token without starting a
+  compile, so the editor can drop stale work explicitly
+- compiles poll cancelled_check(): the slot queue (HostCompileSlots.acquire)
+  stops waiting, the sandbox kills the LaTeX process group, and the compile
+  raises CompilationCancelled so the caller releases its workspace
+
+Tokens are small files in a shared directory (tmpfs by default), one per
+session, so a newer request handled by another gunicorn worker or by the
+compile daemon still reaches the older compile. A missing file means "no
+newer request": cancellation never fires by accident after a sweep.
+"""
+
+import os
+import re
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SESSIONS_DIR = "/dev/shm/tikz_sessions" if os.path.isdir("/dev/shm") else "/tmp/tikz_sessions"
+
+SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+SWEEP_INTERVAL_SECONDS = 60
+
+
+class CompilationCancelled(Exception):
+    """A newer request (or an explicit cancel) superseded this compile"""
+
+
+def valid_session_id(session_id) -> bool:
+    return isinstance(session_id, str) and bool(SESSION_ID_RE.match(session_id))
+
+
+class CompileSessions:
+    """Latest-request token per (user, session) in a shared directory"""
+
+    def __init__(self, state_dir: str = DEFAULT_SESSIONS_DIR, session_ttl_seconds: int = 3600):
+        self.state_dir = state_dir
+        self.session_ttl_seconds = session_ttl_seconds    # idle session files are swept after this
+        self.lock = threading.Lock()
+        self.stats = {'begun': 0, 'superseded': 0, 'cancel_requests': 0, 'cancelled': 0, 'swept': 0}
+        self._last_sweep = 0.0
+        os.makedirs(self.state_dir, exist_ok=True)
+
+    def _path(self, user_id: str, session_id: str) -> str:
+        # Scoped per user: a session id guessed from another account cannot cancel its compiles
+        digest = hashlib.sha256(f"{user_id}:{session_id}".encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.state_dir, digest)
+
+    @staticmethod
+    def _read(path: str) -> Optional[str]:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write(self, path: str, token: str):
+        """Atomic replace so a concurrent reader never sees a partial token"""
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(token)
+        os.replace(tmp_path, path)
+
+    def begin(self, user_id: str, session_id: str) -> str:
+        """Make this request the session's latest; returns its token (older compiles are superseded)"""
+        path = self._path(user_id, session_id)
+        token = uuid.uuid4().hex
+        superseded = self._read(path) is not None
+        try:
+            self._write(path, token)
+        except OSError as e:
+            logger.warning(f"Cannot record compile session {session_id}: {e}")
+        with self.lock:
+            self.stats['begun'] += 1
+            self.stats['superseded'] += superseded
+        self._maybe_sweep()
+        return token
+
+    def cancel(self, user_id: str, session_id: str) -> bool:
+        """Supersede whatever the session is compiling; False if nothing was in flight"""
+        path = self._path(user_id, session_id)
+        in_flight = self._read(path) is not None
+        if in_flight:
+            try:
+                self._write(path, f"cancelled-{uuid.uuid4().hex}")
+            except OSError as e:
+                logger.warning(f"Cannot cancel compile session {session_id}: {e}")
+                return False
+        with self.lock:
+            self.stats['cancel_requests'] += 1
+        return in_flight
+
+    def cancelled_check(self, user_id: str, session_id: str, token: str) -> Callable[[], bool]:
+        """Callable polled during the compile: True once a newer token replaced ours"""
+        path = self._path(user_id, session_id)
+
+        def cancelled() -> bool:
+            current = self._read(path)
+            return current is not None and current != token
+
+        return cancelled
+
+    def end(self, user_id: str, session_id: str, token: str, cancelled: bool = False):
+        """Compile finished: drop the session file if it still holds our token"""
+        path = self._path(user_id, session_id)
+        if self._read(path) == token:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if cancelled:
+            with self.lock:
+                self.stats['cancelled'] += 1
+
+    def _maybe_sweep(self):
+        """Remove session files left by cancelled or crashed requests (at most once a minute)"""
+        now = time.time()
+        if now - self._last_sweep < SWEEP_INTERVAL_SECONDS:
+            return
+        self._last_sweep = now
+        swept = 0
+        try:
+            for name in os.listdir(self.state_dir):
+                path = os.path.join(self.state_dir, name)
+                try:
+                    if now - os.path.getmtime(path) > self.session_ttl_seconds:
+                        os.remove(path)
+                        swept += 1
+                except OSError:
+                    pass
+        except OSError:
+            return
+        with self.lock:
+            self.stats['swept'] += swept
+
+    def get_stats(self) -> dict:
+        try:
+            open_sessions = sum(1 for name in os.listdir(self.state_dir) if not name.endswith(".tmp"))
+        except OSError:
+            open_sessions = 0
+        with self.lock:
+            return {'state_dir': self.state_dir, 'open_sessions': open_sessions, **self.stats}
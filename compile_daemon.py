@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+TikZ Compile Daemon
+===================
+Standalone compile-service process that owns the compile queue, workspaces and
+LaTeX subprocesses. Flask workers talk to it over a local Unix socket, so web
+workers can be I/O-oriented (gthread) and the compile tier is sized separately.
+
+Protocol: one JSON request line per connection, one JSON response line.
+    {"method": "compile", "params": {"tikz_code": ..., "work_dir": ..., "user_id": ..., "options": {...}}}
+    {"method": "submit",  "params": {"tikz_code": ..., "user_id": ..., "options": {...}}}
+    {"method": "ping"} / {"method": "stats"}
+
+Usage:
+    # systemd (ExecStart) or manually
+    python compile_daemon.py --socket /run/tikz2svg/compile.sock
+
+    # Web tier: point Flask workers at the daemon
+    export TIKZ_COMPILE_DAEMON_SOCKET=/run/tikz2svg/compile.sock
+
+gunicorn.conf.py starts the daemon itself when TIKZ_COMPILE_DAEMON_AUTOSTART=1.
+"""
+
+import os
+import sys
+import json
+import errno
+import time
+import socket
+import signal
+import logging
+import argparse
+import threading
+import socketserver
+from typing import Optional, Dict
+
+from compile_slots import CompilationQueueFull
+from compile_cancel import CompilationCancelled
+from compile_workspace import DEFAULT_WORKSPACE_ROOT
+
+logger = logging.getLogger(__name__)
+
+MAX_REQUEST_BYTES = 1024 * 1024   # TikZ code is capped at 50KB by the security validator
+
+
+class CompileDaemonUnavailable(Exception):
+    """Daemon socket missing or refusing connections: nothing was sent, compiling elsewhere is safe"""
+
+
+class CompileDaemonError(Exception):
+    """The daemon took the request but timed out, failed or answered garbage (do not recompile)"""
+
+
+
+class CompileDaemonClient:
+    """Unix-socket RPC client used by Flask workers"""
+
+    def __init__(self, socket_path: str, timeout: float = 180.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def call(self, method: str, **params) -> Dict:
+        """
+        Send one request, return the decoded response
+        Raises CompileDaemonUnavailable only when the connection itself fails (ENOENT/ECONNREFUSED);
+        a timeout or error after connecting is CompileDaemonError
+        """
+        payload = json.dumps({'method': method, 'params': params}).encode('utf-8') + b"\n"
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout)
+                try:
+                    sock.connect(self.socket_path)
+                except OSError as e:
+                    if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+                        raise CompileDaemonUnavailable(f"Compile daemon unavailable at {self.socket_path}: {e}")
+                    raise
+                sock.sendall(payload)
+                sock.shutdown(socket.SHUT_WR)
+                chunks = []
+                while True:
+                    chunk = sock.recv(65536)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+        except CompileDaemonUnavailable:
+            raise
+        except (OSError, socket.timeout) as e:
+            raise CompileDaemonError(f"Compile daemon at {self.socket_path} failed: {e}")
+
+        try:
+            response = json.loads(b"".join(chunks).decode('utf-8'))
+        except ValueError:
+            raise CompileDaemonError("Invalid response from compile daemon")
+        if not response.get('ok'):
+            if response.get('cancelled'):
+                raise CompilationCancelled(response.get('error', 'Compile cancelled'))
+            if response.get('retry_after'):
+                raise CompilationQueueFull(response.get('error', 'Compile queue is full'), response['retry_after'])
+            raise CompileDaemonError(response.get('error', 'Compile daemon error'))
+        return response.get('result') or {}
+
+    def compile(self, tikz_code: str, work_dir: str, user_id: str = "anonymous", **options) -> tuple[bool, str, str]:
+        """
+        Same contract as compile_tikz_enhanced_whitelist (raises CompilationQueueFull / CompilationCancelled)
+        plus CompileDaemonUnavailable / CompileDaemonError
+        """
+        result = self.call('compile', tikz_code=tikz_code, work_dir=work_dir, user_id=user_id, options=options)
+        return bool(result.get('success')), result.get('svg_content') or "", result.get('error') or ""
+
+    def submit(self, tikz_code: str, user_id: str = "anonymous", **options) -> Optional[Dict]:
+        """Enqueue an async job in the daemon (status is read from the shared jobs dir)"""
+        result = self.call('submit', tikz_code=tikz_code, user_id=user_id, options=options)
+        return result.get('job')
+
+    def ping(self) -> bool:
+        try:
+            return self.call('ping').get('pong', False)
+        except (CompileDaemonUnavailable, CompileDaemonError):
+            return False
+
+
+class CompileDaemonHandler(socketserver.StreamRequestHandler):
+    """One request per connection"""
+
+    def handle(self):
+        try:
+            line = self.rfile.readline(MAX_REQUEST_BYTES + 1)
+            if len(line) > MAX_REQUEST_BYTES:
+                raise ValueError("Request too large")
+            request = json.loads(line.decode('utf-8'))
+            result = self.server.dispatch(request.get('method'), request.get('params') or {})
+            response = {'ok': True, 'result': result}
+        except CompilationQueueFull as e:
+            response = {'ok': False, 'error': str(e), 'retry_after': e.retry_after}
+        except CompilationCancelled as e:
+            response = {'ok': False, 'error': str(e), 'cancelled': True}
+        except Exception as e:
+            logger.exception("Compile daemon request failed")
+            response = {'ok': False, 'error': str(e)}
+        self.wfile.write(json.dumps(response).encode('utf-8') + b"\n")
+
+
+class CompileDaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Threaded Unix-socket server; LaTeX concurrency bounded by a semaphore (excess requests wait)"""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, compile_func, job_queue=None, concurrency: int = 4,
+                 workspace_root: str = DEFAULT_WORKSPACE_ROOT):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        os.makedirs(os.path.dirname(socket_path) or ".", exist_ok=True)
+        super().__init__(socket_path, CompileDaemonHandler)
+        os.chmod(socket_path, 0o660)
+
+        self.socket_path = socket_path
+        self.compile_func = compile_func
+        self.job_queue = job_queue
+        self.workspace_root = os.path.realpath(workspace_root)
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.concurrency = concurrency
+        self.started_at = time.time()
+        self.stats_lock = threading.Lock()
+        self.stats = {'compiles': 0, 'waiting': 0, 'running': 0, 'submitted': 0}
+
+    def _check_work_dir(self, work_dir: str) -> str:
+        """Only write inside the workspace root"""
+        real = os.path.realpath(work_dir or "")
+        if not real.startswith(self.workspace_root + os.sep):
+            raise ValueError(f"work_dir outside workspace root: {work_dir}")
+        os.makedirs(real, exist_ok=True)
+        return real
+
+    def dispatch(self, method: str, params: dict) -> dict:
+        if method == 'ping':
+            return {'pong': True, 'pid': os.getpid()}
+
+        if method == 'stats':
+            with self.stats_lock:
+                return {
+                    'pid': os.getpid(),
+                    'uptime_seconds': round(time.time() - self.started_at, 1),
+                    'concurrency': self.concurrency,
+                    **self.stats
+                }
+
+        if method == 'compile':
+            work_dir = self._check_work_dir(params.get('work_dir'))
+            with self.stats_lock:
+                self.stats['waiting'] += 1
+            with self.slots:
+                with self.stats_lock:
+                    self.stats['waiting'] -= 1
+                    self.stats['running'] += 1
+                try:
+                    success, svg_content, error = self.compile_func(
+                        params.get('tikz_code', ''), work_dir, params.get('user_id', 'anonymous'),
+                        **(params.get('options') or {})
+                    )
+                finally:
+                    with self.stats_lock:
+                        self.stats['running'] -= 1
+                        self.stats['compiles'] += 1
+            return {'success': success, 'svg_content': svg_content, 'error': error}
+
+        if method == 'submit':
+            if self.job_queue is None:
+                raise ValueError("Job queue not available")
+            job = self.job_queue.submit(
+                params.get('tikz_code', ''), params.get('user_id', 'anonymous'), **(params.get('options') or {})
+            )
+            with self.stats_lock:
+                self.stats['submitted'] += 1
+            return {'job': job}
+
+        raise ValueError(f"Unknown method: {method}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TikZ compile daemon (Unix socket)")
+    parser.add_argument('--socket', default=os.environ.get('TIKZ_COMPILE_DAEMON_SOCKET', '/tmp/tikz2svg-compile.sock'))
+    parser.add_argument('--concurrency', type=int, default=int(os.environ.get('TIKZ_COMPILE_DAEMON_CONCURRENCY', 0)),
+                        help="Max in-flight compile requests (0 = scheduler slots + queue)")
+    parser.add_argument('--workspace-root', default=os.environ.get('TIKZ_WORKSPACE_ROOT') or DEFAULT_WORKSPACE_ROOT)
+    args = parser.parse_args()
+
+    # This process compiles locally: app must not delegate back to the daemon
+    os.environ.pop('TIKZ_COMPILE_DAEMON_SOCKET', None)
+    from app import compile_tikz_enhanced_whitelist, get_compile_job_queue, compilation_manager, cache_warmer
+
+    # Ordering and fairness are decided by the host-wide scheduler; the daemon
+    # only bounds how many requests it holds (running + queued)
+    concurrency = args.concurrency or (compilation_manager.max_concurrent + compilation_manager.slots.max_queue)
+
+    server = CompileDaemonServer(
+        args.socket,
+        compile_func=compile_tikz_enhanced_whitelist,
+        job_queue=get_compile_job_queue(),
+        concurrency=concurrency,
+        workspace_root=args.workspace_root
+    )
+    # systemd/gunicorn stop with SIGTERM: exit cleanly so atexit hooks (warm pool) run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Web workers leave cache warm-up to the daemon
+    cache_warmer.ensure_started()
+    print(f"🧮 Compile daemon listening on {args.socket} (concurrency: {concurrency}, pid: {os.getpid()})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        try:
+            os.remove(args.socket)
+        except OSError:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+"""
+Asynchronous Compile Jobs
+=========================
+Job queue behind POST /api/compile so web workers never block on the LaTeX
+subprocess:
+
+- submit() stores a 'queued' job record and hands the compile to a
+  background thread pool, the HTTP request returns immediately
+- job records are JSON files in a shared directory, so any gunicorn worker
+  can answer GET /api/compile/<id> (and the SSE stream, enabled only on
+  threaded/async workers: it holds its worker until the job ends)
+- states: queued -> running -> done | failed | cancelled (superseded by a
+  newer job of the same editor session, see compile_cancel)
+- a record carries the pid of the process that runs it; get() fails a
+  queued/running job whose process is gone (worker killed or recycled) and a
+  running job not updated for stale_running_seconds, instead of leaving it
+  'running' until the record expires
+
+The SVG of a finished job is served by /temp_svg/<job_id> (same workspace
+layout as the index route: <workspace root>/<job_id>/tikz.svg, allocated and
+expired by compile_workspace.WorkspaceAllocator when one is given).
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Dict
+
+from compile_slots import CompilationQueueFull
+from compile_cancel import CompilationCancelled
+from tex_log import load_error_excerpt
+
+logger = logging.getLogger(__name__)
+
+JOB_ID_RE = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+TERMINAL_STATES = ('done', 'failed', 'cancelled')
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class CompileJobQueue:
+    """Background compile jobs with file-backed status shared across workers"""
+
+    def __init__(self, compile_func: Callable, error_classifier: Callable, jobs_dir: str,
+                 workspace_root: str = "/tmp", max_workers: int = 5, max_pending: int = 50,
+                 job_ttl_seconds: int = 3600, workspaces=None, stale_running_seconds: int = 900):
+        self.compile_func = compile_func              # (tikz_code, work_dir, user_id, **options) -> (ok, svg, error)
+        self.error_classifier = error_classifier      # (error_message, tikz_code) -> dict
+        self.jobs_dir = jobs_dir
+        self.workspace_root = workspaces.root if workspaces else workspace_root
+        self.workspaces = workspaces                  # WorkspaceAllocator: expiry index + quota
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.job_ttl_seconds = job_ttl_seconds
+        self.stale_running_seconds = stale_running_seconds   # longer than any compile (lease incl. fallbacks)
+
+        self.lock = threading.Lock()
+        self.pending = 0                              # queued + running in this process
+        self._executor = None
+        self._executor_pid = None
+        self._last_cleanup = 0.0
+
+        os.makedirs(self.jobs_dir, exist_ok=True)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Thread pool per process (gunicorn preload forks after import)"""
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="compile-job")
+            self._executor_pid = os.getpid()
+            self.pending = 0
+        return self._executor
+
+    def _job_path(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def _write(self, job: dict):
+        """Atomic write so readers in other workers never see a partial file"""
+        path = self._job_path(job['job_id'])
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job, f)
+        os.replace(tmp_path, path)
+
+    def _update(self, job: dict, **fields):
+        job.update(fields)
+        job['updated_at'] = time.time()
+        self._write(job)
+
+    def submit(self, tikz_code: str, user_id: str = "anonymous", **options) -> Optional[Dict]:
+        """
+        Enqueue a compile job
+        Returns the job record, or None if this worker's queue is full
+        """
+        with self.lock:
+            executor = self._get_executor()
+            if self.pending >= self.max_pending:
+                return None
+            self.pending += 1
+
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        job = {
+            'job_id': job_id,
+            'status': 'queued',
+            'user_id': user_id,
+            'pid': os.getpid(),
+            'created_at': now,
+            'updated_at': now,
+            'started_at': None,
+            'finished_at': None,
+            'svg_url': None,
+            'error': None
+        }
+        self._write(job)
+
+        try:
+            executor.submit(self._run, job, tikz_code, options)
+        except RuntimeError as e:
+            with self.lock:
+                self.pending -= 1
+            self._update(job, status='failed', finished_at=time.time(),
+                         error={'category': 'unknown', 'user_message': str(e), 'suggestions': []})
+
+        self._maybe_cleanup()
+        return job
+
+    def _run(self, job: dict, tikz_code: str, options: dict):
+        """Worker thread: compile and record the outcome"""
+        work_dir = os.path.join(self.workspace_root, job['job_id'])
+        try:
+            if self.workspaces:
+                self.workspaces.create(job['job_id'])
+            else:
+                os.makedirs(work_dir, exist_ok=True)
+            self._update(job, status='running', started_at=time.time())
+
+            success, svg_content, error_message = self.compile_func(tikz_code, work_dir, job['user_id'], **options)
+
+            if success:
+                # Cache hits return content without writing the file
+                svg_path = os.path.join(work_dir, "tikz.svg")
+                if not os.path.exists(svg_path) and svg_content:
+                    with open(svg_path, "w", encoding="utf-8") as f:
+                        f.write(svg_content)
+                if self.workspaces:
+                    self.workspaces.settle(work_dir)
+                self._update(job, status='done', finished_at=time.time(), svg_url=f"/temp_svg/{job['job_id']}")
+            else:
+                classification = self.error_classifier(error_message, tikz_code)
+                error_excerpt = load_error_excerpt(work_dir)     # first error + line in the user's code
+                if self.workspaces:
+                    self.workspaces.release(work_dir)
+                self._update(job, status='failed', finished_at=time.time(), error={
+                    'category': classification['category'],
+                    'user_message': classification['user_message'],
+                    'suggestions': classification['suggestions'],
+                    'severity': classification['severity'],
+                    'technical_details': (classification.get('technical_details') or '')[:2000],
+                    'log_excerpt': error_excerpt
+                })
+        except CompilationCancelled:
+            if self.workspaces:
+                self.workspaces.release(work_dir)
+            self._update(job, status='cancelled', finished_at=time.time())
+        except CompilationQueueFull as e:
+            if self.workspaces:
+                self.workspaces.release(work_dir)
+            self._update(job, status='failed', finished_at=time.time(), error={
+                'category': 'resource',
+                'user_message': f"Server busy: {e}",
+                'suggestions': [],
+                'severity': 'low',
+                'retry_after': e.retry_after
+            })
+        except Exception as e:
+            logger.exception(f"Compile job {job['job_id']} crashed")
+            if self.workspaces:
+                self.workspaces.release(work_dir)
+            self._update(job, status='failed', finished_at=time.time(), error={
+                'category': 'unknown',
+                'user_message': f"Compilation error: {e}",
+                'suggestions': [],
+                'severity': 'medium'
+            })
+        finally:
+            with self.lock:
+                self.pending = max(0, self.pending - 1)
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """Read a job record (from any worker); orphaned or stale jobs are failed on read"""
+        if not JOB_ID_RE.match(job_id or ""):
+            return None
+        try:
+            with open(self._job_path(job_id), "r", encoding="utf-8") as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if job['status'] in TERMINAL_STATES:
+            return job
+        if job.get('pid') and not _process_alive(job['pid']):
+            reason = "Compile worker exited before the job finished"
+        elif job['status'] == 'running' and time.time() - job['updated_at'] > self.stale_running_seconds:
+            reason = f"Compile job made no progress for {self.stale_running_seconds}s"
+        else:
+            return job
+        logger.warning(f"Compile job {job_id}: {reason}, marking failed")
+        self._update(job, status='failed', finished_at=time.time(), error={
+            'category': 'resource',
+            'user_message': reason,
+            'suggestions': ["Thử biên dịch lại"],
+            'severity': 'medium'
+        })
+        return job
+
+    @staticmethod
+    def public_view(job: dict) -> dict:
+        """Fields returned to clients"""
+        view = {key: job.get(key) for key in ('job_id', 'status', 'created_at', 'started_at', 'finished_at', 'svg_url', 'error')}
+        if job.get('started_at') and job.get('finished_at'):
+            view['compile_seconds'] = round(job['finished_at'] - job['started_at'], 3)
+        return view
+
+    def stream_events(self, job_id: str, poll_interval: float = 0.25, max_seconds: int = 120,
+                      heartbeat_seconds: int = 15):
+        """Server-sent events: one 'status' event per state change until a terminal state"""
+        started = time.time()
+        last_status = None
+        last_sent = started
+
+        while time.time() - started < max_seconds:
+            job = self.get(job_id)
+            if job is None:
+                yield f"event: error\ndata: {json.dumps({'error': 'Job not found'})}\n\n"
+                return
+
+            if job['status'] != last_status:
+                last_status = job['status']
+                last_sent = time.time()
+                yield f"event: status\ndata: {json.dumps(self.public_view(job))}\n\n"
+                if last_status in TERMINAL_STATES:
+                    return
+            elif time.time() - last_sent >= heartbeat_seconds:
+                last_sent = time.time()
+                yield ": keep-alive\n\n"
+
+            time.sleep(poll_interval)
+
+        yield f"event: timeout\ndata: {json.dumps({'job_id': job_id, 'status': last_status})}\n\n"
+
+    def _maybe_cleanup(self):
+        """Remove expired job records (at most once a minute)"""
+        now = time.time()
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+        try:
+            for name in os.listdir(self.jobs_dir):
+                path = os.path.join(self.jobs_dir, name)
+                try:
+                    if now - os.path.getmtime(path) > self.job_ttl_seconds:
+                        os.remove(path)
+                except OSError:
+                    pass
+        except OSError:
+            pass
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                'pending_in_worker': self.pending,
+                'max_pending': self.max_pending,
+                'max_workers': self.max_workers
+            }
+
+
+# Singleton instance
+_compile_job_queue_instance = None
+
+
+def init_compile_job_queue(compile_func: Callable, error_classifier: Callable, **kwargs) -> CompileJobQueue:
+    """Initialize the compile job queue"""
+    global _compile_job_queue_instance
+    _compile_job_queue_instance = CompileJobQueue(compile_func, error_classifier, **kwargs)
+    return _compile_job_queue_instance
+
+
+def get_compile_job_queue() -> CompileJobQueue:
+    """Get the compile job queue (init_compile_job_queue must be called first)"""
+    if _compile_job_queue_instance is None:
+        raise RuntimeError("Compile job queue not initialized")
+    return _compile_job_queue_instance
@@ -0,0 +1,172 @@
+"""
+Single-Flight Compilation
+=========================
+Collapses identical in-flight compilations (same CompilationCache key) into
+one LaTeX run.
+
+- Inside a process: the first request for a key becomes the leader and
+  compiles; identical requests wait on its Event and receive the same result
+  (or the same exception) without spawning lualatex.
+- Across processes: the leader also holds an fcntl lock on
+  <lock_dir>/<key>.lock (tmpfs by default). A leader in another gunicorn
+  worker blocks on that lock, then re-checks the cache first. The shared L2/L3
+  tiers already hold the result at that point, so it does not compile again.
+  The kernel drops the lock when a process dies, so a crashed leader never
+  blocks a key.
+- Waiting is bounded by wait_timeout. After that the request compiles on
+  its own instead of failing.
+- Errors listed in retry_errors belong to the leader's request, not to the
+  key (e.g. its compile was cancelled by a newer request of the same editor):
+  followers then run the flight again instead of raising them.
+"""
+
+import os
+import time
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOCK_DIR = "/dev/shm/tikz_flights" if os.path.isdir("/dev/shm") else "/tmp/tikz_flights"
+
+POLL_INTERVAL = 0.05
+
+
+class _Flight:
+    """One in-flight computation shared by every identical request in this process"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """Per-key leader election: in-process Event plus optional host-wide fcntl lock"""
+
+    def __init__(self, lock_dir: Optional[str] = DEFAULT_LOCK_DIR, wait_timeout: float = 90,
+                 retry_errors: tuple = ()):
+        self.lock_dir = lock_dir            # None = deduplicate inside this process only
+        self.wait_timeout = wait_timeout    # upper bound for one compile incl. fallbacks
+        self.retry_errors = retry_errors    # leader-specific errors: followers compute again
+        self.lock = threading.Lock()
+        self.flights = {}                   # key -> _Flight
+        self.stats = {'leaders': 0, 'followers': 0, 'host_followers': 0, 'wait_timeouts': 0, 'retries': 0}
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+
+    @contextmanager
+    def _host_lock(self, key: str):
+        """
+        Exclusive host-wide lock for key; yields True if another process held it first
+        Without lock_dir, or once the wait times out, it yields without holding the lock
+        """
+        if not self.lock_dir:
+            yield False
+            return
+
+        path = os.path.join(self.lock_dir, f"{key}.lock")
+        deadline = time.time() + self.wait_timeout
+        waited = False
+        lock_file = None
+        while lock_file is None:
+            try:
+                candidate = open(path, "a")
+            except OSError as e:
+                logger.warning(f"Single-flight lock unavailable for {key}: {e}")
+                break
+            try:
+                fcntl.flock(candidate, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                candidate.close()
+                waited = True
+                if time.time() >= deadline:
+                    with self.lock:
+                        self.stats['wait_timeouts'] += 1
+                    break
+                time.sleep(POLL_INTERVAL)
+                continue
+            # The previous holder unlinks the file on release: make sure we locked the live one
+            try:
+                same_file = os.fstat(candidate.fileno()).st_ino == os.stat(path).st_ino
+            except FileNotFoundError:
+                same_file = False
+            if same_file:
+                lock_file = candidate
+            else:
+                candidate.close()
+
+        try:
+            yield waited
+        finally:
+            if lock_file is not None:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+
+    def run(self, key: str, compute: Callable, recheck: Callable = None):
+        """
+        Return compute() for key, sharing one call between identical concurrent requests
+        recheck() is called after waiting on another process's flight; a non-None
+        result (e.g. a cache hit) is returned instead of computing again
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = _Flight()
+                self.flights[key] = flight
+                self.stats['leaders'] += 1
+                leader = True
+            else:
+                flight.followers += 1
+                self.stats['followers'] += 1
+                leader = False
+
+        if not leader:
+            if flight.done.wait(self.wait_timeout):
+                if isinstance(flight.error, self.retry_errors):
+                    with self.lock:
+                        self.stats['retries'] += 1
+                    return self.run(key, compute, recheck)
+                if flight.error is not None:
+                    raise flight.error
+                return flight.result
+            with self.lock:
+                self.stats['wait_timeouts'] += 1
+            return compute()
+
+        try:
+            with self._host_lock(key) as waited:
+                result = None
+                if waited and recheck is not None:
+                    result = recheck()
+                    if result is not None:
+                        with self.lock:
+                            self.stats['host_followers'] += 1
+                if result is None:
+                    result = compute()
+            flight.result = result
+            return result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                self.flights.pop(key, None)
+            flight.done.set()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                'in_flight': len(self.flights),
+                'waiting': sum(flight.followers for flight in self.flights.values()),
+                'host_wide': bool(self.lock_dir),
+                **self.stats
+            }
@@ -0,0 +1,366 @@
+"""
+Host-wide Compile Slots
+=======================
+Cross-process fair-share compile scheduler shared by every gunicorn worker
+(and the compile daemon) on the host.
+
+- State is a small JSON table of leases (running compiles) and waiters
+  (queued compiles) in a shared directory (tmpfs by default), guarded by an
+  fcntl lock file, so N workers share one ceiling instead of N x 5
+- every compile holds a lease {user_id, lane, pid, expires_at}; leases are
+  reaped when they expire or when the owning process is gone, so a crashed
+  worker cannot leak slots
+- when all slots are busy, requests wait in lanes: interactive previews
+  before saves before batch/admin work (batch never holds more than
+  batch_share of the slots); inside a lane the user with the fewest running
+  compiles goes first, then FIFO
+- a request is shed (CompilationQueueFull with retry_after) when the queue is
+  full or the estimated wait, from the moving average of observed compile
+  durations, exceeds the lane's wait budget
+- background holders (parked warm-pool lualatex) take a slot with
+  try_acquire() only when one is free and nobody is waiting; preemptible
+  leases are revoked as soon as requests queue, and the holder polls held()
+  to learn that its slot is gone
+"""
+
+import os
+import json
+import math
+import time
+import uuid
+import fcntl
+import logging
+from contextlib import contextmanager
+from typing import Callable, Optional, Dict
+
+import psutil
+
+from compile_cancel import CompilationCancelled
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SLOTS_DIR = "/dev/shm/tikz_slots" if os.path.isdir("/dev/shm") else "/tmp/tikz_slots"
+
+# Lane priority order and how long a request may wait for a slot (seconds)
+LANES = ('interactive', 'save', 'batch')
+LANE_WAIT_SECONDS = {
+    'interactive': 20,
+    'save': 30,
+    'batch': 300
+}
+
+WAITER_HEARTBEAT_SECONDS = 5      # waiters poll far more often; silent ones are dropped
+POLL_INTERVAL = 0.05              # first re-check; each wait grows x1.5 up to MAX_POLL_INTERVAL
+MAX_POLL_INTERVAL = 0.5           # every poll loads/saves the table under the lock
+DURATION_EWMA_ALPHA = 0.2
+
+
+class CompilationQueueFull(Exception):
+    """No slot available within the lane's wait budget"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def auto_concurrency(memory_per_compile_mb: int, reserve_mb: int = 512) -> int:
+    """Slots from CPU cores and memory available for compiles (at least 1)"""
+    cpu_slots = os.cpu_count() or 1
+    try:
+        available_mb = psutil.virtual_memory().available / (1024 ** 2)
+        memory_slots = int((available_mb - reserve_mb) // memory_per_compile_mb)
+    except Exception:
+        memory_slots = cpu_slots
+    return max(1, min(cpu_slots, memory_slots))
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class HostCompileSlots:
+    """File-locked lease/wait table: global, per-user and per-lane compile scheduling across processes"""
+
+    def __init__(self, state_dir: str = DEFAULT_SLOTS_DIR, max_concurrent: int = 5,
+                 max_per_user: int = 2, lease_seconds: int = 180, max_queue: int = None,
+                 batch_share: float = 0.5):
+        self.state_dir = state_dir
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.lease_seconds = lease_seconds      # upper bound for one compile incl. fallbacks
+        self.max_queue = max_queue or max_concurrent * 4
+        self.batch_slots = max(1, int(max_concurrent * batch_share))
+
+        os.makedirs(self.state_dir, exist_ok=True)
+        self.state_path = os.path.join(self.state_dir, "leases.json")
+        self.lock_path = os.path.join(self.state_dir, "leases.lock")
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self) -> dict:
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        state.setdefault('leases', {})
+        state.setdefault('waiters', {})
+        state.setdefault('reaped', 0)
+        state.setdefault('shed', 0)
+        state.setdefault('preempted', 0)
+        state.setdefault('avg_seconds', 5.0)
+        return state
+
+    def _save(self, state: dict):
+        tmp_path = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _reap(self, state: dict, now: float):
+        """Drop expired leases, leases of dead processes and silent waiters (called with lock held)"""
+        stale = [
+            lease_id for lease_id, lease in state['leases'].items()
+            if lease['expires_at'] <= now or not _pid_alive(lease['pid'])
+        ]
+        for lease_id in stale:
+            lease = state['leases'].pop(lease_id)
+            logger.warning(f"Reaped stale compile lease {lease_id} (user {lease['user_id']}, pid {lease['pid']})")
+        state['reaped'] += len(stale)
+
+        for ticket, waiter in list(state['waiters'].items()):
+            if now - waiter['heartbeat'] > WAITER_HEARTBEAT_SECONDS or not _pid_alive(waiter['pid']):
+                del state['waiters'][ticket]
+
+        # Queued requests come before background holders: revoke preemptible leases for
+        # the waiters that the free slots cannot take
+        short = len(state['waiters']) - max(0, self.max_concurrent - len(state['leases']))
+        preemptible = sorted(
+            (lease['acquired_at'], lease_id) for lease_id, lease in state['leases'].items()
+            if lease.get('preemptible')
+        )
+        for _, lease_id in preemptible[:max(0, short)]:
+            del state['leases'][lease_id]
+            state['preempted'] += 1
+
+    def _admission_order(self, state: dict) -> list:
+        """Tickets that get the currently free slots, in scheduling order"""
+        free = self.max_concurrent - len(state['leases'])
+        if free <= 0 or not state['waiters']:
+            return []
+
+        user_running = {}
+        batch_running = 0
+        for lease in state['leases'].values():
+            user_running[lease['user_id']] = user_running.get(lease['user_id'], 0) + 1
+            batch_running += lease['lane'] == 'batch'
+
+        pending = dict(state['waiters'])
+        admitted = []
+        while free > 0 and pending:
+            chosen = None
+            for lane in LANES:
+                if lane == 'batch' and batch_running >= self.batch_slots:
+                    continue
+                candidates = [
+                    (user_running.get(w['user_id'], 0), w['enqueued_at'], ticket)
+                    for ticket, w in pending.items()
+                    if w['lane'] == lane and user_running.get(w['user_id'], 0) < self.max_per_user
+                ]
+                if candidates:
+                    chosen = min(candidates)[2]
+                    break
+            if chosen is None:
+                break
+            waiter = pending.pop(chosen)
+            user_running[waiter['user_id']] = user_running.get(waiter['user_id'], 0) + 1
+            batch_running += waiter['lane'] == 'batch'
+            admitted.append(chosen)
+            free -= 1
+        return admitted
+
+    def _estimate_wait(self, state: dict, queued_ahead: int) -> float:
+        """Seconds until a new request would start, from observed compile durations"""
+        busy = sum(1 for lease in state['leases'].values() if not lease.get('preemptible'))
+        if busy < self.max_concurrent and queued_ahead == 0:
+            return 0.0
+        return state['avg_seconds'] * (queued_ahead + 1) / self.max_concurrent
+
+    def _shed(self, state: dict, message: str, wait_seconds: float):
+        state['shed'] += 1
+        self._save(state)
+        raise CompilationQueueFull(message, retry_after=max(1, min(300, math.ceil(wait_seconds))))
+
+    def acquire(self, user_id: str, lane: str = 'interactive', wait_timeout: float = None,
+                cancelled: Optional[Callable[[], bool]] = None) -> str:
+        """
+        Take a compile slot for user_id, waiting in the lane if all slots are busy
+        Returns lease_id; raises CompilationQueueFull (with retry_after) when shed,
+        CompilationCancelled when cancelled() turns true before a slot is granted
+        """
+        if cancelled is not None and cancelled():
+            raise CompilationCancelled("Superseded before queueing for a compile slot")
+        lane = lane if lane in LANES else 'interactive'
+        wait_timeout = LANE_WAIT_SECONDS[lane] if wait_timeout is None else wait_timeout
+        ticket = uuid.uuid4().hex
+        deadline = time.time() + wait_timeout
+
+        with self._locked():
+            now = time.time()
+            state = self._load()
+            self._reap(state, now)
+            if len(state['waiters']) >= self.max_queue:
+                self._shed(state, f"Compile queue is full ({self.max_queue} waiting)",
+                           self._estimate_wait(state, len(state['waiters'])))
+            ahead = sum(1 for w in state['waiters'].values() if LANES.index(w['lane']) <= LANES.index(lane))
+            estimated_wait = self._estimate_wait(state, ahead)
+            if estimated_wait > wait_timeout:
+                self._shed(state, f"Compile queue is busy (estimated wait {estimated_wait:.0f}s)", estimated_wait)
+            state['waiters'][ticket] = {
+                'user_id': user_id,
+                'lane': lane,
+                'pid': os.getpid(),
+                'enqueued_at': now,
+                'heartbeat': now
+            }
+            self._save(state)
+
+        poll_interval = POLL_INTERVAL
+        while True:
+            if cancelled is not None and cancelled():
+                with self._locked():
+                    state = self._load()
+                    state['waiters'].pop(ticket, None)
+                    self._save(state)
+                raise CompilationCancelled("Superseded while waiting for a compile slot")
+            with self._locked():
+                now = time.time()
+                state = self._load()
+                self._reap(state, now)
+                waiter = state['waiters'].get(ticket)
+                if waiter is None:
+                    # Dropped as silent (e.g. process stalled); queue again at the back
+                    waiter = {'user_id': user_id, 'lane': lane, 'pid': os.getpid(), 'enqueued_at': now}
+                    state['waiters'][ticket] = waiter
+                waiter['heartbeat'] = now
+
+                if ticket in self._admission_order(state):
+                    del state['waiters'][ticket]
+                    lease_id = uuid.uuid4().hex
+                    state['leases'][lease_id] = {
+                        'user_id': user_id,
+                        'lane': lane,
+                        'pid': os.getpid(),
+                        'acquired_at': now,
+                        'waited_seconds': round(now - waiter['enqueued_at'], 3),
+                        'expires_at': now + self.lease_seconds
+                    }
+                    self._save(state)
+                    return lease_id
+
+                if now >= deadline:
+                    del state['waiters'][ticket]
+                    ahead = sum(1 for w in state['waiters'].values() if w['enqueued_at'] < waiter['enqueued_at'])
+                    self._shed(state, f"No compile slot within {wait_timeout:.0f}s",
+                               self._estimate_wait(state, ahead))
+                self._save(state)
+            time.sleep(poll_interval)
+            poll_interval = min(MAX_POLL_INTERVAL, poll_interval * 1.5)
+
+    def try_acquire(self, user_id: str, lane: str = 'batch', lease_seconds: float = None,
+                    preemptible: bool = False) -> Optional[str]:
+        """
+        Take a free slot right now or return None: never queues and never goes ahead of
+        waiting requests (background work such as parked warm-pool workers)
+        lease_seconds overrides the lease lifetime for holders that outlive one compile;
+        preemptible leases are revoked once requests queue (holder checks held())
+        """
+        lane = lane if lane in LANES else 'batch'
+        with self._locked():
+            now = time.time()
+            state = self._load()
+            self._reap(state, now)
+            if state['waiters'] or len(state['leases']) >= self.max_concurrent:
+                return None
+            if lane == 'batch' and sum(1 for l in state['leases'].values() if l['lane'] == 'batch') >= self.batch_slots:
+                return None
+            lease_id = uuid.uuid4().hex
+            state['leases'][lease_id] = {
+                'user_id': user_id,
+                'lane': lane,
+                'pid': os.getpid(),
+                'acquired_at': now,
+                'waited_seconds': 0.0,
+                'expires_at': now + (lease_seconds or self.lease_seconds)
+            }
+            if preemptible:
+                state['leases'][lease_id]['preemptible'] = True
+            self._save(state)
+            return lease_id
+
+    def held(self, lease_ids) -> set:
+        """The lease_ids still in the table (not released, reaped or preempted)"""
+        with self._locked():
+            state = self._load()
+            self._reap(state, time.time())
+            self._save(state)
+        return {lease_id for lease_id in lease_ids if lease_id in state['leases']}
+
+    def release(self, lease_id: str, record_duration: bool = True):
+        """
+        Return a slot (no-op if the lease was already reaped) and record the compile duration
+        record_duration=False for leases that did not time one compile (warm-pool workers)
+        """
+        with self._locked():
+            state = self._load()
+            lease = state['leases'].pop(lease_id, None)
+            if lease is not None:
+                if record_duration:
+                    duration = time.time() - lease['acquired_at']
+                    state['avg_seconds'] = round(
+                        (1 - DURATION_EWMA_ALPHA) * state['avg_seconds'] + DURATION_EWMA_ALPHA * duration, 3
+                    )
+                self._save(state)
+
+    def get_stats(self) -> Dict:
+        """Host-wide numbers (reaps stale leases first)"""
+        with self._locked():
+            state = self._load()
+            self._reap(state, time.time())
+            self._save(state)
+
+        per_user = {}
+        for lease in state['leases'].values():
+            per_user[lease['user_id']] = per_user.get(lease['user_id'], 0) + 1
+        active = len(state['leases'])
+        return {
+            'scope': 'host',
+            'active_count': active,
+            'max_concurrent': self.max_concurrent,
+            'available_slots': max(0, self.max_concurrent - active),
+            'max_per_user': self.max_per_user,
+            'active_users': len(per_user),
+            'queued': len(state['waiters']),
+            'max_queue': self.max_queue,
+            'queued_by_lane': {lane: sum(1 for w in state['waiters'].values() if w['lane'] == lane) for lane in LANES},
+            'running_by_lane': {lane: sum(1 for l in state['leases'].values() if l['lane'] == lane) for lane in LANES},
+            'avg_compile_seconds': state['avg_seconds'],
+            'estimated_wait_seconds': round(self._estimate_wait(state, len(state['waiters'])), 1),
+            'shed_requests': state['shed'],
+            'preempted_leases': state['preempted'],
+            'worker_pids': sorted({lease['pid'] for lease in state['leases'].values()}),
+            'reaped_leases': state['reaped']
+        }
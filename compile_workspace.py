@@ -0,0 +1,285 @@
+"""
+Compile Workspaces
+==================
+Allocator for the per-compile working directories (<root>/<uuid>/tikz.*),
+rooted on tmpfs (/dev/shm/tikz_work by default) instead of /tmp.
+
+- every process indexes the workspaces it created in a min-heap by expiry
+  time, so cleanup pops expired entries instead of listing and stat-ing all of
+  /tmp; serving or converting a preview extends its expiry (touch). Other
+  processes can only bump the directory mtime, so cleanup() re-checks it
+  before deleting and re-indexes a workspace touched since
+- settle() records a workspace's size once its files are written; when the
+  process's workspaces exceed quota_bytes the ones closest to expiry are
+  deleted first (their preview links return 404 earlier)
+- prune() deletes LaTeX intermediates (.aux, .pdf, .dvi, ...) as soon as the
+  SVG exists; only tikz.svg (and tikz.log + tikz.error.json after a
+  failure, for the error panel and GET /compile_log/<id>) stay on tmpfs
+- workspaces left by a crashed worker are not in any index: an occasional
+  sweep of the root removes directories idle for longer than twice the TTL
+- ids must be UUIDs: paths built from request data never leave the root
+"""
+
+import os
+import re
+import time
+import heapq
+import shutil
+import logging
+import threading
+import uuid as uuid_module
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKSPACE_ROOT = "/dev/shm/tikz_work" if os.path.isdir("/dev/shm") else "/tmp/tikz_work"
+
+WORKSPACE_ID_RE = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+# Files the routes still need after a compile; everything else is an intermediate
+KEEP_AFTER_SUCCESS = ('tikz.svg',)
+KEEP_AFTER_FAILURE = ('tikz.log', 'tikz.error.json')
+
+ORPHAN_SWEEP_SECONDS = 600
+
+
+class WorkspaceAllocator:
+    """Per-process expiry index and byte quota for compile workspaces"""
+
+    def __init__(self, root: str = DEFAULT_WORKSPACE_ROOT, ttl_seconds: int = 600,
+                 quota_bytes: int = 256 * 1024 * 1024, sweep_interval: int = 30):
+        self.root = os.path.realpath(root)
+        self.ttl_seconds = ttl_seconds
+        self.quota_bytes = quota_bytes          # per process; 0 = unlimited
+        self.sweep_interval = sweep_interval
+
+        self.lock = threading.Lock()
+        self.workspaces = {}                    # id -> {'expires_at', 'size_bytes'}
+        self.heap = []                          # (expires_at, id); stale entries skipped lazily
+        self.total_bytes = 0
+        self.stats = {'created': 0, 'expired': 0, 'released': 0, 'quota_evictions': 0,
+                      'orphans_removed': 0, 'pruned_files': 0}
+        self._started_pid = None
+        self._last_orphan_sweep = 0.0
+
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, workspace_id: str) -> Optional[str]:
+        """Directory of workspace_id, None if the id is not a workspace id"""
+        if not WORKSPACE_ID_RE.match(workspace_id or ""):
+            return None
+        return os.path.join(self.root, workspace_id)
+
+    def _id_of(self, work_dir: str) -> Optional[str]:
+        workspace_id = os.path.basename(os.path.normpath(work_dir or ""))
+        return workspace_id if self.path(workspace_id) == os.path.normpath(work_dir or "") else None
+
+    def create(self, workspace_id: str = None) -> str:
+        """Make and index a new workspace; returns its path"""
+        workspace_id = workspace_id or str(uuid_module.uuid4())
+        work_dir = self.path(workspace_id)
+        if work_dir is None:
+            raise ValueError(f"Invalid workspace id: {workspace_id}")
+        os.makedirs(work_dir, exist_ok=True)
+        expires_at = time.time() + self.ttl_seconds
+        with self.lock:
+            if workspace_id not in self.workspaces:
+                self.workspaces[workspace_id] = {'expires_at': expires_at, 'size_bytes': 0}
+                self.stats['created'] += 1
+            else:
+                self.workspaces[workspace_id]['expires_at'] = expires_at
+            heapq.heappush(self.heap, (expires_at, workspace_id))
+        self.ensure_started()
+        return work_dir
+
+    def touch(self, work_dir: str):
+        """Extend the expiry of a workspace (the index entry only exists in the owning process)"""
+        workspace_id = self._id_of(work_dir)
+        if workspace_id is None:
+            return
+        try:
+            os.utime(work_dir)          # keeps the orphan sweep of other processes away
+        except OSError:
+            return
+        expires_at = time.time() + self.ttl_seconds
+        with self.lock:
+            entry = self.workspaces.get(workspace_id)
+            if entry is not None:
+                entry['expires_at'] = expires_at
+                heapq.heappush(self.heap, (expires_at, workspace_id))
+
+    def prune(self, work_dir: str, keep: tuple = KEEP_AFTER_SUCCESS) -> int:
+        """Delete every file of work_dir except keep; returns the number removed"""
+        removed = 0
+        try:
+            names = os.listdir(work_dir)
+        except OSError:
+            return 0
+        for name in names:
+            if name in keep:
+                continue
+            path = os.path.join(work_dir, name)
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        with self.lock:
+            self.stats['pruned_files'] += removed
+        return removed
+
+    def settle(self, work_dir: str):
+        """Record the workspace size after its files are written and enforce the quota"""
+        workspace_id = self._id_of(work_dir)
+        size_bytes = _dir_size(work_dir)
+        evict = []
+        with self.lock:
+            entry = self.workspaces.get(workspace_id)
+            if entry is None:
+                return
+            self.total_bytes += size_bytes - entry['size_bytes']
+            entry['size_bytes'] = size_bytes
+            if self.quota_bytes:
+                # Closest to expiry first (heap order); the workspace just settled is kept
+                kept = None
+                while self.total_bytes > self.quota_bytes and self.heap:
+                    expires_at, candidate = heapq.heappop(self.heap)
+                    current = self.workspaces.get(candidate)
+                    if current is None or current['expires_at'] != expires_at:
+                        continue        # stale heap entry
+                    if candidate == workspace_id:
+                        kept = (expires_at, candidate)
+                        continue
+                    self.total_bytes -= self.workspaces.pop(candidate)['size_bytes']
+                    self.stats['quota_evictions'] += 1
+                    evict.append(candidate)
+                if kept:
+                    heapq.heappush(self.heap, kept)
+        for candidate in evict:
+            shutil.rmtree(os.path.join(self.root, candidate), ignore_errors=True)
+
+    def release(self, work_dir: str):
+        """Delete a workspace now (saved, discarded or failed preview)"""
+        workspace_id = self._id_of(work_dir)
+        if workspace_id is None:
+            return
+        with self.lock:
+            entry = self.workspaces.pop(workspace_id, None)
+            if entry is not None:
+                self.total_bytes -= entry['size_bytes']
+                self.stats['released'] += 1
+        shutil.rmtree(os.path.join(self.root, workspace_id), ignore_errors=True)
+
+    def cleanup(self, now: float = None) -> int:
+        """Delete expired workspaces of this process; returns how many"""
+        now = now or time.time()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                expires_at, workspace_id = heapq.heappop(self.heap)
+                entry = self.workspaces.get(workspace_id)
+                if entry is None or entry['expires_at'] != expires_at:
+                    continue            # released, evicted or touched since
+                due.append((expires_at, workspace_id))
+
+        # touch() from another process only bumps the mtime: stat outside the lock
+        touched = {}
+        for expires_at, workspace_id in due:
+            try:
+                touched_until = os.path.getmtime(os.path.join(self.root, workspace_id)) + self.ttl_seconds
+            except OSError:
+                continue
+            if touched_until > now:
+                touched[workspace_id] = touched_until
+
+        expired = []
+        with self.lock:
+            for expires_at, workspace_id in due:
+                entry = self.workspaces.get(workspace_id)
+                if entry is None or entry['expires_at'] != expires_at:
+                    continue            # changed while we were stat-ing
+                if workspace_id in touched:
+                    entry['expires_at'] = touched[workspace_id]
+                    heapq.heappush(self.heap, (entry['expires_at'], workspace_id))
+                    continue
+                self.total_bytes -= self.workspaces.pop(workspace_id)['size_bytes']
+                expired.append(workspace_id)
+            self.stats['expired'] += len(expired)
+            if len(self.heap) > 4 * len(self.workspaces) + 64:
+                self.heap = [(entry['expires_at'], key) for key, entry in self.workspaces.items()]
+                heapq.heapify(self.heap)
+        for workspace_id in expired:
+            shutil.rmtree(os.path.join(self.root, workspace_id), ignore_errors=True)
+        if now - self._last_orphan_sweep >= ORPHAN_SWEEP_SECONDS:
+            self._last_orphan_sweep = now
+            self._sweep_orphans(now)
+        return len(expired)
+
+    def _sweep_orphans(self, now: float):
+        """Remove workspaces no live index owns any more (crashed or recycled workers)"""
+        removed = 0
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return
+        for name in names:
+            if not WORKSPACE_ID_RE.match(name) or name in self.workspaces:
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                if now - os.path.getmtime(path) > 2 * self.ttl_seconds:
+                    shutil.rmtree(path, ignore_errors=True)
+                    removed += 1
+            except OSError:
+                pass
+        if removed:
+            with self.lock:
+                self.stats['orphans_removed'] += removed
+            logger.info(f"Removed {removed} orphaned compile workspaces")
+
+    def ensure_started(self):
+        """Start the cleanup thread once per process (gunicorn preload forks after import)"""
+        if self._started_pid == os.getpid():
+            return
+        with self.lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+        threading.Thread(target=self._loop, name="workspace-cleanup", daemon=True).start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.cleanup()
+            except Exception:
+                logger.exception("Workspace cleanup failed")
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                'root': self.root,
+                'workspaces': len(self.workspaces),
+                'size_mb': round(self.total_bytes / (1024 * 1024), 2),
+                'quota_mb': round(self.quota_bytes / (1024 * 1024), 2),
+                'ttl_seconds': self.ttl_seconds,
+                **self.stats
+            }
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return total
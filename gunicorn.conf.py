@@ -22,6 +22,17 @@ backlog = 2048           # Maximum number of pending connections
 # Worker processes (Conservative for VPS)
 workers = int(os.environ.get("GUNICORN_WORKERS", 2))  # 2 workers for VPS
 worker_class = "sync"    # Sync workers for LaTeX compilation (CPU intensive)
+threads = 1              # threads > 1 would silently turn sync workers into gthread
+
+# Compile daemon: LaTeX runs in compile_daemon.py, web workers only wait on a
+# Unix socket, so they can be I/O-oriented threaded workers
+compile_daemon_socket = os.environ.get("TIKZ_COMPILE_DAEMON_SOCKET")
+compile_daemon_autostart = os.environ.get("TIKZ_COMPILE_DAEMON_AUTOSTART") == "1"
+if compile_daemon_socket:
+    worker_class = "gthread"
+    threads = int(os.environ.get("GUNICORN_THREADS", 8))
+    # SSE job streams only tie up one thread here (the app is preloaded after this file runs)
+    os.environ.setdefault("TIKZ_COMPILE_EVENTS", "1")
 worker_connections = 1000
 max_requests = 1000      # Restart workers after 1000 requests
 max_requests_jitter = 50 # Add randomness to prevent thundering herd
@@ -113,6 +124,20 @@ keepalive = 5
 # 📈 MONITORING HOOKS
 # ================================
 
+compile_daemon_process = None
+
+def on_starting(server):
+    """Called before the master process is initialized"""
+    global compile_daemon_process
+    if compile_daemon_socket and compile_daemon_autostart:
+        import sys
+        import subprocess
+        compile_daemon_process = subprocess.Popen([
+            sys.executable, str(Path(__file__).parent / "compile_daemon.py"),
+            "--socket", compile_daemon_socket
+        ])
+        print(f"🧮 Compile daemon started (PID: {compile_daemon_process.pid})")
+
 def when_ready(server):
     """Called just after the server is started"""
     print("🚀 Gunicorn server started successfully")
@@ -160,6 +185,13 @@ def pre_exec(server):
 def on_exit(server):
     """Called when gunicorn is about to exit"""
     print("👋 Gunicorn server shutting down")
+
+    if compile_daemon_process and compile_daemon_process.poll() is None:
+        compile_daemon_process.terminate()
+        try:
+            compile_daemon_process.wait(timeout=graceful_timeout)
+        except Exception:
+            compile_daemon_process.kill()
     
     # Log shutdown
     with open(log_dir / "startup.log", "a") as f:
@@ -220,6 +252,9 @@ print("=" * 60)
 print(f"Bind: {bind}")
 print(f"Workers: {workers}")
 print(f"Worker Class: {worker_class}")
+print(f"Threads: {threads}")
+print(f"Compile Daemon: {compile_daemon_socket or 'in-process'}")
+print(f"Compile SSE: {'on' if os.environ.get('TIKZ_COMPILE_EVENTS') == '1' else 'off (poll /api/compile/<id>)'}")
 print(f"Timeout: {timeout}s")
 print(f"Max Requests: {max_requests}")
 print(f"Preload App: {preload_app}")
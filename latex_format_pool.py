@@ -0,0 +1,426 @@
+"""
+LuaLaTeX Format Pool
+====================
+Precompiled LuaLaTeX format files (.fmt) for the TikZ preambles generated by
+generate_latex_source().
+
+Every compile used to reload fontspec, tikz, pgfplots, tkz-euclide... from
+scratch. The pool dumps one format per distinct preamble (keyed by a hash of
+the preamble, i.e. TEX_TEMPLATE + injected \\usepackage/\\usetikzlibrary lines)
+with mylatexformat, keeps them in an LRU pool on disk, and lets the compile
+stage start lualatex from that format so only the document body is processed.
+
+Notes:
+- fontspec/polyglossia cannot be dumped in a LuaTeX format (luaotfload state
+  lives in Lua), so they are moved after \\endofdump and loaded at runtime.
+- Formats are built by one background builder thread per process, fed by a
+  small bounded queue; the request that triggers the build compiles normally,
+  later requests with the same preamble use the .fmt.
+- Only preambles seen min_uses times get a format: per-diagram (minimal)
+  preambles would otherwise churn the LRU with one-off builds.
+- A build takes a free host compile slot (HostCompileSlots.try_acquire, batch
+  lane) and runs under the LaTeXSandbox limits; with no free slot it is
+  skipped and scheduled again on a later request.
+- The .fmt directory is shared by all gunicorn workers; mtime is used as the
+  cross-process LRU clock and a lock file prevents duplicate builds.
+- The engine version (part of the key) is probed once at startup.
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import logging
+import queue
+import threading
+import subprocess
+from collections import OrderedDict
+from typing import Optional, Dict
+
+try:
+    import fcntl
+except ImportError:  # Windows dev machines
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+BEGIN_DOCUMENT = r"\begin{document}"
+END_OF_DUMP = r"\endofdump"
+
+# Packages that must be loaded after the format (cannot be dumped)
+RUNTIME_ONLY_PACKAGES = ("fontspec", "polyglossia")
+
+FORMAT_POOL_USER = "format-pool"     # lease owner in the host compile slots
+MAX_TRACKED_PREAMBLES = 256
+
+
+def split_latex_source(latex_source: str) -> tuple[str, str]:
+    """
+    Split LaTeX source into (preamble, body) at the first \\begin{document}
+    The body keeps the \\begin{document} line
+    """
+    index = latex_source.find(BEGIN_DOCUMENT)
+    if index < 0:
+        return latex_source, ""
+    return latex_source[:index], latex_source[index:]
+
+
+def _is_runtime_only_line(line: str) -> bool:
+    """Check if a preamble line loads a package that cannot be dumped"""
+    stripped = line.strip()
+    if not stripped.startswith(r"\usepackage"):
+        return False
+    return any(f"{{{pkg}}}" in stripped for pkg in RUNTIME_ONLY_PACKAGES)
+
+
+def split_preamble_for_dump(preamble: str) -> tuple[str, str]:
+    """
+    Split preamble into (dumpable part, runtime-only part)
+    """
+    dump_lines = []
+    runtime_lines = []
+    for line in preamble.split("\n"):
+        if _is_runtime_only_line(line):
+            runtime_lines.append(line.strip())
+        else:
+            dump_lines.append(line)
+    return "\n".join(dump_lines), "\n".join(runtime_lines)
+
+
+class LaTeXFormatPool:
+    """LRU pool of precompiled LuaLaTeX formats keyed by preamble hash"""
+
+    def __init__(self, format_dir: str, max_formats: int = 8, engine: str = "lualatex",
+                 build_timeout: int = 120, retry_failed_after: int = 600, enabled: bool = True,
+                 min_uses: int = 3, max_queued_builds: int = 4, sandbox=None, slots=None,
+                 memory_mb: int = 1000):
+        self.format_dir = format_dir
+        self.max_formats = max(1, max_formats)
+        self.engine = engine
+        self.build_timeout = build_timeout
+        self.retry_failed_after = retry_failed_after
+        self.enabled = enabled
+        self.min_uses = max(1, min_uses)   # sightings of a preamble before its format is built
+        self.max_queued_builds = max(1, max_queued_builds)
+        self.sandbox = sandbox             # LaTeXSandbox: limits and priority for builds
+        self.slots = slots                 # HostCompileSlots: a build holds one slot
+        self.memory_mb = memory_mb
+
+        self.formats = OrderedDict()       # key -> format info (LRU order)
+        self.building = set()              # keys queued or being built by this process
+        self.failed = {}                   # key -> failure timestamp
+        self.seen = OrderedDict()          # key -> misses counted (bounded, LRU)
+        self.lock = threading.Lock()
+        self._engine_version = None
+        self._queue = None                 # per-process build queue + builder thread
+        self._builder_pid = None
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'builds': 0,
+            'build_failures': 0,
+            'builds_dropped': 0,
+            'builds_no_slot': 0,
+            'evictions': 0,
+            'runtime_fallbacks': 0,
+            'total_build_seconds': 0.0
+        }
+
+        if self.enabled:
+            try:
+                os.makedirs(self.format_dir, exist_ok=True)
+            except OSError as e:
+                logger.warning(f"Format pool disabled, cannot create {self.format_dir}: {e}")
+                self.enabled = False
+        if self.enabled:
+            self._get_engine_version()     # at startup, not on the first request
+
+    def _get_engine_version(self) -> str:
+        """First line of `lualatex --version` (formats are not portable across TeX Live releases)"""
+        if self._engine_version is None:
+            try:
+                result = subprocess.run([self.engine, "--version"], capture_output=True, text=True, timeout=10)
+                self._engine_version = (result.stdout or "").split("\n", 1)[0].strip()
+            except Exception:
+                self._engine_version = "unknown"
+        return self._engine_version
+
+    def format_key(self, dump_preamble: str) -> str:
+        """Hash of engine version + dumpable preamble"""
+        key_input = f"{self.engine}\n{self._get_engine_version()}\n{dump_preamble.strip()}"
+        return "tikzfmt-" + hashlib.sha256(key_input.encode("utf-8")).hexdigest()[:24]
+
+    def _format_path(self, key: str) -> str:
+        return os.path.join(self.format_dir, f"{key}.fmt")
+
+    def _compile_env(self) -> dict:
+        """Environment so kpathsea finds formats in the pool directory"""
+        env = os.environ.copy()
+        env["TEXFORMATS"] = f"{self.format_dir}:{env.get('TEXFORMATS', '')}"
+        return env
+
+    def acquire(self, latex_source: str) -> Optional[Dict]:
+        """
+        Get a ready format for this LaTeX source
+        Returns: {'format_name', 'source', 'env', 'key'} or None (compile normally)
+        A missing format is scheduled for a background build
+        """
+        if not self.enabled:
+            return None
+
+        preamble, body = split_latex_source(latex_source)
+        if not body:
+            return None
+
+        dump_preamble, runtime_preamble = split_preamble_for_dump(preamble)
+        key = self.format_key(dump_preamble)
+        fmt_path = self._format_path(key)
+
+        with self.lock:
+            if os.path.exists(fmt_path):
+                # Hit (built by this process or adopted from another worker)
+                info = self.formats.pop(key, None) or {
+                    'built_at': os.path.getmtime(fmt_path),
+                    'uses': 0,
+                    'build_seconds': 0.0
+                }
+                info['uses'] += 1
+                info['last_used'] = time.time()
+                self.formats[key] = info
+                self.stats['hits'] += 1
+                try:
+                    os.utime(fmt_path, None)  # Shared LRU clock across workers
+                except OSError:
+                    pass
+
+                runtime_source = (
+                    dump_preamble.rstrip("\n") + "\n" + END_OF_DUMP + "\n"
+                    + (runtime_preamble + "\n" if runtime_preamble else "")
+                    + body
+                )
+                return {
+                    'format_name': key,
+                    'source': runtime_source,
+                    'env': self._compile_env(),
+                    'key': key
+                }
+
+            self.formats.pop(key, None)
+            self.stats['misses'] += 1
+
+            uses = self.seen.pop(key, 0) + 1
+            self.seen[key] = uses
+            while len(self.seen) > MAX_TRACKED_PREAMBLES:
+                self.seen.popitem(last=False)
+            if uses < self.min_uses:
+                return None
+
+            failed_at = self.failed.get(key)
+            if failed_at and time.time() - failed_at < self.retry_failed_after:
+                return None
+            if key in self.building:
+                return None
+            build_queue = self._get_queue()
+            try:
+                build_queue.put_nowait((key, dump_preamble))
+            except queue.Full:
+                self.stats['builds_dropped'] += 1   # seen again later, queued then
+                return None
+            self.building.add(key)
+        return None
+
+    def _get_queue(self) -> queue.Queue:
+        """Bounded build queue and its single builder thread, per process (called with lock held)"""
+        if self._queue is None or self._builder_pid != os.getpid():
+            self._queue = queue.Queue(maxsize=self.max_queued_builds)
+            self._builder_pid = os.getpid()
+            self.building = set()
+            threading.Thread(target=self._builder_loop, args=(self._queue,), daemon=True,
+                             name="fmt-builder").start()
+        return self._queue
+
+    def _builder_loop(self, build_queue: queue.Queue):
+        while True:
+            key, dump_preamble = build_queue.get()
+            try:
+                self._build_format(key, dump_preamble)
+            except Exception as e:
+                logger.warning(f"Format build error for {key}: {e}")
+                with self.lock:
+                    self.building.discard(key)
+
+    def _build_format(self, key: str, dump_preamble: str):
+        """Dump a format with mylatexformat (runs in the builder thread)"""
+        lease = None
+        if self.slots:
+            lease = self.slots.try_acquire(FORMAT_POOL_USER, 'batch', lease_seconds=self.build_timeout + 30)
+            if lease is None:
+                # Host busy: not a failure, a later request schedules the build again
+                with self.lock:
+                    self.building.discard(key)
+                    self.stats['builds_no_slot'] += 1
+                return
+
+        lock_path = os.path.join(self.format_dir, f"{key}.lock")
+        build_dir = os.path.join(self.format_dir, f"build-{key}-{os.getpid()}")
+        lock_file = None
+        start_time = time.time()
+        success = False
+
+        try:
+            lock_file = open(lock_path, "w")
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Another worker is building the same format
+                    return
+
+            if os.path.exists(self._format_path(key)):
+                success = True
+                return
+
+            os.makedirs(build_dir, exist_ok=True)
+            with open(os.path.join(build_dir, f"{key}.tex"), "w", encoding="utf-8") as f:
+                f.write(dump_preamble.rstrip("\n") + "\n" + END_OF_DUMP + "\n")
+
+            cmd = [
+                self.engine,
+                "-ini",
+                "-interaction=nonstopmode",
+                "-halt-on-error",
+                f"-jobname={key}",
+                f"&{self.engine}",
+                "mylatexformat.ltx",
+                f"{key}.tex"
+            ]
+            if self.sandbox:
+                result = self.sandbox.run(cmd, cwd=build_dir, timeout_seconds=self.build_timeout,
+                                          memory_mb=self.memory_mb)
+            else:
+                result = subprocess.run(cmd, cwd=build_dir, capture_output=True, text=True,
+                                        timeout=self.build_timeout)
+
+            built_fmt = os.path.join(build_dir, f"{key}.fmt")
+            if result.returncode != 0 or not os.path.exists(built_fmt):
+                tail = (result.stdout or result.stderr or "")[-500:]
+                logger.warning(f"Format build failed for {key}: {tail}")
+                return
+
+            os.replace(built_fmt, self._format_path(key))
+            success = True
+
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Format build timeout for {key} ({self.build_timeout}s)")
+        except Exception as e:
+            logger.warning(f"Format build error for {key}: {e}")
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+            if lease:
+                self.slots.release(lease, record_duration=False)
+            if lock_file is not None:
+                lock_file.close()
+                try:
+                    os.remove(lock_path)
+                except OSError:
+                    pass
+
+            build_seconds = time.time() - start_time
+            with self.lock:
+                self.building.discard(key)
+                if success:
+                    self.failed.pop(key, None)
+                    self.formats[key] = {
+                        'built_at': time.time(),
+                        'last_used': time.time(),
+                        'uses': 0,
+                        'build_seconds': round(build_seconds, 2)
+                    }
+                    self.stats['builds'] += 1
+                    self.stats['total_build_seconds'] += build_seconds
+                    logger.info(f"Format {key} ready in {build_seconds:.2f}s")
+                else:
+                    self.failed[key] = time.time()
+                    self.stats['build_failures'] += 1
+
+            if success:
+                self._evict_lru_formats()
+
+    def _evict_lru_formats(self):
+        """Keep at most max_formats .fmt files on disk (oldest mtime first)"""
+        try:
+            fmt_files = [
+                os.path.join(self.format_dir, name)
+                for name in os.listdir(self.format_dir)
+                if name.endswith(".fmt")
+            ]
+        except OSError:
+            return
+
+        if len(fmt_files) <= self.max_formats:
+            return
+
+        fmt_files.sort(key=lambda path: os.path.getmtime(path) if os.path.exists(path) else 0)
+        for path in fmt_files[:len(fmt_files) - self.max_formats]:
+            key = os.path.basename(path)[:-len(".fmt")]
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            with self.lock:
+                self.formats.pop(key, None)
+                self.stats['evictions'] += 1
+
+    def is_format_error(self, error_output: str) -> bool:
+        """Check if a compile failed because of the format itself (not user code)"""
+        text = (error_output or "").lower()
+        return "format file" in text or "fatal format" in text
+
+    def discard(self, key: str):
+        """Drop a broken format so it gets rebuilt"""
+        with self.lock:
+            self.formats.pop(key, None)
+            self.stats['runtime_fallbacks'] += 1
+        try:
+            os.remove(self._format_path(key))
+        except OSError:
+            pass
+
+    def get_stats(self) -> dict:
+        """Get format pool statistics"""
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                'enabled': self.enabled,
+                'format_dir': self.format_dir,
+                'formats_count': len(self.formats),
+                'max_formats': self.max_formats,
+                'building': len(self.building),
+                'min_uses': self.min_uses,
+                'hit_rate_percent': round(self.stats['hits'] / max(1, lookups) * 100, 2),
+                'hits': self.stats['hits'],
+                'misses': self.stats['misses'],
+                'builds': self.stats['builds'],
+                'build_failures': self.stats['build_failures'],
+                'builds_dropped': self.stats['builds_dropped'],
+                'builds_no_slot': self.stats['builds_no_slot'],
+                'evictions': self.stats['evictions'],
+                'runtime_fallbacks': self.stats['runtime_fallbacks'],
+                'avg_build_seconds': round(self.stats['total_build_seconds'] / max(1, self.stats['builds']), 2)
+            }
+
+    def clear(self):
+        """Remove all formats from disk"""
+        with self.lock:
+            try:
+                fmt_names = [name for name in os.listdir(self.format_dir) if name.endswith(".fmt")]
+            except OSError:
+                fmt_names = []
+            for name in fmt_names:
+                try:
+                    os.remove(os.path.join(self.format_dir, name))
+                except OSError:
+                    pass
+            self.formats.clear()
+            self.failed.clear()
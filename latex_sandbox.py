@@ -0,0 +1,323 @@
+"""
+LaTeX Subprocess Sandbox
+========================
+Runs lualatex/pdflatex and the SVG converters with enforced limits, so one
+runaway job cannot starve the web workers:
+
+- every run gets its own process group (start_new_session) and the whole
+  group is SIGKILLed on timeout, or as soon as the caller's cancelled()
+  check turns true (compile superseded by a newer request)
+- RLIMIT_CPU always; memory through a cgroup v2 child (memory.max, cpu.max)
+  when a delegated cgroup root is configured, otherwise RLIMIT_AS
+- lower CPU (nice) and I/O (ionice) priority than the web workers
+- limits are applied by the parent to the child's PID right after Popen
+  (prlimit, setpriority, cgroup.procs): no preexec_fn in a threaded worker
+- peak RSS and CPU time of each run are taken from wait4() rusage (and
+  memory.peak of the cgroup when available); cpu_meter() adds up the CPU of
+  the runs reaped on the current thread (e.g. the cache warmer's own compiles)
+- stdout is read incrementally while the process runs (OutputTail over the
+  capture file, no pipe to drain); a stop_on_output line callback can end
+  the run early, e.g. at the first fatal LaTeX error (tex_log)
+
+RLIMIT_AS counts virtual address space (mapped format and font files
+included), so it is set to the RSS budget plus a fixed headroom.
+"""
+
+import os
+import time
+import uuid
+import signal
+import logging
+import resource
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+import psutil
+
+from compile_cancel import CompilationCancelled
+
+logger = logging.getLogger(__name__)
+
+WAIT_POLL_INTERVAL = 0.02
+OUTPUT_READ_CHUNK = 64 * 1024
+OUTPUT_MAX_WATCH_BYTES = 8 * 1024 * 1024     # lines past this are not watched (still captured)
+
+
+class OutputTail:
+    """
+    Reads what a child has written to its output file so far (pread at our own
+    offset) and calls on_line for each complete line; the instance is the
+    stop_early callable of LaTeXSandbox.wait (True when on_line returned True)
+    """
+
+    def __init__(self, fd: int, on_line: Callable[[str], bool]):
+        self.fd = fd
+        self.on_line = on_line
+        self.offset = 0
+        self.partial = b""
+
+    def __call__(self) -> bool:
+        while self.offset < OUTPUT_MAX_WATCH_BYTES:
+            chunk = os.pread(self.fd, OUTPUT_READ_CHUNK, self.offset)
+            if not chunk:
+                return False
+            self.offset += len(chunk)
+            lines = (self.partial + chunk).split(b"\n")
+            self.partial = lines.pop()[-OUTPUT_READ_CHUNK:]
+            for line in lines:
+                if self.on_line(line.decode("utf-8", errors="replace").rstrip("\r")):
+                    return True
+        return False
+
+
+class LaTeXSandbox:
+    """Spawn and reap subprocesses under memory/CPU/priority limits"""
+
+    def __init__(self, nice: int = 10, ionice: str = "idle", address_space_overhead_mb: int = 700,
+                 cgroup_root: Optional[str] = None, cpu_percent: Optional[int] = None):
+        self.nice = nice
+        self.ionice = ionice                      # 'idle' | 'besteffort' | 'off'
+        self.address_space_overhead_mb = address_space_overhead_mb
+        self.cpu_percent = cpu_percent            # cgroup cpu.max, percent of one core
+        self.cgroup_root = cgroup_root if cgroup_root and self._cgroup_usable(cgroup_root) else None
+        if cgroup_root and not self.cgroup_root:
+            logger.warning(f"cgroup root {cgroup_root} not usable, falling back to RLIMIT_AS")
+
+        self.lock = threading.Lock()
+        self._meters = threading.local()          # cpu_meter() of the current thread
+        self.stats = {
+            'runs': 0,
+            'timeouts': 0,
+            'cancelled': 0,
+            'stopped_early': 0,
+            'limit_kills': 0,
+            'max_peak_rss_mb': 0.0,
+            'total_cpu_seconds': 0.0
+        }
+
+    @staticmethod
+    def _cgroup_usable(root: str) -> bool:
+        return os.path.exists(os.path.join(root, "cgroup.controllers")) and os.access(root, os.W_OK)
+
+    def _create_cgroup(self, memory_mb: int) -> Optional[str]:
+        path = os.path.join(self.cgroup_root, f"compile-{uuid.uuid4().hex[:12]}")
+        try:
+            os.mkdir(path)
+            with open(os.path.join(path, "memory.max"), "w") as f:
+                f.write(str(memory_mb * 1024 * 1024))
+            if self.cpu_percent:
+                with open(os.path.join(path, "cpu.max"), "w") as f:
+                    f.write(f"{self.cpu_percent * 1000} 100000")
+        except OSError as e:
+            logger.warning(f"Cannot set up cgroup {path}: {e}")
+            self._remove_cgroup(path)
+            return None
+        try:
+            with open(os.path.join(path, "memory.swap.max"), "w") as f:
+                f.write("0")
+        except OSError:
+            pass   # swap controller not enabled
+        return path
+
+    @staticmethod
+    def _remove_cgroup(path: Optional[str]):
+        if path:
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+
+    @contextmanager
+    def cpu_meter(self):
+        """Yields {'cpu_seconds'}: CPU of every run reaped on this thread inside the block"""
+        meter = {'cpu_seconds': 0.0}
+        outer = getattr(self._meters, 'meter', None)
+        self._meters.meter = meter
+        try:
+            yield meter
+        finally:
+            self._meters.meter = outer
+            if outer is not None:
+                outer['cpu_seconds'] += meter['cpu_seconds']
+
+    def _apply_limits(self, pid: int, memory_mb: int, cpu_seconds: int, cgroup_path: Optional[str]):
+        """
+        Applied from the parent right after Popen (no preexec_fn: the web worker
+        is multi-threaded and Python code between fork and exec can deadlock).
+        The child has at most just exec'd by now, long before LaTeX allocates
+        anything that matters. Raises OSError if a limit cannot be applied
+        """
+        in_cgroup = False
+        if cgroup_path:
+            try:
+                with open(os.path.join(cgroup_path, "cgroup.procs"), "w") as f:
+                    f.write(str(pid))
+                in_cgroup = True
+            except OSError as e:
+                logger.warning(f"Cannot move PID {pid} into {cgroup_path}: {e}")
+        if not in_cgroup:
+            address_space = (memory_mb + self.address_space_overhead_mb) * 1024 * 1024
+            resource.prlimit(pid, resource.RLIMIT_AS, (address_space, address_space))
+        # SIGXCPU at the soft limit, SIGKILL at the hard limit
+        resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 5))
+        if self.nice:
+            priority = min(os.getpriority(os.PRIO_PROCESS, 0) + self.nice, 19)
+            os.setpriority(os.PRIO_PROCESS, pid, priority)
+
+    def _set_ionice(self, pid: int):
+        if self.ionice == "off":
+            return
+        try:
+            if self.ionice == "idle":
+                psutil.Process(pid).ionice(psutil.IOPRIO_CLASS_IDLE)
+            else:
+                psutil.Process(pid).ionice(psutil.IOPRIO_CLASS_BE, value=7)
+        except (psutil.Error, AttributeError, ValueError):
+            pass   # not supported on this platform / process already gone
+
+    def spawn(self, cmd: list, cwd: str, memory_mb: int, cpu_seconds: int, env: dict = None,
+              stdin=None, stdout=None, stderr=None, text: bool = True) -> subprocess.Popen:
+        """Start cmd in its own process group under the limits (reap it with wait())"""
+        cgroup_path = self._create_cgroup(memory_mb) if self.cgroup_root else None
+        try:
+            process = subprocess.Popen(
+                cmd,
+                cwd=cwd,
+                env=env,
+                stdin=stdin,
+                stdout=stdout,
+                stderr=stderr,
+                text=text,
+                start_new_session=True
+            )
+        except Exception:
+            self._remove_cgroup(cgroup_path)
+            raise
+        process.sandbox_cgroup = cgroup_path
+        try:
+            self._apply_limits(process.pid, memory_mb, cpu_seconds, cgroup_path)
+        except ProcessLookupError:
+            pass   # already exited; wait() reaps it
+        except OSError as e:
+            # never let a job run unlimited
+            self.kill_group(process)
+            process.wait()
+            self._remove_cgroup(cgroup_path)
+            raise RuntimeError(f"Cannot apply sandbox limits to {cmd[0]}: {e}") from e
+        self._set_ionice(process.pid)
+        return process
+
+    @staticmethod
+    def kill_group(process: subprocess.Popen):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def wait(self, process: subprocess.Popen, timeout_seconds: float,
+             cancelled: Optional[Callable[[], bool]] = None,
+             stop_early: Optional[Callable[[], bool]] = None) -> dict:
+        """
+        Wait for exit, kill leftover group members, reap with rusage
+        Returns {'peak_rss_mb', 'cpu_seconds'}; raises subprocess.TimeoutExpired (group killed)
+        Raises CompilationCancelled (group killed) once cancelled() returns True
+        stop_early() returning True kills the group as well but is a normal return
+        (process.stopped_early = True, returncode -SIGKILL)
+        """
+        deadline = time.monotonic() + timeout_seconds
+        timed_out = False
+        was_cancelled = False
+        process.stopped_early = False
+        while True:
+            # WNOWAIT: leader stays a zombie, so its process group id cannot be reused yet
+            exited = os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+            if exited is not None:
+                break
+            if time.monotonic() >= deadline:
+                timed_out = True
+                break
+            if cancelled is not None and cancelled():
+                was_cancelled = True
+                break
+            if stop_early is not None and stop_early():
+                process.stopped_early = True
+                break
+            time.sleep(WAIT_POLL_INTERVAL)
+
+        self.kill_group(process)
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        cgroup_path = getattr(process, 'sandbox_cgroup', None)
+        peak_rss_mb = rusage.ru_maxrss / 1024      # KB on Linux
+        if cgroup_path:
+            try:
+                with open(os.path.join(cgroup_path, "memory.peak")) as f:
+                    peak_rss_mb = max(peak_rss_mb, int(f.read().strip()) / (1024 ** 2))
+            except (OSError, ValueError):
+                pass
+            self._remove_cgroup(cgroup_path)
+
+        usage = {
+            'peak_rss_mb': round(peak_rss_mb, 1),
+            'cpu_seconds': round(rusage.ru_utime + rusage.ru_stime, 3)
+        }
+        limit_kill = (not (timed_out or was_cancelled or process.stopped_early)
+                      and process.returncode in (-signal.SIGKILL, -signal.SIGXCPU))
+        with self.lock:
+            self.stats['runs'] += 1
+            self.stats['timeouts'] += timed_out
+            self.stats['cancelled'] += was_cancelled
+            self.stats['stopped_early'] += process.stopped_early
+            self.stats['limit_kills'] += limit_kill
+            self.stats['max_peak_rss_mb'] = max(self.stats['max_peak_rss_mb'], usage['peak_rss_mb'])
+            self.stats['total_cpu_seconds'] = round(self.stats['total_cpu_seconds'] + usage['cpu_seconds'], 3)
+        meter = getattr(self._meters, 'meter', None)
+        if meter is not None:
+            meter['cpu_seconds'] += usage['cpu_seconds']
+
+        if timed_out:
+            raise subprocess.TimeoutExpired(process.args, timeout_seconds)
+        if was_cancelled:
+            raise CompilationCancelled(f"{process.args[0]} cancelled after {usage['cpu_seconds']}s CPU")
+        return usage
+
+    def run(self, cmd: list, cwd: str, timeout_seconds: float, memory_mb: int, cpu_seconds: int = None,
+            env: dict = None, check: bool = False,
+            cancelled: Optional[Callable[[], bool]] = None,
+            stop_on_output: Optional[Callable[[str], bool]] = None) -> subprocess.CompletedProcess:
+        """
+        subprocess.run() replacement: CompletedProcess with .usage = {'peak_rss_mb', 'cpu_seconds'}
+        stop_on_output(line) sees stdout lines as they are written; True ends the run
+        (.stopped_early = True, stdout holds everything up to that point)
+        Raises subprocess.TimeoutExpired, CompilationCancelled, and CalledProcessError when check=True
+        """
+        cpu_seconds = cpu_seconds or int(timeout_seconds) + 1
+        with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+            process = self.spawn(cmd, cwd, memory_mb, cpu_seconds, env=env,
+                                 stdin=subprocess.DEVNULL, stdout=out, stderr=err, text=False)
+            usage = self.wait(process, timeout_seconds, cancelled=cancelled,
+                              stop_early=OutputTail(out.fileno(), stop_on_output) if stop_on_output else None)
+            out.seek(0)
+            err.seek(0)
+            stdout = out.read().decode("utf-8", errors="replace")
+            stderr = err.read().decode("utf-8", errors="replace")
+
+        completed = subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+        completed.usage = usage
+        completed.stopped_early = process.stopped_early
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+        return completed
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                'mode': 'cgroup' if self.cgroup_root else 'rlimit',
+                'nice': self.nice,
+                'ionice': self.ionice,
+                **self.stats
+            }
@@ -0,0 +1,431 @@
+"""
+LuaLaTeX Warm Pool
+==================
+Pre-started lualatex processes that have already loaded the preamble and are
+parked at \\begin{document}, waiting for the diagram body.
+
+How a worker works:
+- Its tikz.tex is `<preamble>\\begin{document}` followed by a \\read from the
+  terminal (stdin) and \\input{body}. lualatex loads every package, then blocks
+  on the read without using CPU.
+- A job writes body.tex into the worker directory, sends one line on stdin and
+  waits; tikz.pdf/tikz.log are then moved to the job's work_dir.
+
+A LaTeX run only finalizes its PDF when the process exits, so a worker serves
+exactly one job and is then replaced. Workers are also recycled when they sit
+idle longer than max_idle_seconds, and discarded on any error (died while
+parked, failed job, timeout). The pool keeps one parked worker for each of the
+most requested preambles.
+
+Parked workers hold memory, so each one holds a host compile slot
+(HostCompileSlots.try_acquire, batch lane: only a free slot nobody is waiting
+for) and runs under the adaptive memory limit; no slot, no worker. The lease
+is preemptible: once requests queue for slots it is revoked, and the
+maintainer thread kills the worker within maintain_interval seconds. The slot
+also goes back when a job takes the worker (the job holds its own) or when the
+worker is killed.
+
+Spawning and recycling run on one maintainer thread per process; run() only
+takes a parked worker and wakes the maintainer, so requests never pay for a
+lualatex start-up.
+"""
+
+import os
+import time
+import uuid
+import shutil
+import signal
+import hashlib
+import logging
+import threading
+import subprocess
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from latex_sandbox import OutputTail
+
+logger = logging.getLogger(__name__)
+
+BEGIN_DOCUMENT = r"\begin{document}"
+END_DOCUMENT = r"\end{document}"
+
+# Parked after the preamble; a single stdin line releases the worker
+WARM_POOL_USER = "warm-pool"        # lease owner in the host compile slots
+LEASE_MARGIN_SECONDS = 60
+
+WARM_DOCUMENT_TAIL = r"""\begin{document}
+{\endlinechar=-1 \global\read-1 to \tikzwarmgo}
+\input{body}
+\end{document}
+"""
+
+
+def split_document_body(latex_source: str) -> tuple[str, Optional[str]]:
+    """
+    Split LaTeX source into (preamble, body between \\begin{document} and \\end{document})
+    Returns (source, None) if the source has no document environment
+    """
+    begin = latex_source.find(BEGIN_DOCUMENT)
+    end = latex_source.rfind(END_DOCUMENT)
+    if begin < 0 or end < begin:
+        return latex_source, None
+    return latex_source[:begin], latex_source[begin + len(BEGIN_DOCUMENT):end]
+
+
+class LuaLaTeXWarmPool:
+    """Pool of lualatex processes parked at \\begin{document}"""
+
+    def __init__(self, pool_dir: str, size: int = 2, max_idle_seconds: int = 300,
+                 engine: str = "lualatex", max_tracked_preambles: int = 32,
+                 sandbox=None, memory_mb: int = 300, memory_limit: Optional[Callable[[], int]] = None,
+                 slots=None, maintain_interval: float = 1.0):
+        self.pool_dir = pool_dir
+        self.sandbox = sandbox           # LaTeXSandbox: limits, priority and rusage for workers
+        self.memory_mb = memory_mb
+        self.memory_limit = memory_limit # current adaptive memory limit (MB); memory_mb when None
+        self.slots = slots               # HostCompileSlots: a parked worker holds one slot
+        self.size = max(0, size)
+        self.max_idle_seconds = max_idle_seconds
+        self.engine = engine
+        self.max_tracked_preambles = max_tracked_preambles
+        self.maintain_interval = maintain_interval
+        self.enabled = self.size > 0
+
+        self.parked = {}                 # preamble key -> list of worker dicts
+        self.spawning = set()            # preamble keys with a spawn in progress (outside the lock)
+        self.demand = OrderedDict()      # preamble key -> {'preamble', 'count', 'last_seen'}
+        self.lock = threading.Lock()
+        self._owner_pid = os.getpid()    # gunicorn preload: workers must not reuse the master's children
+        self._wake = threading.Event()   # run() -> maintainer: replenish now
+        self._maintainer_pid = None
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'spawned': 0,
+            'no_slot': 0,
+            'preempted': 0,
+            'recycled_idle': 0,
+            'discarded_errors': 0,
+            'timeouts': 0
+        }
+
+        if self.enabled:
+            try:
+                os.makedirs(self.pool_dir, exist_ok=True)
+            except OSError as e:
+                logger.warning(f"Warm pool disabled, cannot create {self.pool_dir}: {e}")
+                self.enabled = False
+
+    def _preamble_key(self, preamble: str) -> str:
+        return hashlib.sha256(preamble.strip().encode("utf-8")).hexdigest()[:16]
+
+    def _check_fork(self):
+        """Forget workers inherited from the parent process (called with lock held)"""
+        if os.getpid() != self._owner_pid:
+            self._owner_pid = os.getpid()
+            self.parked = {}
+            self.spawning = set()
+
+    def _ensure_maintainer(self):
+        """Start this process's maintainer thread (called with lock held)"""
+        if self._maintainer_pid != os.getpid():
+            self._maintainer_pid = os.getpid()
+            self._wake = threading.Event()
+            threading.Thread(target=self._maintain_loop, daemon=True, name="warm-pool-maintainer").start()
+
+    def _maintain_loop(self):
+        while True:
+            self._wake.wait(self.maintain_interval)
+            self._wake.clear()
+            try:
+                self._drop_preempted()
+                self.replenish()
+            except Exception as e:
+                logger.warning(f"Warm pool maintenance failed: {e}")
+
+    def _drop_preempted(self):
+        """Kill parked workers whose compile slot was revoked for queued requests"""
+        if not self.slots:
+            return
+        with self.lock:
+            leases = [w['lease'] for ws in self.parked.values() for w in ws if w.get('lease')]
+        if not leases:
+            return
+        held = self.slots.held(leases)
+        to_kill = []
+        with self.lock:
+            for key, workers in self.parked.items():
+                kept = []
+                for worker in workers:
+                    if worker.get('lease') and worker['lease'] not in held:
+                        worker.pop('lease')   # already gone from the table
+                        to_kill.append(worker)
+                    else:
+                        kept.append(worker)
+                self.parked[key] = kept
+            self.stats['preempted'] += len(to_kill)
+        for worker in to_kill:
+            self._kill_worker(worker)
+
+    def _release_lease(self, worker: dict):
+        lease = worker.pop('lease', None)
+        if lease and self.slots:
+            try:
+                self.slots.release(lease, record_duration=False)
+            except Exception as e:
+                logger.warning(f"Warm pool: cannot release compile slot {lease}: {e}")
+
+    def _spawn_worker(self, key: str, preamble: str) -> Optional[dict]:
+        """
+        Start lualatex on the preamble; it parks at \\begin{document}
+        Called without self.lock; None when no compile slot is free or the spawn failed
+        """
+        lease = None
+        if self.slots:
+            try:
+                lease = self.slots.try_acquire(WARM_POOL_USER, 'batch',
+                                               lease_seconds=self.max_idle_seconds + LEASE_MARGIN_SECONDS,
+                                               preemptible=True)
+            except Exception as e:
+                logger.warning(f"Warm pool: compile slots unavailable: {e}")
+            if lease is None:
+                with self.lock:
+                    self.stats['no_slot'] += 1
+                return None
+        memory_mb = self.memory_limit() if self.memory_limit else self.memory_mb
+
+        worker_dir = os.path.join(self.pool_dir, f"worker-{uuid.uuid4().hex}")
+        try:
+            os.makedirs(worker_dir)
+            with open(os.path.join(worker_dir, "tikz.tex"), "w", encoding="utf-8") as f:
+                f.write(preamble.rstrip("\n") + "\n" + WARM_DOCUMENT_TAIL)
+
+            cmd = [
+                self.engine,
+                "-interaction=scrollmode",   # nonstopmode forbids \read from the terminal
+                "-halt-on-error",
+                "--output-directory=.",
+                "tikz.tex"
+            ]
+            console = open(os.path.join(worker_dir, "console.log"), "w", encoding="utf-8")
+            if self.sandbox:
+                # CPU limit covers preamble loading + one job; parked workers use no CPU
+                process = self.sandbox.spawn(cmd, worker_dir, memory_mb, cpu_seconds=180,
+                                             stdin=subprocess.PIPE, stdout=console, stderr=subprocess.STDOUT)
+            else:
+                process = subprocess.Popen(cmd,
+                cwd=worker_dir,
+                stdin=subprocess.PIPE,
+                stdout=console,
+                stderr=subprocess.STDOUT,
+                text=True,
+                start_new_session=True  # own process group, killed as a whole
+                )
+            console.close()
+        except Exception as e:
+            logger.warning(f"Warm pool: failed to spawn worker: {e}")
+            shutil.rmtree(worker_dir, ignore_errors=True)
+            self._release_lease({'lease': lease})
+            return None
+
+        with self.lock:
+            self.stats['spawned'] += 1
+        return {
+            'process': process,
+            'dir': worker_dir,
+            'key': key,
+            'lease': lease,
+            'started_at': time.time()
+        }
+
+    def _kill_worker(self, worker: dict):
+        """Kill the worker's process group, remove its directory and return its compile slot"""
+        self._release_lease(worker)
+        process = worker['process']
+        if process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                pass
+        shutil.rmtree(worker['dir'], ignore_errors=True)
+
+    def _record_demand(self, key: str, preamble: str):
+        entry = self.demand.pop(key, None) or {'preamble': preamble, 'count': 0}
+        entry['count'] += 1
+        entry['last_seen'] = time.time()
+        self.demand[key] = entry
+        while len(self.demand) > self.max_tracked_preambles:
+            self.demand.popitem(last=False)
+
+    def _target_keys(self) -> list:
+        """Most requested preambles get a parked worker"""
+        ranked = sorted(self.demand.items(), key=lambda item: item[1]['count'], reverse=True)
+        return [key for key, _ in ranked[:self.size]]
+
+    def replenish(self):
+        """Recycle idle/dead workers and park one worker per hot preamble (maintainer thread)"""
+        if not self.enabled:
+            return
+
+        to_kill = []
+        with self.lock:
+            self._check_fork()
+            now = time.time()
+            for key, workers in list(self.parked.items()):
+                alive = []
+                for worker in workers:
+                    if worker['process'].poll() is not None:
+                        self.stats['discarded_errors'] += 1
+                        to_kill.append(worker)
+                    elif now - worker['started_at'] > self.max_idle_seconds:
+                        self.stats['recycled_idle'] += 1
+                        to_kill.append(worker)
+                    else:
+                        alive.append(worker)
+                self.parked[key] = alive
+
+            targets = self._target_keys()
+            for key in list(self.parked.keys()):
+                if key not in targets:
+                    to_kill.extend(self.parked.pop(key))
+
+            to_spawn = [(key, self.demand[key]['preamble']) for key in targets
+                        if not self.parked.get(key) and key not in self.spawning]
+            self.spawning.update(key for key, _ in to_spawn)
+            owner_pid = self._owner_pid
+
+        for worker in to_kill:
+            self._kill_worker(worker)
+
+        # lualatex start-up (and the slot table lock) outside self.lock
+        for key, preamble in to_spawn:
+            worker = self._spawn_worker(key, preamble)
+            with self.lock:
+                self.spawning.discard(key)
+                if worker and os.getpid() == owner_pid and key in self._target_keys() and not self.parked.get(key):
+                    self.parked[key] = [worker]
+                    worker = None
+            if worker:
+                self._kill_worker(worker)   # no longer wanted
+
+    def run(self, latex_source: str, work_dir: str, timeout_seconds: int,
+            cancelled: Optional[Callable[[], bool]] = None,
+            stop_on_output: Optional[Callable[[str], bool]] = None) -> Optional[subprocess.CompletedProcess]:
+        """
+        Compile on a parked worker if one matches this preamble
+        Returns CompletedProcess (tikz.pdf/tikz.log moved into work_dir) or None (no warm worker)
+        Raises subprocess.TimeoutExpired on timeout, CompilationCancelled when cancelled()
+        turns true; stop_on_output watches the console like LaTeXSandbox.run (sandboxed workers only)
+        """
+        if not self.enabled:
+            return None
+
+        preamble, body = split_document_body(latex_source)
+        if body is None:
+            return None
+        key = self._preamble_key(preamble)
+
+        worker = None
+        dead = []
+        with self.lock:
+            self._check_fork()
+            self._ensure_maintainer()
+            self._record_demand(key, preamble)
+            workers = self.parked.get(key) or []
+            while workers and worker is None:
+                candidate = workers.pop(0)
+                if candidate['process'].poll() is None:
+                    worker = candidate
+                else:
+                    self.stats['discarded_errors'] += 1
+                    dead.append(candidate)
+            if worker:
+                self.stats['hits'] += 1
+            else:
+                self.stats['misses'] += 1
+
+        for candidate in dead:
+            self._kill_worker(candidate)
+        if worker:
+            self._release_lease(worker)   # the job runs it under its own compile slot
+
+        # Replace the worker we took (or start one for a newly hot preamble) off the request path
+        self._wake.set()
+
+        if worker is None:
+            return None
+
+        try:
+            with open(os.path.join(worker['dir'], "body.tex"), "w", encoding="utf-8") as f:
+                f.write(body)
+            usage = None
+            try:
+                if self.sandbox:
+                    try:
+                        worker['process'].stdin.write("go\n")
+                        worker['process'].stdin.close()
+                    except BrokenPipeError:
+                        pass   # worker died while parked; wait() reports its exit code
+                    with open(os.path.join(worker['dir'], "console.log"), "rb") as console:
+                        stop_early = OutputTail(console.fileno(), stop_on_output) if stop_on_output else None
+                        usage = self.sandbox.wait(worker['process'], timeout_seconds, cancelled=cancelled,
+                                                  stop_early=stop_early)
+                else:
+                    worker['process'].communicate(input="go\n", timeout=timeout_seconds)
+            except subprocess.TimeoutExpired:
+                self.stats['timeouts'] += 1
+                raise
+
+            with open(os.path.join(worker['dir'], "console.log"), "r", encoding="utf-8", errors="replace") as f:
+                console_output = f.read()
+
+            os.makedirs(work_dir, exist_ok=True)
+            with open(os.path.join(work_dir, "tikz.tex"), "w", encoding="utf-8") as f:
+                f.write(latex_source)
+            for name in ("tikz.pdf", "tikz.log"):
+                src = os.path.join(worker['dir'], name)
+                if os.path.exists(src):
+                    shutil.move(src, os.path.join(work_dir, name))
+
+            returncode = worker['process'].returncode
+            if returncode != 0:
+                with self.lock:
+                    self.stats['discarded_errors'] += 1
+
+            completed = subprocess.CompletedProcess(
+                args=worker['process'].args,
+                returncode=returncode,
+                stdout=console_output,
+                stderr=""
+            )
+            completed.usage = usage
+            completed.stopped_early = getattr(worker['process'], 'stopped_early', False)
+            return completed
+        finally:
+            self._kill_worker(worker)
+
+    def get_stats(self) -> dict:
+        """Get warm pool statistics"""
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                'enabled': self.enabled,
+                'size': self.size,
+                'parked_workers': sum(len(w) for w in self.parked.values()),
+                'hot_preambles': len(self._target_keys()),
+                'hit_rate_percent': round(self.stats['hits'] / max(1, lookups) * 100, 2),
+                **self.stats
+            }
+
+    def shutdown(self):
+        """Kill all parked workers"""
+        with self.lock:
+            workers = [w for ws in self.parked.values() for w in ws]
+            self.parked = {}
+        for worker in workers:
+            self._kill_worker(worker)
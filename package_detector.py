@@ -0,0 +1,233 @@
+"""
+Package Auto-Detection
+======================
+detect_required_packages() used to run ~40 any(cmd in tikz_code ...) checks,
+each walking the whole submission again. Here every trigger of every rule is
+compiled into one Aho-Corasick automaton and the code is read once.
+
+- rules = BUILTIN_RULES (below) + rows of the package_detection_rules table
+  whose target is a supported package (PACKAGE_DETECTION_RULES_MIGRATION.sql)
+- DB rules are filtered against the allowlists (SAFE_PACKAGES, ...), so a bad
+  row can never put a package the compiler rejects into the preamble
+- the automaton is rebuilt only when the tables change: their row counts and
+  MAX(updated_at) are checked at most every refresh_seconds, and invalidate()
+  (called by clear_package_cache) forces a check on the next lookup
+- matching is case-sensitive and substring-based, exactly like the old
+  any(... in ...) checks; results come back in rule order, so the generated
+  preamble does not change
+- all built-in triggers start with a backslash: while the automaton is at its
+  root it jumps straight to the next possible first character
+"""
+
+import re
+import time
+import logging
+import threading
+from typing import Callable, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('package', 'tikz_lib', 'pgfplots_lib')
+
+# (kind, targets, triggers) - thứ tự rule = thứ tự trong preamble
+BUILTIN_RULES = (
+    # siunitx - cho đơn vị đo lường
+    ('package', ('siunitx',), ("\\si{", "\\SI{", "\\num{", "\\ang{", "\\unit{")),
+    # circuitikz - cho mạch điện
+    ('package', ('circuitikz',), ("\\ohm", "\\volt", "\\ampere", "\\resistor", "\\capacitor", "\\inductor", "\\battery", "\\lamp")),
+    # tikz-timing - cho timing diagrams
+    ('package', ('tikz-timing',), ("\\timing", "\\timingD{", "\\timingL{", "\\timingH{", "\\timingX{")),
+    # physics - cho ký hiệu vật lý
+    ('package', ('physics',), ("\\vec{", "\\abs{", "\\norm{", "\\order{", "\\qty{", "\\mrm{")),
+    # mathtools - cho toán học nâng cao
+    ('package', ('mathtools',), ("\\DeclarePairedDelimiter", "\\DeclareMathOperator", "\\mathclap", "\\mathllap", "\\mathrlap")),
+    # tikz-cd - cho commutative diagrams
+    ('package', ('tikz-cd',), ("\\begin{tikzcd}", "\\arrow[", "\\arrow{r}", "\\arrow{d}")),
+    # tikz-network - cho network diagrams
+    ('package', ('tikz-network',), ("\\begin{tikzpicture}[network]", "\\Vertex[", "\\Edge[", "\\tikzstyle{VertexStyle}")),
+    # tikzpeople - cho people diagrams
+    ('package', ('tikzpeople',), ("\\person[", "\\tikzstyle{PersonStyle}", "\\begin{tikzpicture}[person")),
+    # tikzmark - cho annotations
+    ('package', ('tikzmark',), ("\\tikzmark{", "\\tikzmarkin{", "\\tikzmarkend{")),
+    # pgfornament - cho ornaments
+    ('package', ('pgfornament',), ("\\pgfornament{", "\\pgfornament[")),
+
+    # TikZ libraries
+    ('tikz_lib', ('decorations.markings', 'decorations.pathreplacing'),
+     ("\\draw[decorate", "\\draw[decoration", "\\decorate", "\\decoration{")),
+    ('tikz_lib', ('patterns',), ("\\draw[pattern", "\\pattern", "\\fill[pattern")),
+    ('tikz_lib', ('shadings',), ("\\draw[shade", "\\shade", "\\shadedraw", "\\shading")),
+    ('tikz_lib', ('hobby',), ("\\draw[hobby", "\\hobby", "\\curve{")),
+    # spy (magnifying glass)
+    ('tikz_lib', ('spy',), ("\\spy",)),
+    ('tikz_lib', ('backgrounds',), ("\\begin{scope}[on background layer]", "\\begin{background}", "\\background")),
+    ('tikz_lib', ('intersections',), ("\\path[name intersections", "\\coordinate[name intersections", "\\draw[name intersections")),
+    ('tikz_lib', ('angles',), ("\\pic[angle", "\\angle", "\\draw pic[angle")),
+    ('tikz_lib', ('quotes',), ("\\draw[quotes", "\\quotes", "\\draw[quotes=")),
+    ('tikz_lib', ('positioning',), ("\\node[above", "\\node[below", "\\node[left", "\\node[right", "\\node[above left",
+                                   "\\node[above right", "\\node[below left", "\\node[below right")),
+    ('tikz_lib', ('arrows.meta',), ("\\draw[-{", "\\draw[->{", "\\draw[<->{", "\\draw[arrows=")),
+    ('tikz_lib', ('shapes.geometric',), ("\\draw[regular polygon", "\\draw[star", "\\draw[diamond", "\\draw[ellipse", "\\draw[circle")),
+    ('tikz_lib', ('shapes.symbols',), ("\\draw[signal", "\\draw[tape", "\\draw[magnifying glass", "\\draw[cloud")),
+    ('tikz_lib', ('shapes.arrows',), ("\\draw[arrow box", "\\draw[strike out", "\\draw[rounded rectangle")),
+    ('tikz_lib', ('fit',), ("\\node[fit=", "\\fit{", "\\draw[fit=")),
+    ('tikz_lib', ('matrix',), ("\\matrix[", "\\matrix of", "\\matrix (", "\\matrix{")),
+    ('tikz_lib', ('chains',), ("\\begin{scope}[start chain", "\\chainin", "\\chainin (", "\\onchain")),
+    ('tikz_lib', ('automata',), ("\\begin{tikzpicture}[automaton", "\\node[state", "\\path[->] node[state")),
+    ('tikz_lib', ('petri',), ("\\begin{tikzpicture}[petri", "\\place[", "\\transition[", "\\arc[")),
+    ('tikz_lib', ('mindmap',), ("\\begin{tikzpicture}[mindmap", "\\concept[", "\\concept color=")),
+    ('tikz_lib', ('trees',), ("\\begin{tikzpicture}[tree", "\\node[level", "\\child[", "\\child {")),
+    ('tikz_lib', ('graphs',), ("\\begin{tikzpicture}[graph", "\\graph[", "\\graph {", "\\graph (")),
+    ('tikz_lib', ('shadows',), ("\\draw[shadow", "\\shadow", "\\shadow{", "\\draw[drop shadow")),
+    ('tikz_lib', ('fadings',), ("\\begin{tikzfadingfrompicture", "\\tikzfading", "\\path[fading=")),
+
+    # pgfplots libraries
+    ('pgfplots_lib', ('fillbetween',), ("\\addplot[fill between", "\\addplot[fillbetween", "\\fillbetween")),
+    ('pgfplots_lib', ('statistics',), ("\\addplot[statistics", "\\addplot[hist", "\\addplot[boxplot", "\\addplot[error bars")),
+    ('pgfplots_lib', ('dateplot',), ("\\addplot[date coordinates", "\\addplot[dateplot", "\\dateplot")),
+    ('pgfplots_lib', ('colorbrewer',), ("\\addplot[colorbrewer", "\\colormap[colorbrewer", "\\pgfplotsset{colormap name=")),
+    ('pgfplots_lib', ('groupplots',), ("\\begin{groupplot}", "\\nextgroupplot", "\\groupplot[", "\\pgfplotsset{groupplot")),
+    ('pgfplots_lib', ('ternary',), ("\\begin{ternaryaxis}", "\\ternaryaxis[", "\\addplot3[ternary", "\\ternaryaxis")),
+    ('pgfplots_lib', ('smithchart',), ("\\begin{smithchart}", "\\smithchart[", "\\addplot[smithchart", "\\smithchart")),
+    ('pgfplots_lib', ('units',), ("\\begin{axis}[x unit=", "\\begin{axis}[y unit=", "\\addplot[unit=")),
+)
+
+
+class TriggerAutomaton:
+    """Aho-Corasick automaton over the triggers; outputs are rule indices"""
+
+    def __init__(self, rules: Iterable[tuple]):
+        self.rules = list(rules)
+        goto = [{}]                 # trie: state -> {char: state}
+        outputs = [set()]           # state -> rule indices of triggers ending here
+        for index, (_, _, triggers) in enumerate(self.rules):
+            for trigger in triggers:
+                state = 0
+                for char in trigger:
+                    following = goto[state].get(char)
+                    if following is None:
+                        following = len(goto)
+                        goto[state][char] = following
+                        goto.append({})
+                        outputs.append(set())
+                    state = following
+                outputs[state].add(index)
+
+        # Failure links breadth-first, folded into a full transition table:
+        # delta[state].get(char, 0) is the next state, no failure walk at match time
+        fail = [0] * len(goto)
+        delta = [dict(goto[0])]
+        delta.extend({} for _ in range(len(goto) - 1))
+        queue = list(goto[0].values())
+        for state in queue:
+            queue.extend(goto[state].values())
+        for state in queue:
+            delta[state] = {**delta[fail[state]], **goto[state]}
+            outputs[state] |= outputs[fail[state]]
+            for char, following in goto[state].items():
+                fail[following] = delta[fail[state]].get(char, 0)
+        self.delta = delta
+        self.outputs = [frozenset(found) for found in outputs]
+
+        # At the root only a trigger's first character can start a match
+        first_chars = ''.join(sorted(goto[0]))
+        self.skip = re.compile('[' + re.escape(first_chars) + ']') if first_chars else None
+
+    def matched_rules(self, text: str) -> set:
+        """Indices of the rules with at least one trigger in text"""
+        found = set()
+        if self.skip is None:
+            return found
+        delta, outputs, search = self.delta, self.outputs, self.skip.search
+        remaining = len(self.rules)
+        state = 0
+        position = 0
+        length = len(text)
+        while position < length:
+            if state == 0:
+                start = search(text, position)
+                if start is None:
+                    break
+                position = start.start()
+            state = delta[state].get(text[position], 0)
+            position += 1
+            if outputs[state]:
+                found |= outputs[state]
+                if len(found) == remaining:
+                    break           # every rule already matched
+        return found
+
+
+class PackageDetector:
+    """Cached trigger automaton for BUILTIN_RULES plus the DB rules"""
+
+    def __init__(self, builtin_rules: Iterable[tuple] = BUILTIN_RULES,
+                 load_rules: Optional[Callable] = None,
+                 rules_signature: Optional[Callable] = None,
+                 allowed: dict = None, refresh_seconds: float = 60.0):
+        self.builtin_rules = tuple(builtin_rules)
+        self.load_rules = load_rules                # () -> [(trigger, kind, target)]
+        self.rules_signature = rules_signature      # () -> anything that changes with the tables
+        self.allowed = allowed or {}                # kind -> set of names accepted by the compiler
+        self.refresh_seconds = refresh_seconds
+
+        self.lock = threading.Lock()
+        self.automaton = TriggerAutomaton(self.builtin_rules)
+        self.signature = None
+        self.checked_at = 0.0
+        self.stats = {'builds': 1, 'db_rules': 0, 'rejected_db_rules': 0, 'refresh_errors': 0}
+
+    def invalidate(self):
+        """Re-check the DB tables on the next detect() (package approved/removed)"""
+        self.checked_at = 0.0
+
+    def _refresh(self):
+        if self.load_rules is None or time.time() - self.checked_at < self.refresh_seconds:
+            return
+        with self.lock:
+            if time.time() - self.checked_at < self.refresh_seconds:
+                return
+            self.checked_at = time.time()
+            try:
+                signature = self.rules_signature() if self.rules_signature else None
+                if signature is not None and signature == self.signature:
+                    return
+                rows = self.load_rules()
+            except Exception as e:
+                self.stats['refresh_errors'] += 1
+                logger.warning(f"Package detection rules not refreshed: {e}")
+                return
+            self.automaton = TriggerAutomaton(self.builtin_rules + self._db_rules(rows))
+            self.signature = signature
+            self.stats['builds'] += 1
+
+    def _db_rules(self, rows) -> tuple:
+        """Group (trigger, kind, target) rows into rules, dropping anything not allowlisted"""
+        triggers = {}
+        rejected = 0
+        for trigger, kind, target in rows:
+            allowed = self.allowed.get(kind)
+            if not trigger or kind not in KINDS or (allowed is not None and target not in allowed):
+                rejected += 1
+                continue
+            triggers.setdefault((kind, target), []).append(trigger)
+        self.stats['db_rules'] = len(rows) - rejected
+        self.stats['rejected_db_rules'] = rejected
+        return tuple((kind, (target,), tuple(found)) for (kind, target), found in triggers.items())
+
+    def detect(self, tikz_code: str) -> tuple:
+        """Auto-detected (packages, tikz_libs, pgfplots_libs) name lists, in rule order"""
+        self._refresh()
+        automaton = self.automaton
+        detected = {kind: [] for kind in KINDS}
+        for index in sorted(automaton.matched_rules(tikz_code)):
+            kind, targets, _ = automaton.rules[index]
+            detected[kind].extend(targets)
+        return tuple(list(dict.fromkeys(detected[kind])) for kind in KINDS)
+
+    def get_stats(self) -> dict:
+        return {
+            'rules': len(self.automaton.rules),
+            'states': len(self.automaton.delta),
+            **self.stats
+        }
@@ -95,9 +95,17 @@ def get_cached_packages(cache_timestamp=None):
             conn.close()
         return {'active': [], 'manual': []}, {}
 
+_package_cache_listeners = []
+
+def on_package_cache_clear(callback):
+    """Register a callback run whenever the package cache is cleared"""
+    _package_cache_listeners.append(callback)
+
 def clear_package_cache():
     """Clear the package cache to force refresh"""
     get_cached_packages.cache_clear()
+    for callback in _package_cache_listeners:
+        callback()
 
 def setup_package_routes(app, limiter=None):
     """Setup all package management routes"""
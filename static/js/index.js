@@ -11,6 +11,10 @@
     let isLoggedIn = false;
     let cm = null; // CodeMirror instance
     let pendingTikzCode = null; // Code TikZ đang chờ được set vào CodeMirror
+    // Session preview của tab này: request mới hủy compile cũ còn đang chạy trên server
+    const previewSessionId = (window.crypto && typeof window.crypto.randomUUID === 'function')
+        ? window.crypto.randomUUID()
+        : Date.now().toString(36) + '-' + Math.random().toString(36).slice(2, 12);
 
     // Initialize app state from HTML
     function initializeAppState() {
@@ -163,6 +167,15 @@
             }, 1000); // Delay 1 giây sau khi ngừng gõ
         });
         
+        // Rời trang: bỏ compile preview còn đang chạy
+        window.addEventListener('pagehide', function() {
+            if (navigator.sendBeacon) {
+                const data = new FormData();
+                data.append('session_id', previewSessionId);
+                navigator.sendBeacon('/api/compile/cancel', data);
+            }
+        });
+        
         // Khởi tạo preview nếu có code TikZ ban đầu
         const initialCode = cm.getValue();
         if (initialCode && initialCode.trim()) {
@@ -170,8 +183,8 @@
         }
     }
 
-    // Hiển thị lỗi biên dịch TikZ, kèm log chi tiết nếu có
-    function displayCompileError(message, fullLog) {
+    // Hiển thị lỗi biên dịch TikZ, kèm trích đoạn log (log đầy đủ tải từ logUrl khi cần)
+    function displayCompileError(message, fullLog, logUrl) {
         // Xóa TẤT CẢ error sections cũ
         document.querySelectorAll('.result-section, #result-section, #ajax-result-section').forEach(el => {
             if (el.querySelector('.error') || el.querySelector('#ajax-show-log-btn')) {
@@ -187,10 +200,17 @@
             html += `<div class=\"ajax-button-container\">`;
             html += `<button id=\"ajax-show-log-btn\">Hiển thị chi tiết log</button>`;
             html += `<button id=\"ajax-copy-log-btn\" style=\"display:none;\">Copy log</button>`;
+            if (logUrl) {
+                html += `<button id=\"ajax-load-log-btn\" style=\"display:none;\">Tải log đầy đủ</button>`;
+            }
             html += `</div>`;
-            html += `<pre id=\"ajax-full-log\" style=\"display:none; background:#fff0f0; color:#b71c1c; border:1px solid #f5c6cb; border-radius:4px; padding:12px; margin-top:10px; max-height:400px; overflow:auto;\">${fullLog}</pre>`;
+            html += `<pre id=\"ajax-full-log\" style=\"display:none; background:#fff0f0; color:#b71c1c; border:1px solid #f5c6cb; border-radius:4px; padding:12px; margin-top:10px; max-height:400px; overflow:auto;\"></pre>`;
         }
         section.innerHTML = html;
+        const logPre = section.querySelector('#ajax-full-log');
+        if (logPre) {
+            logPre.textContent = fullLog;
+        }
         // Insert OUTSIDE the scroll area: sau .table-scroll-x và sau mobile hint
         const tableScroll = document.querySelector('.table-scroll-x');
         const mobileHint = document.getElementById('mobile-scroll-hint');
@@ -238,6 +258,22 @@
         // Gán event handler
         const logBtn = document.getElementById('ajax-show-log-btn');
         const copyBtn = document.getElementById('ajax-copy-log-btn');
+        const loadLogBtn = document.getElementById('ajax-load-log-btn');
+        if (loadLogBtn) {
+            loadLogBtn.onclick = async function() {
+                loadLogBtn.disabled = true;
+                try {
+                    const logResponse = await fetch(logUrl);
+                    if (!logResponse.ok) {
+                        throw new Error(logResponse.status);
+                    }
+                    logPre.textContent = await logResponse.text();
+                    loadLogBtn.remove();
+                } catch (e) {
+                    loadLogBtn.textContent = '❌ Log không còn trên server';
+                }
+            };
+        }
         if (logBtn) {
             logBtn.onclick = function() {
                 const log = document.getElementById('ajax-full-log');
@@ -245,6 +281,7 @@
                     if (log.style.display === 'none') {
                         log.style.display = 'block';
                         this.textContent = 'Ẩn chi tiết log';
+                        if (loadLogBtn) loadLogBtn.style.display = 'inline-flex';
                         if (copyBtn) {
                             copyBtn.style.display = 'inline-flex';
                             // Set responsive margin based on screen size
@@ -266,6 +303,7 @@
                         log.style.display = 'none';
                         this.textContent = 'Hiển thị chi tiết log';
                         if (copyBtn) copyBtn.style.display = 'none';
+                        if (loadLogBtn) loadLogBtn.style.display = 'none';
                     }
                 }
             };
@@ -350,13 +388,14 @@
                     // Tìm full log trong cùng document
                     const fullLogEl = doc.getElementById('full-log');
                     const fullLog = fullLogEl ? fullLogEl.textContent : '';
+                    const logUrl = fullLogEl ? (fullLogEl.dataset.logUrl || '') : '';
                     
                     // Track TikZ render error
                     if (window.analytics) {
                         window.analytics.trackTikzRender(false, 'compile_error');
                     }
                     
-                    displayCompileError(msg, fullLog);
+                    displayCompileError(msg, fullLog, logUrl);
                     // Reset button ngay khi có lỗi
                     if (compileBtn && originalText) {
                         compileBtn.textContent = originalText;
@@ -674,9 +713,14 @@
                 headers: {
                     'Content-Type': 'application/x-www-form-urlencoded',
                 },
-                body: `code=${encodeURIComponent(tikzCode)}`
+                body: `code=${encodeURIComponent(tikzCode)}&session_id=${encodeURIComponent(previewSessionId)}`
             });
             
+            // 409: đã bị thay thế bởi preview mới hơn, request đó sẽ cập nhật giao diện
+            if (response.status === 409) {
+                return;
+            }
+            
             if (response.ok) {
                 const html = await response.text();
                 const parser = new DOMParser();
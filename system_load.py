@@ -0,0 +1,107 @@
+"""
+Background System-Load Sampler
+===============================
+One daemon thread per process samples CPU, memory, load average and the
+compile queue every interval_seconds into a rolling window, so request
+handlers read the latest snapshot instantly instead of sleeping in
+psutil.cpu_percent(interval=0.1).
+
+- CPU comes from psutil.cpu_percent(interval=None): the utilisation since the
+  previous sample, i.e. over one whole interval instead of a 100ms slice
+- snapshot() returns the latest sample plus averages over the window, so
+  load decisions can use the smoothed CPU and one busy second does not
+  flip them
+- the thread starts lazily on first use and again after a fork (gunicorn
+  preload); until the first sample exists, one non-blocking sample is taken
+  inline with CPU estimated from the 1-minute load average
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from typing import Callable, Optional
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+
+class SystemLoadSampler:
+    """Rolling window of host load samples, refreshed by a background thread"""
+
+    def __init__(self, interval_seconds: float = 1.0, window_seconds: float = 30.0,
+                 queue_stats: Optional[Callable] = None):
+        self.interval_seconds = interval_seconds
+        self.samples = deque(maxlen=max(1, int(window_seconds / interval_seconds)))
+        self.queue_stats = queue_stats          # () -> compile_slots stats ('active_count', 'queued')
+        self.lock = threading.Lock()
+        self._started_pid = None
+
+    def ensure_started(self):
+        """Start the sampling thread once per process"""
+        if self._started_pid == os.getpid():
+            return
+        with self.lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            self.samples.clear()                # samples inherited from the parent are stale
+        psutil.cpu_percent(interval=None)       # prime the per-process CPU baseline
+        threading.Thread(target=self._loop, name="system-load-sampler", daemon=True).start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval_seconds)
+            try:
+                sample = self._sample()
+            except Exception:
+                logger.exception("System load sample failed")
+                continue
+            with self.lock:
+                self.samples.append(sample)
+
+    def _sample(self, cpu_percent: float = None) -> dict:
+        memory = psutil.virtual_memory()
+        load1, load5, _ = os.getloadavg()
+        sample = {
+            'timestamp': time.time(),
+            'cpu_percent': psutil.cpu_percent(interval=None) if cpu_percent is None else cpu_percent,
+            'memory_percent': memory.percent,
+            'memory_available_mb': round(memory.available / (1024 ** 2)),
+            'load_1m': round(load1, 2),
+            'load_5m': round(load5, 2),
+            'compiles_active': 0,
+            'compiles_queued': 0
+        }
+        if self.queue_stats:
+            try:
+                stats = self.queue_stats()
+                sample['compiles_active'] = stats.get('active_count', 0)
+                sample['compiles_queued'] = stats.get('queued', 0)
+            except Exception as e:
+                logger.debug(f"Compile queue stats unavailable: {e}")
+        return sample
+
+    def snapshot(self) -> dict:
+        """Latest sample plus window averages; never blocks on a measurement interval"""
+        self.ensure_started()
+        with self.lock:
+            samples = list(self.samples)
+        if not samples:
+            load1 = os.getloadavg()[0]
+            estimate = min(100.0, load1 / (os.cpu_count() or 1) * 100)
+            samples = [self._sample(cpu_percent=round(estimate, 1))]
+
+        latest = samples[-1]
+        count = len(samples)
+        return {
+            **latest,
+            'age_seconds': round(time.time() - latest['timestamp'], 2),
+            'window_samples': count,
+            'avg_cpu_percent': round(sum(s['cpu_percent'] for s in samples) / count, 1),
+            'max_cpu_percent': max(s['cpu_percent'] for s in samples),
+            'avg_memory_percent': round(sum(s['memory_percent'] for s in samples) / count, 1),
+            'avg_compiles_queued': round(sum(s['compiles_queued'] for s in samples) / count, 2)
+        }
@@ -0,0 +1,111 @@
+"""
+Tests cho compile_slots.HostCompileSlots: lane ưu tiên, chia công bằng theo user, try_acquire
+Chạy: python -m pytest -q test_compile_slots.py
+"""
+
+import os
+import time
+
+import pytest
+
+pytest.importorskip("psutil")
+
+from compile_slots import HostCompileSlots, CompilationQueueFull  # noqa: E402
+
+
+def make_slots(tmp_path, **kwargs):
+    kwargs.setdefault('max_concurrent', 2)
+    kwargs.setdefault('max_per_user', 2)
+    return HostCompileSlots(state_dir=str(tmp_path / "slots"), **kwargs)
+
+
+def lease(user_id, lane='interactive', **extra):
+    return {'user_id': user_id, 'lane': lane, 'pid': 1, 'acquired_at': 0.0,
+            'waited_seconds': 0.0, 'expires_at': time.time() + 60, **extra}
+
+
+def waiter(user_id, lane, enqueued_at):
+    return {'user_id': user_id, 'lane': lane, 'pid': 1, 'enqueued_at': enqueued_at, 'heartbeat': enqueued_at}
+
+
+def test_interactive_lane_goes_before_save_and_batch(tmp_path):
+    slots = make_slots(tmp_path, max_concurrent=1)
+    state = {'leases': {}, 'waiters': {
+        'b': waiter('u1', 'batch', 1.0),
+        's': waiter('u2', 'save', 2.0),
+        'i': waiter('u3', 'interactive', 3.0),
+    }}
+    assert slots._admission_order(state) == ['i']
+
+
+def test_user_with_fewer_running_compiles_goes_first(tmp_path):
+    slots = make_slots(tmp_path, max_concurrent=3)
+    state = {'leases': {'l1': lease('heavy')}, 'waiters': {
+        'first': waiter('heavy', 'interactive', 1.0),
+        'second': waiter('light', 'interactive', 2.0),
+    }}
+    assert slots._admission_order(state) == ['second', 'first']
+
+
+def test_fifo_inside_a_lane(tmp_path):
+    slots = make_slots(tmp_path, max_concurrent=1)
+    state = {'leases': {}, 'waiters': {
+        'late': waiter('u1', 'save', 5.0),
+        'early': waiter('u2', 'save', 1.0),
+    }}
+    assert slots._admission_order(state) == ['early']
+
+
+def test_per_user_cap(tmp_path):
+    slots = make_slots(tmp_path, max_concurrent=4, max_per_user=1)
+    state = {'leases': {'l1': lease('u1')}, 'waiters': {'w': waiter('u1', 'interactive', 1.0)}}
+    assert slots._admission_order(state) == []
+
+
+def test_batch_never_takes_more_than_its_share(tmp_path):
+    slots = make_slots(tmp_path, max_concurrent=4, batch_share=0.5)
+    state = {'leases': {'l1': lease('warm', 'batch'), 'l2': lease('bulk', 'batch')}, 'waiters': {
+        'b': waiter('other', 'batch', 1.0),
+        'i': waiter('user', 'interactive', 2.0),
+    }}
+    assert slots._admission_order(state) == ['i']
+
+
+def test_acquire_and_release(tmp_path):
+    slots = make_slots(tmp_path)
+    first = slots.acquire('u1')
+    second = slots.acquire('u2')
+    stats = slots.get_stats()
+    assert stats['active_count'] == 2 and stats['available_slots'] == 0
+    slots.release(first)
+    slots.release(second)
+    assert slots.get_stats()['active_count'] == 0
+
+
+def test_busy_request_is_shed_with_retry_after(tmp_path):
+    slots = make_slots(tmp_path, max_concurrent=1)
+    slots.acquire('u1')
+    with pytest.raises(CompilationQueueFull) as excinfo:
+        slots.acquire('u2', wait_timeout=0.2)
+    assert excinfo.value.retry_after >= 1
+
+
+def test_try_acquire_does_not_pass_waiters(tmp_path):
+    slots = make_slots(tmp_path, max_concurrent=4)
+    assert slots.try_acquire('warm-pool', 'batch') is not None
+    with slots._locked():
+        state = slots._load()
+        state['waiters']['w'] = {**waiter('u1', 'interactive', time.time()), 'pid': os.getpid()}
+        slots._save(state)
+    # Free slots and batch share left, but a request is queued
+    assert slots.try_acquire('format-pool', 'batch') is None
+
+
+def test_preemptible_lease_is_revoked_for_queued_requests(tmp_path):
+    slots = make_slots(tmp_path, max_concurrent=1)
+    parked = slots.try_acquire('warm-pool', 'batch', preemptible=True)
+    assert slots.held([parked]) == {parked}
+    granted = slots.acquire('u1', wait_timeout=1)
+    assert granted
+    assert slots.held([parked]) == set()
+    assert slots.get_stats()['preempted_leases'] == 1
@@ -0,0 +1,106 @@
+"""
+Tests cho compile_workspace.WorkspaceAllocator: hết hạn, touch, quota, prune
+Chạy: python -m pytest -q test_compile_workspace.py
+"""
+
+import os
+import time
+
+import pytest
+
+from compile_workspace import WorkspaceAllocator, KEEP_AFTER_FAILURE
+
+
+@pytest.fixture
+def allocator(tmp_path):
+    workspaces = WorkspaceAllocator(root=str(tmp_path / "work"), ttl_seconds=10, quota_bytes=250)
+    workspaces._started_pid = os.getpid()      # no background cleanup thread: tests call cleanup()
+    return workspaces
+
+
+def write(work_dir, name="tikz.svg", size=100):
+    with open(os.path.join(work_dir, name), "w") as f:
+        f.write("x" * size)
+
+
+def test_ids_must_be_uuids(allocator):
+    assert allocator.path("../etc") is None
+    with pytest.raises(ValueError):
+        allocator.create("not-a-uuid")
+
+
+def test_cleanup_deletes_only_expired_workspaces(allocator):
+    old = allocator.create()
+    allocator.ttl_seconds = 100
+    fresh = allocator.create()
+    os.utime(old, (0, 0))
+    assert allocator.cleanup(now=time.time() + 11) == 1
+    assert not os.path.exists(old)
+    assert os.path.exists(fresh)
+
+
+def test_touch_extends_expiry(allocator):
+    work_dir = allocator.create()
+    first_expiry = allocator.workspaces[os.path.basename(work_dir)]['expires_at']
+    time.sleep(0.01)
+    allocator.touch(work_dir)
+    assert allocator.workspaces[os.path.basename(work_dir)]['expires_at'] > first_expiry
+
+
+def test_cleanup_keeps_a_workspace_touched_by_another_process(allocator):
+    work_dir = allocator.create()
+    later = time.time() + 11
+    os.utime(work_dir, (later - 1, later - 1))   # another worker served the preview (mtime only)
+    assert allocator.cleanup(now=later) == 0
+    assert os.path.exists(work_dir)
+    assert allocator.workspaces[os.path.basename(work_dir)]['expires_at'] > later
+
+
+def test_quota_evicts_closest_to_expiry_first(allocator):
+    first, second, third = allocator.create(), allocator.create(), allocator.create()
+    for work_dir in (first, second, third):
+        write(work_dir)
+        allocator.settle(work_dir)
+    # 300 bytes > 250: the oldest goes, the one just settled stays
+    assert not os.path.exists(first)
+    assert os.path.exists(second) and os.path.exists(third)
+    stats = allocator.get_stats()
+    assert stats['quota_evictions'] == 1 and stats['workspaces'] == 2
+
+
+def test_settle_keeps_the_settled_workspace_even_over_quota(allocator):
+    work_dir = allocator.create()
+    write(work_dir, size=1000)
+    allocator.settle(work_dir)
+    assert os.path.exists(work_dir)
+
+
+def test_release_deletes_and_unindexes(allocator):
+    work_dir = allocator.create()
+    write(work_dir)
+    allocator.settle(work_dir)
+    allocator.release(work_dir)
+    assert not os.path.exists(work_dir)
+    assert allocator.get_stats()['workspaces'] == 0
+    assert allocator.total_bytes == 0
+
+
+def test_prune_keeps_only_the_listed_files(allocator):
+    work_dir = allocator.create()
+    for name in ("tikz.aux", "tikz.pdf", "tikz.log", "tikz.error.json"):
+        write(work_dir, name, size=1)
+    assert allocator.prune(work_dir, keep=KEEP_AFTER_FAILURE) == 2
+    assert sorted(os.listdir(work_dir)) == ["tikz.error.json", "tikz.log"]
+
+
+def test_orphan_sweep_skips_indexed_and_recent_directories(allocator):
+    indexed = allocator.create()
+    orphan = os.path.join(allocator.root, "0f0e0d0c-0b0a-4000-8000-000000000001")
+    recent = os.path.join(allocator.root, "0f0e0d0c-0b0a-4000-8000-000000000002")
+    os.makedirs(orphan)
+    os.makedirs(recent)
+    os.utime(orphan, (0, 0))
+    os.utime(indexed, (0, 0))
+    allocator._sweep_orphans(time.time())
+    assert not os.path.exists(orphan)
+    assert os.path.exists(recent) and os.path.exists(indexed)
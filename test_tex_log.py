@@ -0,0 +1,91 @@
+"""
+Tests cho tex_log: lỗi '!' đầu tiên, map dòng tikz.tex -> dòng trong code người dùng
+Chạy: python -m pytest -q test_tex_log.py
+"""
+
+from tex_log import (FatalErrorWatcher, first_fatal_error, document_line, map_to_user_line,
+                     latex_error_excerpt, error_identity, relocate_error_excerpt)
+
+PREAMBLE = "\\documentclass{standalone}\n\\usepackage{tikz}\n\\begin{document}\n"
+
+CODE = "\\begin{tikzpicture}\n\\draw (0,0) -- (1,1);\n\\foo (2,2);\n\\end{tikzpicture}"
+
+CONSOLE = (
+    "This is LuaHBTeX\n"
+    "! Undefined control sequence.\n"
+    "l.6 \\foo\n"
+    "          (2,2);\n"
+    "The control sequence at the end of the top line\n"
+    "? \n"
+)
+
+
+def test_document_line_is_one_based():
+    assert document_line(PREAMBLE + CODE) == 3
+    assert document_line("no document") is None
+
+
+def test_first_fatal_error():
+    error = first_fatal_error(CONSOLE)
+    assert error['message'] == "Undefined control sequence."
+    assert error['tex_line'] == 6
+    assert error['line_context'] == "\\foo"
+
+
+def test_first_fatal_error_looks_past_emergency_stop():
+    console = "! LaTeX Error: File `x.sty' not found.\n! Emergency stop.\n<read *>\nl.2 \\usepackage{x}\n"
+    error = first_fatal_error(console)
+    assert error['message'].startswith("LaTeX Error: File")
+    assert error['tex_line'] == 2
+    assert all("Emergency stop" not in line and "<read *>" not in line for line in error['context'])
+
+
+def test_map_to_user_line_counts_from_begin_document():
+    assert map_to_user_line(CODE, 6, 3, "\\foo") == 3
+    assert map_to_user_line(CODE, 4, 3) == 1
+
+
+def test_map_to_user_line_skips_package_directives():
+    code = "%!<tikz-cd>\n" + CODE      # dropped by generate_latex_source, not in tikz.tex
+    assert map_to_user_line(code, 6, 3, "\\foo") == 4
+
+
+def test_map_to_user_line_checks_the_context_text():
+    # Wrong offset (e.g. a multi-line template change): the unique line containing the context wins
+    assert map_to_user_line(CODE, 5, 3, "\\foo") == 3
+    # Error raised inside a package file: no line in the user's code
+    assert map_to_user_line(CODE, 900, 3, "\\pgf@nonexistent") is None
+
+
+def test_excerpt_points_at_the_user_line():
+    excerpt = latex_error_excerpt(CONSOLE, CODE, 3)
+    assert excerpt['line'] == 3
+    assert excerpt['source'] == "\\foo (2,2);"
+    assert excerpt['tex_line'] == 6
+
+
+def test_cached_error_is_relocated_in_edited_code():
+    identity = error_identity(latex_error_excerpt(CONSOLE, CODE, 3), CODE)
+    assert 'line' not in identity and 'source' not in identity
+
+    # Same cache key (comments/blank lines only), error now on line 6 / tikz.tex line 9
+    edited = "% ghi chú\n\n\\begin{tikzpicture}\n\\draw (0,0) -- (1,1); % x\n\n  \\foo  (2,2);\n\\end{tikzpicture}"
+    excerpt = relocate_error_excerpt(identity, edited)
+    assert excerpt['line'] == 6
+    assert excerpt['source'] == "  \\foo  (2,2);"
+    assert excerpt['tex_line'] == 9
+    assert excerpt['context'][0].startswith("l.9 ")
+
+
+def test_relocation_drops_the_line_when_ambiguous():
+    identity = error_identity(latex_error_excerpt(CONSOLE, CODE, 3), CODE)
+    excerpt = relocate_error_excerpt(identity, CODE.replace("\\end", "\\foo (2,2);\n\\end"))
+    assert excerpt['line'] is None and excerpt['tex_line'] is None
+    assert not any(line.startswith("l.") for line in excerpt['context'])
+
+
+def test_watcher_stops_after_the_line_reference():
+    watcher = FatalErrorWatcher()
+    results = [watcher.feed(line) for line in CONSOLE.splitlines()]
+    assert results[:3] == [False, False, False]
+    assert results[3] is True
@@ -0,0 +1,54 @@
+"""
+Tests cho tex_normalize.normalize_tikz_code (khoá cache)
+Chạy: python -m pytest -q test_tex_normalize.py
+"""
+
+from tex_normalize import normalize_tikz_code
+
+
+def test_comments_and_spacing_do_not_change_the_key():
+    original = "\\begin{tikzpicture}\n\\draw (0,0) -- (1,1);\n\\end{tikzpicture}"
+    edited = ("% hình vuông\n\\begin{tikzpicture}\n"
+              "   \\draw  (0,0)\t--  (1,1);   % đường chéo\n"
+              "\\end{tikzpicture}\n")
+    assert normalize_tikz_code(edited) == normalize_tikz_code(original)
+
+
+def test_windows_line_endings():
+    assert normalize_tikz_code("a\r\nb\rc") == normalize_tikz_code("a\nb\nc")
+
+
+def test_blank_line_runs_collapse_to_one_paragraph_break():
+    assert normalize_tikz_code("a\n\n\n\nb") == "a\n\nb"
+    # A paragraph break is a token: it is not dropped
+    assert normalize_tikz_code("a\n\nb") != normalize_tikz_code("a\nb")
+
+
+def test_escaped_percent_is_not_a_comment():
+    assert normalize_tikz_code("\\node {50\\% done};") == "\\node {50\\% done};"
+    assert normalize_tikz_code("\\node {50\\%}; % note") == "\\node {50\\%};"
+
+
+def test_percent_that_suppresses_the_line_end_space_is_kept():
+    assert normalize_tikz_code("foo%\nbar") == "foo%\nbar"
+    assert normalize_tikz_code("foo% note\nbar") == "foo%\nbar"
+    assert normalize_tikz_code("foo % note\nbar") == "foo\nbar"
+
+
+def test_control_space_is_kept():
+    assert normalize_tikz_code("a\\  b") == "a\\  b"
+
+
+def test_verb_argument_is_kept_byte_for_byte():
+    code = "\\node {\\verb|a   %  b|};"
+    assert normalize_tikz_code(code) == code
+
+
+def test_verbatim_environment_is_untouched():
+    code = "\\begin{verbatim}\n  x   % y\n\n\n\\end{verbatim}\n\\draw  (0,0);"
+    assert normalize_tikz_code(code) == "\\begin{verbatim}\n  x   % y\n\n\n\\end{verbatim}\n\\draw (0,0);"
+
+
+def test_catcode_changes_are_only_stripped():
+    code = "  \\catcode`\\%=12\n\\node {a % b};  \n"
+    assert normalize_tikz_code(code) == code.strip()
@@ -0,0 +1,255 @@
+"""
+LaTeX Error Excerpts
+====================
+Turns LaTeX console output into a small structured error report instead of
+shipping the whole tikz.log (often megabytes with pgfplots/fontspec) to the
+browser:
+
+- FatalErrorWatcher is fed the console output line by line while the engine
+  runs (LaTeXSandbox.run(stop_on_output=...)); it asks to stop the process as
+  soon as the first '!' error and its 'l.<n>' context have been printed
+- first_fatal_error() / latex_error_excerpt() extract that error from the
+  output: message, a few context lines (help boilerplate dropped), the line in
+  tikz.tex and the same line in the user's code
+- line mapping: the user's code starts on the line after \\begin{document}
+  (TEX_TEMPLATE, TEX_TEMPLATE_MINIMAL and the warm pool's body.tex alike);
+  '%!<...>' package directive lines are dropped by generate_latex_source, so
+  they are skipped when counting. The l.<n> context text is checked against
+  the mapped line, an error raised inside a package file maps to no line
+- the excerpt is saved next to tikz.log as tikz.error.json, so the index
+  route reads a few hundred bytes; the full log is fetched on demand
+- the negative cache is keyed by the normalized code (tex_normalize), shared
+  by submissions that differ in comments/blank lines: it keeps error_identity()
+  (the error and its source line, no positions) and relocate_error_excerpt()
+  finds the line again in the code being replayed
+"""
+
+import os
+import re
+import json
+from typing import Optional
+
+from tex_normalize import normalize_tikz_code
+
+EXCERPT_FILE = "tikz.error.json"
+
+MAX_CONTEXT_LINES = 8
+MAX_LINE_CHARS = 200
+WATCH_MAX_LINES_AFTER_ERROR = 20     # stop even without an l.<n> line (e.g. file not found + Emergency stop)
+
+LINE_REF_RE = re.compile(r'^l\.(\d+)(?: (.*))?$')
+PACKAGE_DIRECTIVE_RE = re.compile(r'^%!<.*>$')     # same rule as generate_latex_source
+BOILERPLATE_RE = re.compile(
+    r'^(See the .* (manual|documentation)|Type {1,2}H <return>|Type {1,2}X to quit|or enter new name\.|'
+    r'You\'re in trouble here|Enter file name:|<read \*>|\s*\.\.\.\s*$|\(That was another \\errmessage\.\))'
+)
+
+
+class FatalErrorWatcher:
+    """Line callback for LaTeXSandbox: True once the first fatal error is fully printed"""
+
+    def __init__(self, max_lines_after_error: int = WATCH_MAX_LINES_AFTER_ERROR):
+        self.max_lines_after_error = max_lines_after_error
+        self.lines_after_error = None    # None until the first '!' line
+        self.line_ref_seen = False
+
+    def feed(self, line: str) -> bool:
+        if self.lines_after_error is None:
+            if line.startswith('!'):
+                self.lines_after_error = 0
+            return False
+        self.lines_after_error += 1
+        if self.line_ref_seen:
+            return True                  # the line after l.<n> is the rest of the source line
+        self.line_ref_seen = bool(LINE_REF_RE.match(line))
+        return self.lines_after_error >= self.max_lines_after_error
+
+
+def _clip(text: str) -> str:
+    return text if len(text) <= MAX_LINE_CHARS else text[:MAX_LINE_CHARS] + "..."
+
+
+def first_fatal_error(console_output: str) -> Optional[dict]:
+    """{'message', 'context', 'tex_line', 'line_context'} of the first '!' error, or None"""
+    lines = (console_output or "").splitlines()
+    start = next((index for index, line in enumerate(lines) if line.startswith('!')), None)
+    if start is None:
+        return None
+
+    message = lines[start].lstrip('!').strip()
+    context = []
+    tex_line = None
+    line_context = None
+    for line in lines[start + 1:start + 1 + WATCH_MAX_LINES_AFTER_ERROR]:
+        if tex_line is not None:
+            context.append(_clip(line))      # continuation of the l.<n> source line
+            break
+        if line.startswith('!'):
+            continue                         # '! Emergency stop.': the l.<n> after it still points at the cause
+        ref = LINE_REF_RE.match(line)
+        if ref:
+            tex_line = int(ref.group(1))
+            line_context = ref.group(2) or ""
+            context.append(_clip(line))
+            continue
+        if line.strip() and not BOILERPLATE_RE.match(line):
+            context.append(_clip(line))
+    return {
+        'message': _clip(message),
+        'context': context[-MAX_CONTEXT_LINES:],
+        'tex_line': tex_line,
+        'line_context': line_context
+    }
+
+
+def document_line(tex_source: str) -> Optional[int]:
+    """1-based line of \\begin{document} in the file TeX reports l.<n> against"""
+    index = tex_source.find("\\begin{document}")
+    return tex_source.count("\n", 0, index) + 1 if index >= 0 else None
+
+
+def _kept_lines(user_lines: list) -> list:
+    """Indexes of the user's lines that reach tikz.tex (package directives are dropped)"""
+    return [index for index, line in enumerate(user_lines) if not PACKAGE_DIRECTIVE_RE.match(line.strip())]
+
+
+def map_to_user_line(tikz_code: str, tex_line: int, begin_document_line: int,
+                     line_context: str = None) -> Optional[int]:
+    """Line of tikz_code (1-based) that tikz.tex line tex_line came from, or None"""
+    user_lines = tikz_code.split('\n')
+    kept = _kept_lines(user_lines)
+    position = tex_line - begin_document_line - 1
+    candidate = kept[position] if 0 <= position < len(kept) else None
+
+    # l.<n> shows the source line up to the error point ('...' when cut on the left)
+    needle = (line_context or "").strip()
+    needle = needle[3:] if needle.startswith("...") else needle
+    if not needle or not needle.isascii():
+        return candidate + 1 if candidate is not None else None
+    if candidate is not None and needle in user_lines[candidate]:
+        return candidate + 1
+    matches = [index for index in kept if needle in user_lines[index]]
+    return matches[0] + 1 if len(matches) == 1 else None
+
+
+def make_error_excerpt(message: str, tikz_code: str, line: Optional[int] = None, column: Optional[int] = None,
+                       context: list = (), tex_line: Optional[int] = None, stopped_early: bool = False) -> dict:
+    """Structured excerpt: what the error panel and the negative cache keep"""
+    user_lines = tikz_code.split('\n')
+    source = user_lines[line - 1] if line and line <= len(user_lines) else None
+    return {
+        'message': _clip(message),
+        'line': line,
+        'column': column,
+        'source': _clip(source) if source is not None else None,
+        'tex_line': tex_line,
+        'context': [_clip(entry) for entry in context][:MAX_CONTEXT_LINES],
+        'stopped_early': stopped_early
+    }
+
+
+def latex_error_excerpt(console_output: str, tikz_code: str, begin_document_line: Optional[int] = None,
+                        stopped_early: bool = False) -> Optional[dict]:
+    """Excerpt of the first fatal error in the console output (None if there is no '!' line)"""
+    error = first_fatal_error(console_output)
+    if error is None:
+        return None
+    line = None
+    if error['tex_line'] is not None and begin_document_line is not None:
+        line = map_to_user_line(tikz_code, error['tex_line'], begin_document_line, error['line_context'])
+    return make_error_excerpt(error['message'], tikz_code, line=line, context=error['context'],
+                              tex_line=error['tex_line'], stopped_early=stopped_early)
+
+
+def error_identity(excerpt: dict, tikz_code: str) -> dict:
+    """
+    What the negative cache keeps of an excerpt: the error and its source line
+    (normalized), with the tikz.tex offset of the user's code instead of absolute lines
+    """
+    identity = {
+        'message': excerpt['message'],
+        'column': excerpt.get('column'),
+        'context': list(excerpt.get('context') or []),
+        'stopped_early': excerpt.get('stopped_early', False),
+        'source_key': None,
+        'tex_offset': None
+    }
+    line = excerpt.get('line')
+    user_lines = tikz_code.split('\n')
+    if line and line <= len(user_lines):
+        identity['source_key'] = normalize_tikz_code(user_lines[line - 1]).strip() or None
+        kept = _kept_lines(user_lines)
+        if excerpt.get('tex_line') is not None and line - 1 in kept:
+            identity['tex_offset'] = excerpt['tex_line'] - kept.index(line - 1)
+    return identity
+
+
+def relocate_error_excerpt(identity: dict, tikz_code: str) -> dict:
+    """
+    Excerpt of a cached error for tikz_code: the line is the one whose normalized text
+    matches the cached source line (None when absent or ambiguous); l.<n> context lines
+    are renumbered, or dropped when the line cannot be placed
+    """
+    user_lines = tikz_code.split('\n')
+    kept = _kept_lines(user_lines)
+    line = tex_line = None
+    if identity.get('source_key'):
+        matches = [index for index in kept if normalize_tikz_code(user_lines[index]).strip() == identity['source_key']]
+        if len(matches) == 1:
+            line = matches[0] + 1
+            if identity.get('tex_offset') is not None:
+                tex_line = identity['tex_offset'] + kept.index(matches[0])
+
+    context = []
+    for entry in identity.get('context') or []:
+        ref = LINE_REF_RE.match(entry)
+        if ref:
+            if tex_line is None:
+                continue
+            entry = f"l.{tex_line}" + entry[len(f"l.{ref.group(1)}"):]
+        context.append(entry)
+    return make_error_excerpt(identity['message'], tikz_code, line=line,
+                              column=identity.get('column') if line else None, context=context,
+                              tex_line=tex_line, stopped_early=identity.get('stopped_early', False))
+
+
+def format_error_excerpt(excerpt: dict) -> str:
+    """Plain-text form for the error panel and error messages"""
+    out = [f"! {excerpt['message']}"]
+    out.extend(excerpt.get('context') or [])
+    if excerpt.get('line'):
+        position = f"dòng {excerpt['line']}" + (f", cột {excerpt['column']}" if excerpt.get('column') else "")
+        out.append("")
+        out.append(f"→ Lỗi ở {position} trong code của bạn:")
+        if excerpt.get('source') is not None:
+            out.append(f"    {excerpt['source']}")
+    return "\n".join(out)
+
+
+def save_error_excerpt(work_dir: str, excerpt: dict):
+    try:
+        with open(os.path.join(work_dir, EXCERPT_FILE), "w", encoding="utf-8") as f:
+            json.dump(excerpt, f, ensure_ascii=False)
+    except OSError:
+        pass
+
+
+def load_error_excerpt(work_dir: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(work_dir, EXCERPT_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_console_log(work_dir: str, console_output: str):
+    """
+    After an early stop TeX never flushed the end of tikz.log (the error itself
+    is usually in the lost buffer); the console transcript replaces it
+    """
+    try:
+        with open(os.path.join(work_dir, "tikz.log"), "w", encoding="utf-8") as f:
+            f.write("% Stopped at the first fatal error: console transcript of the LaTeX run\n")
+            f.write(console_output)
+    except OSError:
+        pass
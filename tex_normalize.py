@@ -0,0 +1,135 @@
+"""
+TeX-safe Canonicalization for Cache Keys
+========================================
+normalize_tikz_code() maps TikZ submissions that TeX reads identically to
+one string. Compilation still uses the code exactly as submitted. Only the
+cache key is computed from the normalized form.
+
+Rules (default catcodes: % = comment, space/tab = spacer, end of line = space):
+- a comment runs from an unescaped % (odd number of preceding backslashes
+  = escaped) to the end of the line and also eats the line end: the comment
+  text is dropped, a bare % is kept where it suppresses the line-end space
+  ("foo%"), and "foo % note" becomes "foo" (same single space token)
+- lines that are only a comment are dropped (they produce no tokens)
+- leading and trailing spaces/tabs of a line are ignored by TeX; runs of
+  spaces/tabs inside a line are one space token
+- consecutive blank lines produce one \\par, so runs of them become one
+- verbatim-like environments and \\verb|...| are kept byte for byte
+- code that changes catcodes or the meaning of spaces/line ends
+  (\\catcode, \\obeyspaces, \\obeylines, ...) is only stripped, never rewritten
+"""
+
+import re
+
+# Environments whose body is read with other catcodes: never touched
+VERBATIM_ENVIRONMENTS = ('verbatim', 'verbatim*', 'Verbatim', 'lstlisting', 'minted', 'comment', 'filecontents', 'filecontents*')
+
+# Any of these makes the default-catcode assumptions unsafe
+UNSAFE_MARKERS = ('\\catcode', '\\obeyspaces', '\\obeylines', '\\endlinechar', '\\ExplSyntaxOn',
+                  '\\makeatletter', '\\lstset', '\\directlua', '\\luaexec', '\\begin{luacode')
+
+_VERBATIM_BEGIN = re.compile(r'\\begin\{(' + '|'.join(re.escape(env) for env in VERBATIM_ENVIRONMENTS) + r')\}')
+_VERB = re.compile(r'\\verb\*?([^a-zA-Z\s*])')
+
+
+def _comment_start(line: str) -> int:
+    """Index of the first unescaped %, -1 if none (\\verb spans are skipped)"""
+    index = 0
+    while index < len(line):
+        char = line[index]
+        if char == '\\':
+            verb = _VERB.match(line, index)
+            if verb:
+                close = line.find(verb.group(1), verb.end())
+                if close == -1:
+                    return -1          # unterminated \verb: leave the rest alone
+                index = close + 1
+                continue
+            index += 2                 # skip the escaped character (\%, \\, ...)
+            continue
+        if char == '%':
+            return index
+        index += 1
+    return -1
+
+
+def _collapse_spaces(text: str) -> str:
+    """Runs of spaces/tabs -> one space; the character of a control symbol (\\<space>) is kept"""
+    output = []
+    index = 0
+    while index < len(text):
+        char = text[index]
+        if char == '\\':
+            output.append(text[index:index + 2])
+            index += 2
+            continue
+        if char in ' \t':
+            while index < len(text) and text[index] in ' \t':
+                index += 1
+            output.append(' ')
+            continue
+        output.append(char)
+        index += 1
+    return ''.join(output)
+
+
+def _normalize_line(line: str):
+    """Normalized line, or None when the line produces no tokens (comment only)"""
+    start = _comment_start(line)
+    if '\\verb' in line:
+        # Keep \verb arguments intact: only drop comment text and trailing spaces
+        if start != -1:
+            line = line[:start + 1]
+        return line.strip(' \t')
+
+    if start == -1:
+        # TeX drops trailing spaces of every input line and skips leading ones
+        return _collapse_spaces(line.strip(' \t'))
+
+    before = line[:start]
+    text = _collapse_spaces(before.strip(' \t'))
+    if not text:
+        return None
+    # "foo % note" reads like "foo" (one space token); "foo%" has no space token, keep its %
+    return text if before[-1] in ' \t' else text + '%'
+
+
+def normalize_tikz_code(tikz_code: str) -> str:
+    """Canonical form of tikz_code for cache keys (see module docstring)"""
+    code = tikz_code.replace('\r\n', '\n').replace('\r', '\n')
+    if any(marker in code for marker in UNSAFE_MARKERS):
+        return code.strip()
+
+    output = []
+    verbatim_end = None
+    blank_pending = False
+    for line in code.split('\n'):
+        if verbatim_end is not None:
+            output.append(line)
+            if verbatim_end in line:
+                verbatim_end = None
+            continue
+
+        begin = _VERBATIM_BEGIN.search(line)
+        if begin and (_comment_start(line) == -1 or _comment_start(line) > begin.start()):
+            end_marker = f"\\end{{{begin.group(1)}}}"
+            if end_marker not in line[begin.end():]:
+                verbatim_end = end_marker
+            if blank_pending and output:
+                output.append('')
+            blank_pending = False
+            output.append(line)
+            continue
+
+        normalized = _normalize_line(line)
+        if normalized is None:
+            continue
+        if not normalized:
+            blank_pending = True
+            continue
+        if blank_pending and output:
+            output.append('')
+        blank_pending = False
+        output.append(normalized)
+
+    return '\n'.join(output)
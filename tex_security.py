@@ -0,0 +1,263 @@
+"""
+Single-Pass TeX Security Scanner
+================================
+scan_tex_security() tokenizes the submitted code once and checks every rule
+of DANGEROUS_PATTERNS on the token stream. Each token is looked at a bounded
+number of times, so the time is linear in the input. The old loop ran ~30
+regexes with .* chains, some of which backtracked cubically on adversarial
+input.
+
+- oversized input (> max_bytes) is rejected before anything else is read
+- comments are skipped (TeX never executes them); \\% and \\{ are symbols
+- control-sequence rules match by name prefix, case-insensitively, like the
+  old regexes (\\special also catches \\specialfoo)
+- "A ... B" rules (\\loop ... \\repeat, \\csname ... \\endcsname, ...) only
+  match within one line, as .* without DOTALL did
+- brace-argument rules (\\input{..}, \\url{..}) read the argument up to the
+  next } token, the same span as [^}]*
+- the same pass collects brace balance and depth and \\foreach counts for the
+  warnings
+"""
+
+import re
+
+MAX_CODE_BYTES = 50000
+MAX_BRACE_DEPTH = 20
+MAX_FOREACH = 5
+MAX_BRACE_IMBALANCE = 5
+
+# Rule keys (the former regexes) -> description; the scanner implements them token by token
+DANGEROUS_PATTERNS = {
+    # Shell execution attempts
+    r'\\write18': "Shell execution command detected",
+    r'\\immediate\\write18': "Immediate shell execution detected",
+    r'\\special': "Special command detected",
+
+    # File system access attempts
+    r'\\input\{[^}]*\.\./': "Directory traversal attempt",
+    r'\\input\{/(?:etc|root|home)/': "System file access attempt",
+    r'\\openin': "File input stream detected",
+    r'\\openout': "File output stream detected",
+
+    # Suspicious file operations
+    r'\\verbatiminput\{[^}]*(?:/etc/|/root/|/home/)': "System file read attempt",
+    r'\\lstinputlisting\{[^}]*(?:/etc/|/root/|/home/)': "System file listing attempt",
+
+    # Network/URL attempts
+    r'\\url\{(?:file://|ftp://)[^}]*\}': "Local/FTP URL detected",
+
+    # Code injection attempts
+    r'\\catcode.*=.*13': "Catcode manipulation detected",
+    r'\\lowercase\{.*\\def': "Lowercase definition trick detected",
+    r'\\csname.*\\endcsname': "Control sequence name manipulation",
+
+    # Resource exhaustion patterns
+    r'\\loop.*\\repeat': "Potentially infinite loop detected",
+    r'\\foreach.*\\foreach.*\\foreach': "Nested loop with potential DoS",
+
+    # Lua execution (for lualatex)
+    r'\\directlua\{': "Direct Lua execution detected",
+    r'\\luaexec\{': "Lua execution detected",
+
+    # Advanced patterns (LaTeX3 and modern packages)
+    r'\\__[\w_]+:': "LaTeX3 internal command access detected",
+    r'\\exp_last_unbraced:': "Advanced expansion manipulation detected",
+
+    # TikZ-specific abuses
+    r'\\tikzset{.*execute\s*=.*begin': "TikZ code execution attempt",
+    r'pgfinvokebeamer': "Beamer-specific command injection",
+
+    # Memory-based attacks
+    r'\\pgfmathdeclfunction.*\{.*\{.*\{.*': "Recursive function definition detected",
+    r'\\def\\recursive.*\\recursive': "Recursive macro definition detected",
+
+    # Advanced file operations
+    r'\\pdffiledump': "PDF file dump attempt",
+    r'\\pdfmdfivesum': "PDF checksum access attempt",
+    r'\\pdfcreationdate': "PDF metadata access attempt",
+}
+
+# Control-word prefix -> rule key (matched as soon as the token is read)
+_PRIMITIVE_RULES = (
+    ('special', r'\\special'),
+    ('openin', r'\\openin'),
+    ('openout', r'\\openout'),
+    ('directlua', r'\\directlua\{'),
+    ('luaexec', r'\\luaexec\{'),
+    ('pdffiledump', r'\\pdffiledump'),
+    ('pdfmdfivesum', r'\\pdfmdfivesum'),
+    ('pdfcreationdate', r'\\pdfcreationdate'),
+)
+
+# \cmd{argument} rules whose argument may contain a system path anywhere ([^}]*)
+_PATH_ARGUMENT_RULES = {
+    'input': r'\\input\{[^}]*\.\./',
+    'verbatiminput': r'\\verbatiminput\{[^}]*(?:/etc/|/root/|/home/)',
+    'lstinputlisting': r'\\lstinputlisting\{[^}]*(?:/etc/|/root/|/home/)',
+}
+
+_SYSTEM_DIRS = ('/etc/', '/root/', '/home/')
+
+# One alternative per token kind; no nested quantifiers, so finditer is linear
+_TOKEN = re.compile(r'\\([a-z@]+|.)|([{}])|(\n)|%[^\n]*', re.S)
+_LATEX3_INTERNAL = re.compile(r'_[\w_]+:')
+_TIKZSET_EXECUTE = re.compile(r'execute\s*=')
+
+
+def _line_end(code: str, position: int) -> int:
+    end = code.find('\n', position)
+    return len(code) if end == -1 else end
+
+
+def _argument_violation(code: str, arguments: dict, end: int):
+    """
+    Rule key violated by an open \\cmd{ argument ending at end, or None
+    Only the earliest start per command is kept: its span contains the others
+    """
+    for command, start in arguments.items():
+        if command == 'input':
+            if code.find('../', start, end) != -1:
+                return _PATH_ARGUMENT_RULES['input']
+        elif any(code.find(directory, start, end) != -1 for directory in _SYSTEM_DIRS):
+            return _PATH_ARGUMENT_RULES[command]
+    return None
+
+
+def scan_tex_security(tikz_code: str, max_bytes: int = MAX_CODE_BYTES) -> dict:
+    """
+    One pass over tikz_code
+    Returns: {'violation': rule key | None, 'line': int | None, 'too_large': bool,
+              'brace_balance': int, 'max_depth': int, 'foreach_count': int}
+    """
+    result = {'violation': None, 'line': None, 'too_large': False,
+              'brace_balance': 0, 'max_depth': 0, 'foreach_count': 0}
+    if len(tikz_code) > max_bytes:
+        result['too_large'] = True
+        return result
+
+    code = tikz_code.lower()
+    if 'pgfinvokebeamer' in code:
+        result['violation'] = r'pgfinvokebeamer'
+        result['line'] = code.count('\n', 0, code.index('pgfinvokebeamer')) + 1
+        return result
+
+    depth = 0
+    max_depth = 0
+    foreach_count = 0
+    line = 1
+    seen = set()                     # "A ... B" rule state for the current line
+    line_foreach = 0
+    previous = None                  # previous control word, if only spaces follow it
+    previous_end = 0
+    arguments = {}                   # \cmd{ -> start of its argument, closed by the next }
+    url_file = False                 # \url{file://... waiting for its }
+
+    def violation(rule: str) -> dict:
+        result.update(violation=rule, line=line, brace_balance=depth, max_depth=max_depth, foreach_count=foreach_count)
+        return result
+
+    for token in _TOKEN.finditer(code):
+        name, brace, newline = token.group(1), token.group(2), token.group(3)
+        if previous is not None and code[previous_end:token.start()].strip(' \t'):
+            previous = None          # text in between: not \cmd{...}
+
+        if newline:
+            line += 1
+            seen.clear()
+            line_foreach = 0
+            previous = None
+            continue
+
+        if brace == '{':
+            depth += 1
+            max_depth = max(max_depth, depth)
+            position = token.end()
+            if previous in _PATH_ARGUMENT_RULES:
+                if previous == 'input' and code.startswith(_SYSTEM_DIRS, position):
+                    return violation(r'\\input\{/(?:etc|root|home)/')
+                arguments.setdefault(previous, position)
+            elif previous == 'url':
+                url_file = url_file or code.startswith(('file://', 'ftp://'), position)
+            elif previous == 'lowercase':
+                seen.add('lowercase{')
+            elif previous == 'tikzset' and 'tikzset{' not in seen:
+                # execute = ... begin, later on the same line
+                seen.add('tikzset{')
+                line_end = _line_end(code, position)
+                execute = _TIKZSET_EXECUTE.search(code, position, line_end)
+                if execute and code.find('begin', execute.end(), line_end) != -1:
+                    return violation(r'\\tikzset{.*execute\s*=.*begin')
+            previous = None
+            continue
+
+        if brace == '}':
+            depth -= 1
+            if arguments:
+                rule = _argument_violation(code, arguments, token.start())
+                if rule:
+                    return violation(rule)
+                arguments.clear()
+            if url_file:
+                return violation(r'\\url\{(?:file://|ftp://)[^}]*\}')
+            previous = None
+            continue
+
+        if name is None:
+            previous = None          # comment
+            continue
+
+        before, previous, previous_end = previous, name, token.end()
+
+        if name == '_':
+            if _LATEX3_INTERNAL.match(code, token.end()):
+                return violation(r'\\__[\w_]+:')
+            continue
+
+        for prefix, rule in _PRIMITIVE_RULES:
+            if name.startswith(prefix):
+                return violation(rule)
+
+        if name.startswith('write'):
+            rest = code[token.end():token.end() + 8].lstrip(' \t')
+            if (name[5:] or rest).startswith('18'):
+                return violation(r'\\write18')
+        elif name == 'exp' and code.startswith('_last_unbraced:', token.end()):
+            return violation(r'\\exp_last_unbraced:')
+        elif name.startswith('catcode') and 'catcode' not in seen:
+            seen.add('catcode')
+            line_end = _line_end(code, token.end())
+            equals = code.find('=', token.end(), line_end)
+            if equals != -1 and code.find('13', equals, line_end) != -1:
+                return violation(r'\\catcode.*=.*13')
+        elif name.startswith('pgfmathdeclfunction') and 'pgfmathdeclfunction' not in seen:
+            seen.add('pgfmathdeclfunction')
+            if code.count('{', token.end(), _line_end(code, token.end())) >= 3:
+                return violation(r'\\pgfmathdeclfunction.*\{.*\{.*\{.*')
+        elif name.startswith('foreach'):
+            foreach_count += 1
+            line_foreach += 1
+            if line_foreach >= 3:
+                return violation(r'\\foreach.*\\foreach.*\\foreach')
+        elif name.startswith('loop'):
+            seen.add('loop')
+        elif name.startswith('repeat') and 'loop' in seen:
+            return violation(r'\\loop.*\\repeat')
+        elif name.startswith('csname'):
+            seen.add('csname')
+        elif name.startswith('endcsname') and 'csname' in seen:
+            return violation(r'\\csname.*\\endcsname')
+        elif name.startswith('def') and 'lowercase{' in seen:
+            return violation(r'\\lowercase\{.*\\def')
+        elif name.startswith('recursive'):
+            if 'def\\recursive' in seen:
+                return violation(r'\\def\\recursive.*\\recursive')
+            if before == 'def':
+                seen.add('def\\recursive')
+
+    # [^}]* rules do not need the closing brace
+    rule = _argument_violation(code, arguments, len(code))
+    if rule:
+        return violation(rule)
+
+    result.update(brace_balance=depth, max_depth=max_depth, foreach_count=foreach_count)
+    return result
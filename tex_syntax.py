@@ -0,0 +1,258 @@
+"""
+TeX Syntax Pre-Check
+====================
+check_tex_syntax() is a structural linter that runs before the compile stage.
+It rejects code that cannot compile (unbalanced braces, \\begin/\\end
+mismatches, a missing \\end{tikzpicture}, unterminated math, ...) in a few
+milliseconds instead of a LaTeX run, and reports line/column positions in the
+user's own code.
+
+- one pass over a tokenizer in the style of tex_security: comments, \\%, \\{ and
+  \\$ are skipped; line/column are computed only when an error is reported
+- only errors TeX itself is certain to raise are reported; anything that
+  depends on macro expansion is left to LaTeX:
+  * environment checks are off when the code defines macros or environments
+    (\\newcommand{\\be}{\\begin{center}} would look unbalanced)
+  * nothing is checked when the code uses \\verb, verbatim-like environments
+    or \\iffalse
+  * [ ] is only checked as an option list right after a command that takes
+    one (\\draw[, \\node[, \\begin{axis}[, \\\\[, \\tkz...[); a [ in math such
+    as $x \\in [0,1)$ is plain text
+- unknown environments are checked against TEMPLATE_ENVIRONMENTS plus those of
+  the detected packages/libraries; a loaded package missing from
+  PACKAGE_ENVIRONMENTS switches that check off
+- every error has category 'syntax' (CompilationErrorClassifier)
+"""
+
+import re
+
+MAX_ERRORS = 5
+
+# Environments of the LaTeX kernel and of the packages/libraries in TEX_TEMPLATE
+TEMPLATE_ENVIRONMENTS = frozenset({
+    # LaTeX kernel
+    'document', 'center', 'flushleft', 'flushright', 'minipage', 'tabular', 'tabular*', 'array',
+    'itemize', 'enumerate', 'description', 'list', 'trivlist', 'quote', 'quotation', 'verse',
+    'equation', 'displaymath', 'math', 'eqnarray', 'eqnarray*', 'picture', 'tabbing', 'lrbox',
+    'figure', 'figure*', 'table', 'table*', 'titlepage', 'thebibliography', 'theindex', 'sloppypar',
+    # \begin{cmd} works for every command; these are the ones used as environments in practice
+    'tiny', 'scriptsize', 'footnotesize', 'small', 'normalsize', 'large', 'Large', 'LARGE',
+    'huge', 'Huge', 'bfseries', 'mdseries', 'itshape', 'slshape', 'scshape', 'upshape',
+    'rmfamily', 'sffamily', 'ttfamily', 'normalfont', 'em', 'centering', 'raggedright',
+    'raggedleft', 'color', 'group',
+    # amsmath
+    'equation*', 'align', 'align*', 'alignat', 'alignat*', 'flalign', 'flalign*', 'gather',
+    'gather*', 'multline', 'multline*', 'split', 'aligned', 'alignedat', 'gathered', 'cases',
+    'matrix', 'pmatrix', 'bmatrix', 'Bmatrix', 'vmatrix', 'Vmatrix', 'smallmatrix', 'subequations',
+    'subarray',
+    # tikz / pgf
+    'tikzpicture', 'scope', 'pgfonlayer', 'pgfpicture', 'pgfscope', 'pgfinterruptpicture',
+    'pgfinterruptboundingbox', 'pgfinterruptpath', 'pgflowlevelscope', 'pgfviewboxscope',
+    'pgftransparencygroup',
+    # pgfplots (+ polar)
+    'axis', 'semilogxaxis', 'semilogyaxis', 'loglogaxis', 'polaraxis',
+})
+
+# Package / library -> environments it adds; every SAFE_* name should be listed
+PACKAGE_ENVIRONMENTS = {
+    'fontspec': (), 'xcolor': ('testcolors',), 'graphicx': (), 'geometry': (),
+    'setspace': ('singlespace', 'singlespace*', 'onehalfspace', 'doublespace', 'spacing'),
+    'amsmath': (), 'amssymb': (), 'amsfonts': (), 'physics': (), 'siunitx': (), 'cancel': (),
+    'mathtools': ('dcases', 'dcases*', 'rcases', 'rcases*', 'drcases', 'cases*', 'matrix*', 'pmatrix*',
+                  'bmatrix*', 'Bmatrix*', 'vmatrix*', 'Vmatrix*', 'smallmatrix*', 'psmallmatrix',
+                  'bsmallmatrix', 'Bsmallmatrix', 'vsmallmatrix', 'Vsmallmatrix', 'multlined',
+                  'lgathered', 'rgathered', 'spreadlines'),
+    'cases': ('numcases', 'subnumcases'),
+    'tikz': (), 'pgf': (), 'pgfkeys': (), 'pgfplots': (), 'tikz-3dplot': (), 'tkz-euclide': (),
+    'tkz-tab': (), 'pgfornament': (), 'tikz-network': (), 'tikzpeople': (), 'tikzmark': (),
+    'circuitikz': ('circuitikz',),
+    'tikz-timing': ('tikztimingtable', 'extracode', 'background'),
+    'tikz-cd': ('tikzcd',),
+    'array': (), 'booktabs': (), 'multirow': (), 'colortbl': (),
+    'longtable': ('longtable',), 'tabularx': ('tabularx',),
+    # TikZ libraries
+    'fadings': ('tikzfadingfrompicture',),
+    # pgfplots libraries
+    'groupplots': ('groupplot',), 'ternary': ('ternaryaxis',), 'smithchart': ('smithchart',),
+    'polar': ('polaraxis',),
+}
+
+# Commands whose [ right after them opens an option list
+OPTION_COMMANDS = frozenset({
+    'draw', 'fill', 'filldraw', 'path', 'node', 'coordinate', 'shade', 'shadedraw', 'clip',
+    'pattern', 'pic', 'matrix', 'tikz', 'foreach', 'addplot', 'addplot3', 'tikzset',
+    'nextgroupplot', 'usetikzlibrary', 'begin', '\\',
+})
+
+# Code that defines macros/environments: \begin/\end pairing may come from expansion
+_DEFINITIONS = re.compile(r'\\(?:[egx]?def|let|(?:re)?newcommand|providecommand|(?:re)?newenvironment|'
+                          r'NewDocument(?:Command|Environment)|newtheorem|DeclareDocument\w+|tikzfading)(?![A-Za-z@])')
+_UNCHECKABLE = re.compile(r'\\(?:verb|iffalse|lstinline|mintinline)(?![A-Za-z@])|'
+                          r'\\begin\s*\{(?:verbatim|Verbatim|lstlisting|minted|comment)\*?\}')
+
+_TOKEN = re.compile(r'\\([A-Za-z@]+|.)|(\$\$|[{}\[\]$])|(\n[ \t]*\n)|%[^\n]*', re.S)
+_ENV_NAME = re.compile(r'\s*\{([^{}]*)\}')
+_MATH_CLOSE = {'(': ')', '[': ']'}
+
+
+def _position(code: str, offset: int) -> tuple:
+    line = code.count('\n', 0, offset) + 1
+    return line, offset - (code.rfind('\n', 0, offset) + 1) + 1
+
+
+def known_environments(packages=(), tikz_libs=(), pgfplots_libs=()):
+    """Environments available with these extras, None if a package is unknown to the linter"""
+    known = set(TEMPLATE_ENVIRONMENTS)
+    for entry in packages or []:
+        environments = PACKAGE_ENVIRONMENTS.get(entry.get('name', '') if isinstance(entry, dict) else str(entry))
+        if environments is None:
+            return None
+        known.update(environments)
+    # Allowlisted libraries only add the environments listed here
+    for library in list(tikz_libs or []) + list(pgfplots_libs or []):
+        known.update(PACKAGE_ENVIRONMENTS.get(library, ()))
+    return known
+
+
+def check_tex_syntax(tikz_code: str, packages=(), tikz_libs=(), pgfplots_libs=(),
+                     max_errors: int = MAX_ERRORS) -> list:
+    """
+    Structural errors in tikz_code, first max_errors in reading order
+    Returns: [{'category': 'syntax', 'kind': 'brace'|'bracket'|'environment'|'math'|'unknown_environment',
+               'message': str, 'line': int, 'column': int}]  ([] = nothing certain to fail)
+    """
+    if _UNCHECKABLE.search(tikz_code):
+        return []
+    check_environments = not _DEFINITIONS.search(tikz_code)
+    environments = known_environments(packages, tikz_libs, pgfplots_libs) if check_environments else None
+
+    code = tikz_code
+    errors = []
+    braces = []                      # offsets of open {
+    envs = []                        # (name, offset, brace depth)
+    options = []                     # (offset, brace depth) of open option [
+    maths = []                       # (delimiter, offset, brace depth)
+    option_command_end = None        # end of a command that may be followed by [
+
+    def error(kind: str, message: str, offset: int):
+        line, column = _position(code, offset)
+        errors.append({'category': 'syntax', 'kind': kind, 'message': message, 'line': line, 'column': column})
+
+    for token in _TOKEN.finditer(code):
+        if len(errors) >= max_errors:
+            return errors
+        name, symbol, paragraph = token.group(1), token.group(2), token.group(3)
+        start = token.start()
+        option_after = option_command_end is not None and not code[option_command_end:start].strip()
+        option_command_end = None
+
+        if paragraph:
+            if maths:
+                error('math', "Missing $ inserted (blank line inside math)", maths[-1][1])
+                maths.clear()
+            continue
+
+        if symbol == '{':
+            braces.append(start)
+        elif symbol == '}':
+            if not braces:
+                error('brace', "Too many }'s", start)
+                continue
+            depth = len(braces)
+            if maths and maths[-1][2] >= depth:
+                error('math', "Extra }, or forgotten $", start)
+                maths = [m for m in maths if m[2] < depth]
+            if options and options[-1][1] >= depth:
+                error('bracket', "Runaway argument: option list [ is never closed by ]", options[-1][0])
+                options = [o for o in options if o[1] < depth]
+            if envs and envs[-1][2] >= depth and check_environments:
+                error('environment', f"Extra }}, or forgotten \\end{{{envs[-1][0]}}}", start)
+                envs = [e for e in envs if e[2] < depth]
+            braces.pop()
+        elif symbol == '[':
+            if option_after:
+                options.append((start, len(braces)))
+        elif symbol == ']':
+            if options and options[-1][1] == len(braces):
+                options.pop()
+        elif symbol in ('$', '$$'):
+            top = maths[-1][0] if maths and maths[-1][2] == len(braces) else None
+            if top == symbol:
+                maths.pop()
+            elif top == '$':
+                maths[-1] = ('$', start + 1, len(braces))       # $a$$b$: closes one, opens the next
+            elif top == '$$':
+                error('math', "Display math should end with $$", start)
+                maths.pop()
+            else:
+                maths.append((symbol, start, len(braces)))      # nested: \text{$x$} inside math
+        elif name is None:
+            continue                 # comment
+        elif name in ('(', '['):
+            maths.append((name, start, len(braces)))
+        elif name in (')', ']'):
+            if maths and _MATH_CLOSE.get(maths[-1][0]) == name:
+                maths.pop()
+        elif name in ('begin', 'end'):
+            argument = _ENV_NAME.match(code, token.end())
+            if argument is None:
+                continue
+            env = argument.group(1).strip()
+            if name == 'begin':
+                option_command_end = argument.end()
+                if not check_environments:
+                    continue
+                if environments is not None and env not in environments:
+                    error('unknown_environment', f"Environment {env} undefined", start)
+                envs.append((env, start, len(braces)))
+            elif check_environments:
+                if not envs:
+                    error('environment', f"Extra \\end{{{env}}}", start)
+                    continue
+                if maths and maths[-1][1] > envs[-1][1]:
+                    error('math', f"Missing $ inserted before \\end{{{env}}}", maths[-1][1])
+                    maths = [m for m in maths if m[1] < envs[-1][1]]
+                if envs[-1][0] != env:
+                    begin_line, _ = _position(code, envs[-1][1])
+                    error('environment', f"\\begin{{{envs[-1][0]}}} on line {begin_line} ended by \\end{{{env}}}", start)
+                    if any(e[0] == env for e in envs):
+                        while envs and envs[-1][0] != env:
+                            envs.pop()
+                    else:
+                        continue
+                if envs[-1][2] != len(braces):
+                    error('brace', f"Unbalanced braces inside \\begin{{{env}}} ... \\end{{{env}}}", start)
+                envs.pop()
+        elif name in OPTION_COMMANDS or name.startswith('tkz'):
+            option_command_end = token.end()
+
+    for offset, _ in options:
+        error('bracket', "Runaway argument: option list [ is never closed by ]", offset)
+    for delimiter, offset, _ in maths:
+        closer = delimiter if delimiter in ('$', '$$') else '\\' + _MATH_CLOSE[delimiter]
+        error('math', f"Missing {closer} for math opened here (file ended inside math)", offset)
+    for env, offset, _ in envs:
+        error('environment', f"\\begin{{{env}}} is never closed: \\end{{{env}}} missing", offset)
+    for offset in braces:
+        error('brace', "Missing } for { opened here (file ended inside a group)", offset)
+    return errors[:max_errors]
+
+
+def format_syntax_errors(tikz_code: str, errors: list) -> str:
+    """TeX-log style text ('! message' + 'l.<n> context') for the error log view"""
+    lines = tikz_code.split('\n')
+    out = []
+    for entry in errors:
+        out.append(f"! {entry['message']}.")
+        context = lines[entry['line'] - 1] if entry['line'] <= len(lines) else ''
+        out.append(f"l.{entry['line']} {context[:entry['column'] - 1][-60:]}")
+        out.append(f"{' ' * (len(str(entry['line'])) + 2 + min(entry['column'] - 1, 60))}{context[entry['column'] - 1:][:60]}")
+        out.append("")
+    return "\n".join(out)
+
+
+def syntax_error_summary(errors: list) -> str:
+    """One-line message for the compile result: first error with its position"""
+    first = errors[0]
+    more = f" (+{len(errors) - 1} more)" if len(errors) > 1 else ""
+    return f"Syntax pre-check failed: line {first['line']}, column {first['column']}: {first['message']}{more}"
@@ -248,18 +248,20 @@ def create_production_app():
         """Production health check endpoint"""
         import time
         import psutil
+        from app import system_load_sampler
         
         try:
-            # System health metrics
-            cpu_percent = psutil.cpu_percent(interval=0.1)
-            memory = psutil.virtual_memory()
+            # System health metrics (background sampler snapshot, no 100ms sleep per probe)
+            load = system_load_sampler.snapshot()
+            cpu_percent = load['cpu_percent']
+            memory_percent = load['memory_percent']
             disk = psutil.disk_usage('/')
             
             # Determine health status
-            if cpu_percent > 90 or memory.percent > 90 or disk.percent > 95:
+            if cpu_percent > 90 or memory_percent > 90 or disk.percent > 95:
                 status = "critical"
                 http_status = 503
-            elif cpu_percent > 70 or memory.percent > 80 or disk.percent > 90:
+            elif cpu_percent > 70 or memory_percent > 80 or disk.percent > 90:
                 status = "degraded"
                 http_status = 200
             else:
@@ -273,7 +275,7 @@ def create_production_app():
                 "platform": "Enhanced Whitelist + Resource Limits",
                 "system": {
                     "cpu_percent": cpu_percent,
-                    "memory_percent": memory.percent,
+                    "memory_percent": memory_percent,
                     "disk_percent": disk.percent
                 },
                 "features": {